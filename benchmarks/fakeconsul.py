@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Fake Consul HTTP server serving synthetic responses
+
+Serves /v1/health/service/<service> (blocking queries included),
+/v1/query (list, create, execute, delete), /v1/catalog/services,
+/v1/catalog/service/<service> and /v1/status/leader with the given number
+of instances per service. Responses are generated once per service and
+datacenter and served from memory, compressed when the client accepts it
+(gzip unless --encoding or --no-gzip). Health filter expressions are
+evaluated with counsel's Where, unless --no-filters emulates agents which
+don't support them. Query names are unique, like in Consul.
+
+The tests use it as the consul fixture (see tests/conftest.py).
+
+Usage:
+  fakeconsul.py [--port=port] [--instances=number] [--tags=number] [--latency=ms] [--no-filters]
+                [--no-gzip|--encoding=encoding]
+
+Options:
+  --port=port           port to listen on [default: 8500]
+  --instances=number    number of instances of every service [default: 1000]
+  --tags=number         number of tags of every instance [default: 8]
+  --latency=ms          delay added to every response [default: 0]
+  --no-filters          ignore the filter parameter
+  --no-gzip             never compress responses
+  --encoding=encoding   compress responses by gzip, deflate or raw-deflate (deflate without
+                        the zlib header) [default: gzip]
+"""
+import gzip
+import json
+import time
+import uuid
+import zlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from docopt import docopt
+from counsel.where import Where
+
+
+def instances(service, count, tags=8, dc='dc1'):
+    '''Synthetic health entries of the service
+    '''
+    return [{
+        'Node': {
+            'ID': str(uuid.UUID(int=i)),
+            'Node': 'node-%d' % i,
+            'Address': '10.%d.%d.%d' % (i // 65536, i // 256 % 256, i % 256),
+            'Datacenter': dc,
+            'TaggedAddresses': {'lan': '10.0.0.1', 'wan': '10.0.0.1'},
+            'Meta': {'consul-network-segment': ''},
+            'CreateIndex': 5,
+            'ModifyIndex': 7
+        },
+        'Service': {
+            'ID': '%s-%d' % (service, i),
+            'Service': service,
+            'Tags': ['class:%s' % ('pio' if i % 2 else 'web'),
+                     'instance_id:i-%08x' % i] +
+                    ['tag%d:value-%d' % (t, i % 7) for t in range(tags - 2)],
+            'Address': '',
+            'Port': 8000 + i % 1000,
+            'EnableTagOverride': False,
+            'CreateIndex': 6,
+            'ModifyIndex': 6
+        },
+        'Checks': [{
+            'Node': 'node-%d' % i,
+            'CheckID': 'service:%s-%d' % (service, i),
+            'Name': 'Service check',
+            'Status': 'passing',
+            'Notes': '',
+            'Output': 'HTTP GET http://127.0.0.1:%d/health: 200 OK' % (8000 + i % 1000),
+            'ServiceID': '%s-%d' % (service, i),
+            'ServiceName': service,
+            'CreateIndex': 6,
+            'ModifyIndex': 9
+        }]
+    } for i in range(count)]
+
+
+class FakeConsul(ThreadingHTTPServer):
+    '''Consul stand-in, prepared queries are kept in memory.
+
+       Tests configure it by its attributes: services overrides the
+       generated entries of a service (and the catalog), indexes are the
+       X-Consul-Index of services, codes are statuses of the next responses
+       (served with an error body), down datacenters answer 500 and
+       dc_latency delays the responses of a datacenter. Hooks are called
+       before the named endpoint (health, query.create, ...) is served,
+       leader is the address /v1/status/leader answers with. Requests
+       are logged as (method, path with the query) in requests.
+    '''
+    daemon_threads = True
+
+    # responses this long and longer are compressed
+    GZIP_MIN_SIZE = 1400
+
+    def __init__(self, address, instances=1000, tags=8, latency=0.0,
+                 filters=True, gzip=True, encoding='gzip'):
+        super(FakeConsul, self).__init__(address, Handler)
+        self.instances = instances
+        self.tags = tags
+        self.latency = latency
+        self.filters = filters
+        self.encoding = encoding if gzip else None
+        self.queries = {}
+        self.responses = {}
+        self.compressed = {}
+        self.services = {}
+        self.indexes = {}
+        self.codes = []
+        self.down = set()
+        self.dc_latency = {}
+        self.hooks = {}
+        self.requests = []
+        self.leader = '127.0.0.1:8300'
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    @property
+    def server(self):
+        return '{}:{}'.format(*self.server_address)
+
+    @property
+    def uri(self):
+        return 'http://{}'.format(self.server)
+
+    def index(self, service):
+        return self.indexes.get(service, 1)
+
+    def update(self, service, entries=None, index=None):
+        '''Change entries of the service (if given) and move its index,
+           blocking queries waiting for the service return
+        '''
+        with self.changed:
+            if entries is not None:
+                self.services[service] = entries
+            self.indexes[service] = index or self.index(service) + 1
+            self.changed.notify_all()
+
+    def wait(self, service, index, timeout):
+        '''Block until the service index differs from the given one
+        '''
+        with self.changed:
+            self.changed.wait_for(lambda: self.index(service) != index,
+                                  timeout=timeout)
+
+    def health(self, service, dc):
+        '''Serialized health entries, generated once per service and dc
+        '''
+        with self.lock:
+            if service in self.services:
+                return json.dumps(self.services[service]).encode('utf-8')
+
+            key = (service, dc)
+            if key not in self.responses:
+                self.responses[key] = json.dumps(
+                    instances(service, self.instances, self.tags, dc)
+                ).encode('utf-8')
+            return self.responses[key]
+
+    def catalog(self):
+        if self.services:
+            return {service: [] for service in self.services}
+        return {'bench': ['class:pio', 'class:web']}
+
+    def execute(self, service, dc):
+        '''Serialized prepared query result, generated once per service
+           and dc
+        '''
+        nodes = self.health(service, dc)
+        with self.lock:
+            key = ('query', service, dc)
+            if key not in self.responses or service in self.services:
+                self.responses[key] = b''.join((
+                    b'{"Service": ', json.dumps(service).encode('utf-8'),
+                    b', "Nodes": ', nodes,
+                    b', "DNS": {"TTL": ""}, "Datacenter": ',
+                    json.dumps(dc).encode('utf-8'), b', "Failovers": 0}'))
+            return self.responses[key]
+
+    def compress(self, body):
+        '''Compress body, bodies of the cached responses are compressed
+           once
+        '''
+        key = (self.encoding, body)
+        with self.lock:
+            if key in self.compressed:
+                return self.compressed[key]
+
+        if self.encoding == 'gzip':
+            compressed = gzip.compress(body, compresslevel=6)
+        elif self.encoding == 'deflate':
+            compressed = zlib.compress(body, 6)
+        else:
+            deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            compressed = deflate.compress(body) + deflate.flush()
+
+        if any(body is response for response in self.responses.values()):
+            with self.lock:
+                self.compressed[key] = compressed
+        return compressed
+
+    def start(self):
+        '''Serve in a background thread
+        '''
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,),
+                                  daemon=True)
+        thread.start()
+        return self
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body, index=1):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+
+        encoding = self.server.encoding
+        accepted = 'gzip' if encoding == 'gzip' else 'deflate'
+        compress = encoding and \
+            len(body) >= self.server.GZIP_MIN_SIZE and \
+            accepted in self.headers.get('Accept-Encoding', '')
+        if compress:
+            body = self.server.compress(body)
+
+        try:
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            if compress:
+                self.send_header('Content-Encoding', accepted)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Consul-Index', str(index))
+            self.send_header('X-Consul-Knownleader', 'true')
+            self.send_header('X-Consul-Lastcontact', '0')
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # client gave up (e.g. timed out)
+            self.close_connection = True
+
+    def hook(self, name):
+        hook = self.server.hooks.get(name)
+        if hook:
+            hook()
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        path = url.path.rstrip('/').split('/')[2:]
+        dc = params.get('dc', ['dc1'])[0]
+        server = self.server
+        server.requests.append((method, self.path))
+
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.codes:
+            return self.reply(server.codes.pop(0), b'injected error')
+
+        if dc in server.down:
+            return self.reply(500, b'No path to datacenter')
+
+        if path[:2] == ['health', 'service'] and len(path) == 3:
+            self.hook('health')
+            service = path[2]
+            time.sleep(server.dc_latency.get(dc, 0))
+            if 'index' in params:
+                server.wait(service, int(params['index'][0]),
+                            duration(params.get('wait', ['5m'])[0]))
+
+            index = server.index(service)
+            body = server.health(service, dc)
+            if server.filters and 'filter' in params:
+                try:
+                    where = Where(params['filter'][0])
+                except Where.Error as e:
+                    return self.reply(400, str(e).encode('utf-8'))
+                body = list(where.filter(json.loads(body)))
+            return self.reply(200, body, index)
+
+        if path == ['catalog', 'services']:
+            return self.reply(200, server.catalog())
+
+        if path[:2] == ['catalog', 'service'] and len(path) == 3:
+            nodes = [dict(entry['Node'], ServiceName=path[2])
+                     for entry in json.loads(server.health(path[2], dc))]
+            return self.reply(200, nodes)
+
+        if path == ['status', 'leader']:
+            return self.reply(200, server.leader)
+
+        if path == ['query'] and method == 'GET':
+            return self.reply(200, list(server.queries.values()))
+
+        if path == ['query'] and method == 'POST':
+            self.hook('query.create')
+            definition = json.loads(data or b'{}')
+            definition['ID'] = str(uuid.uuid4())
+            definition['Name'] = definition.get('Name') or definition.get('name')
+            with server.lock:
+                if any(query['Name'] == definition['Name']
+                       for query in server.queries.values()):
+                    return self.reply(500, "name '{}' aliases an existing "
+                                      "query name".format(
+                                          definition['Name']).encode('utf-8'))
+                server.queries[definition['ID']] = definition
+            return self.reply(200, {'ID': definition['ID']})
+
+        if path[:1] == ['query'] and len(path) == 3 and path[2] == 'execute':
+            self.hook('query.execute')
+            for query in list(server.queries.values()):
+                if path[1] in (query['ID'], query['Name']):
+                    service = query.get('service', query.get('Service', {}))
+                    service = service.get('service', service.get('Service'))
+                    return self.reply(200, server.execute(service, dc))
+            return self.reply(404, b'Query not found')
+
+        if path[:1] == ['query'] and len(path) == 2 and method == 'DELETE':
+            server.queries.pop(path[1], None)
+            return self.reply(200, b'')
+
+        return self.reply(404, b'')
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+
+def duration(value):
+    '''Seconds of a Consul duration such as 10s, 5m or 100ms
+    '''
+    for suffix, scale in (('ms', 0.001), ('s', 1), ('m', 60), ('h', 3600)):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * scale
+    return float(value)
+
+
+def main():
+    args = docopt(__doc__)
+    server = FakeConsul(('127.0.0.1', int(args['--port'])),
+                        instances=int(args['--instances']),
+                        tags=int(args['--tags']),
+                        latency=float(args['--latency']) / 1000,
+                        filters=not args['--no-filters'],
+                        gzip=not args['--no-gzip'],
+                        encoding=args['--encoding'])
+    print('fake consul listening on {}'.format(server.server))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Benchmark template rendering over synthetic health entries
+
+Usage:
+  render.py [--entries=number] [--repeat=number]
+
+Options:
+  --entries=number      number of service instances [default: 5000]
+  --repeat=number       number of timed runs, the best one is reported [default: 5]
+"""
+import timeit
+
+from docopt import docopt
+from counsel.results import JinjaRender
+
+
+TEMPLATES = (
+    '{{Node.Address}}',
+    '{{ Node.Address, Service.Port }}',
+)
+
+
+def entries(count):
+    return [{
+        'Node': {'Node': 'node-%d' % i, 'Address': '10.0.%d.%d' % (i // 256, i % 256)},
+        'Service': {'Service': 'bench', 'Port': 8000 + i % 100,
+                    'Tags': ['class:pio', 'instance_id:i-%08x' % i]},
+        'Checks': [{'Status': 'passing', 'Output': 'HTTP GET: 200 OK'}]
+    } for i in range(count)]
+
+
+def main():
+    args = docopt(__doc__)
+    data = entries(int(args['--entries']))
+    repeat = int(args['--repeat'])
+
+    for template in TEMPLATES:
+        renders = (
+            ('jinja', JinjaRender(template)),
+            ('fast', JinjaRender.create(template))
+        )
+        timings = {}
+        for name, render in renders:
+            timings[name] = min(timeit.repeat(lambda: render.render(data),
+                                              number=1, repeat=repeat))
+
+        print('{:<36} jinja {:8.4f}s  fast {:8.4f}s  speedup x{:.1f}'.format(
+            template, timings['jinja'], timings['fast'],
+            timings['jinja'] / timings['fast']))
+
+
+if __name__ == '__main__':
+    main()
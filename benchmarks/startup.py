@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Benchmark counsel CLI start up time
+
+Runs the CLI in fresh interpreters and reports the best and median wall
+time per command. With --max-ms it exits with status 1 when the median of
+any command exceeds the limit, so it can guard against regressions.
+
+Usage:
+  startup.py [--server=server] [--service=service] [--repeat=number] [--max-ms=ms]
+
+Options:
+  --server=server       Consul server to run health queries against (skipped if not given)
+  --service=service     service to query [default: consul]
+  --repeat=number       number of runs per command [default: 10]
+  --max-ms=ms           fail if a median start up time exceeds ms
+"""
+import sys
+import time
+import statistics
+import subprocess
+
+from docopt import docopt
+
+
+def measure(argv, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable] + argv, check=True,
+                       stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings), statistics.median(timings)
+
+
+def main():
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+    cli = ['-m', 'counsel.cli.main']
+
+    commands = [
+        ('python', ['-c', 'pass']),
+        ('import counsel.cli.main', ['-c', 'import counsel.cli.main']),
+        ('counsel --version', cli + ['--version']),
+    ]
+    if args['--server']:
+        health = cli + ['-s', args['--server'], 'health', '-s', args['--service']]
+        commands += [
+            ('counsel health', health),
+            ('counsel health -f', health + ['-f', '{{Node.Address}}']),
+        ]
+
+    failed = False
+    for name, argv in commands:
+        best, median = measure(argv, repeat)
+        print('{:<24} best {:7.1f}ms  median {:7.1f}ms'.format(name, best, median))
+        if args['--max-ms'] and median > float(args['--max-ms']):
+            failed = True
+
+    # heavy modules must not be imported before they are needed
+    check = ('import sys, counsel.cli.main; '
+             'print(sorted(m for m in ("jinja2", "consul", "requests") '
+             'if m in sys.modules))')
+    loaded = subprocess.check_output([sys.executable, '-c', check])
+    print('modules loaded on import: {}'.format(loaded.decode().strip()))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Benchmark counsel against a local fake Consul server
+
+For every response size measures the end-to-end CLI latency, the cost of
+each phase of display_health_service and display_query_service (HTTP,
+JSON decode, Jinja render, format) and their peak memory. The raw data
+is also serialized in every data output format, by each of the installed
+JSON encoders. Results are written as JSON, a summary is printed to
+stderr.
+
+Usage:
+  suite.py [--sizes=sizes] [--tags=number] [--latency=ms] [--repeat=number]
+           [--filter=template] [--format=format] [--output=path]
+
+Options:
+  --sizes=sizes         comma separated numbers of service instances [default: 10,1000,10000]
+  --tags=number         number of tags of every instance [default: 8]
+  --latency=ms          latency injected into every fake Consul response [default: 0]
+  --repeat=number       number of runs per measurement [default: 5]
+  --filter=template     jinja template used by the render phase and the CLI [default: {{ Node.Address }}]
+  --format=format       output format used by the format phase and the CLI [default: oneline]
+  --output=path         write results to the file instead of stdout
+"""
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+import tracemalloc
+
+from docopt import docopt
+
+import counsel
+from counsel import Counsel
+from counsel.results import Formatter
+from counsel.helpers import docopt_strtolist
+
+from fakeconsul import FakeConsul
+
+
+SERVICE = 'bench'
+
+
+def timings(func, repeat):
+    '''Returns (best, median) wall time of func in milliseconds
+    '''
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        runs.append((time.perf_counter() - started) * 1000)
+    return min(runs), statistics.median(runs)
+
+
+def peak_memory(func):
+    '''Returns peak of memory allocated by func in bytes
+    '''
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class Suite(object):
+    def __init__(self, server, size, args):
+        self.server = server
+        self.size = size
+        self.repeat = int(args['repeat'])
+        self.filter = args['filter']
+        self.format = args['format']
+        self.app = Counsel(server=server)
+        self.results = []
+
+    def record(self, name, **values):
+        self.results.append(dict(name=name, instances=self.size, **values))
+        sys.stderr.write('{:>8} {:<28} {}\n'.format(self.size, name, ' '.join(
+            '{}={:.1f}'.format(k, v) if isinstance(v, float) else
+            '{}={}'.format(k, v) for k, v in values.items())))
+
+    def timed(self, name, func):
+        best, median = timings(func, self.repeat)
+        self.record(name, best_ms=best, median_ms=median)
+
+    def phases(self, command, path):
+        '''Time every phase of a command separately
+        '''
+        http = self.app.agent.http
+        uri = http.uri(path)
+
+        response = http.send('GET', uri)
+        data = json.loads(response.body)
+        if command == 'query':
+            data = data['Nodes']
+        rendered = Counsel.jinja_filter(self.filter, data)
+
+        with open(os.devnull, 'w') as devnull:
+            formatter = Formatter(self.format, out=devnull)
+            phases = (
+                ('http', lambda: http.send('GET', uri)),
+                ('decode', lambda: json.loads(response.body)),
+                ('render', lambda: Counsel.jinja_filter(self.filter, data)),
+                ('format', lambda: formatter.write(rendered)),
+            )
+            for phase, func in phases:
+                self.timed('{}.{}'.format(command, phase), func)
+
+            for name, func in self.serializers(data, devnull):
+                self.timed('{}.format-{}'.format(command, name), func)
+
+    @staticmethod
+    def serializers(data, out):
+        '''Yields (name, func) serializing data in the data formats, compact
+           JSON by each of the installed encoders
+        '''
+        encoder = Formatter.ENCODER
+        for name in ('json', 'ndjson', 'json-compact', 'msgpack'):
+            if not Formatter.FACTORY[name].available():
+                continue
+            if name != 'json-compact':
+                yield name, lambda name=name: Formatter(name, out=out).write(data)
+                continue
+
+            for backend in ('json', 'orjson'):
+                def serialize(backend=backend):
+                    Formatter.ENCODER = backend
+                    try:
+                        Formatter(name, out=out).write(data)
+                    finally:
+                        Formatter.ENCODER = encoder
+                try:
+                    getattr(Formatter.Encoders, backend)([])
+                except ImportError:
+                    continue
+                yield '{}.{}'.format(name, backend), serialize
+
+    def display(self, command, display):
+        '''Time and measure peak memory of the whole display call
+        '''
+        with open(os.devnull, 'w') as devnull:
+            run = lambda: display(SERVICE, filter=self.filter,
+                                  format=self.format, out=devnull)
+            self.timed('{}.display'.format(command), run)
+            self.record('{}.peak_memory'.format(command),
+                        bytes=peak_memory(run))
+
+    def cli(self, command):
+        '''Time the CLI invocations in fresh interpreters
+        '''
+        argv = [sys.executable, '-m', 'counsel.cli.main', '-s', self.server,
+                '--no-daemon', command, '-s', SERVICE, '-f', self.filter,
+                '--format={}'.format(self.format)]
+        run = lambda: subprocess.run(argv, check=True,
+                                     stdout=subprocess.DEVNULL)
+        self.timed('{}.cli'.format(command), run)
+
+    def run(self):
+        # query is executed once, so that its creation isn't measured
+        self.app.query_service(SERVICE)
+        query = Counsel.Query()
+        query.options(SERVICE)
+
+        self.phases('health', '/v1/health/service/{}'.format(SERVICE))
+        self.phases('query', '/v1/query/{}/execute'.format(query.uniqname))
+        self.display('health', self.app.display_health_service)
+        self.display('query', self.app.display_query_service)
+        self.cli('health')
+        self.cli('query')
+        return self.results
+
+
+def main():
+    args = docopt(__doc__)
+    args = docopt_strtolist({k.lstrip('-'): v for k, v in args.items()},
+                            'sizes')
+
+    results = []
+    for size in map(int, args['sizes']):
+        fake = FakeConsul(('127.0.0.1', 0), instances=size,
+                          tags=int(args['tags']),
+                          latency=float(args['latency']) / 1000).start()
+        try:
+            results += Suite(fake.server, size, args).run()
+        finally:
+            fake.shutdown()
+            fake.server_close()
+
+    report = {
+        'counsel': counsel.__version__,
+        'python': platform.python_version(),
+        'time': int(time.time()),
+        'options': {k: args[k] for k in ('tags', 'latency', 'repeat',
+                                         'filter', 'format')},
+        'results': results
+    }
+
+    if args['output']:
+        with open(args['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,16 @@
 __version__ = '0.1.0'
 
-from counsel.counsel import Counsel
+
+def __getattr__(name):
+    '''Counsel (and so consul, requests) is imported on the first use,
+       which keeps the CLI start up fast.
+    '''
+    if name == 'Counsel':
+        from counsel.counsel import Counsel
+        return Counsel
+
+    if name == 'AsyncCounsel':
+        from counsel.aio import AsyncCounsel
+        return AsyncCounsel
+
+    raise AttributeError("module 'counsel' has no attribute {!r}".format(name))
@@ -0,0 +1,266 @@
+import asyncio
+
+import consul.base
+
+from counsel.log import log
+from counsel.counsel import Counsel
+from counsel.registry import QueryRegistry
+from counsel.helpers import http_urlparse, dict_compact
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class HTTPClient(consul.base.HTTPClient):
+    '''Asyncio consul HTTP client on top of a pooled aiohttp connector.
+       API methods return coroutines, so consul.base endpoints are awaited
+       e.g. await api.health.service('consul').
+
+       The session is created on the first request, i.e. in the event loop
+       running the client.
+    '''
+
+    def __init__(self, *args, timeout=None, pool_size=100, **kwargs):
+        super(HTTPClient, self).__init__(*args, **kwargs)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                                             ssl=None if self.verify else False)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def request(self, method, callback, path, params=None, data=None):
+        uri = self.uri(path, params)
+        async with self.session.request(method, uri, data=data) as response:
+            body = await response.text(encoding='utf-8')
+            return callback(consul.base.Response(response.status,
+                                                 response.headers, body))
+
+    def get(self, callback, path, params=None):
+        return self.request('GET', callback, path, params)
+
+    def put(self, callback, path, params=None, data=''):
+        return self.request('PUT', callback, path, params, data)
+
+    def delete(self, callback, path, params=None):
+        return self.request('DELETE', callback, path, params)
+
+    def post(self, callback, path, params=None, data=''):
+        return self.request('POST', callback, path, params, data)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class Consul(consul.base.Consul):
+    '''Asyncio consul API client using counsel aio HTTPClient
+    '''
+
+    def __init__(self, *args, timeout=None, pool_size=100, **kwargs):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        super(Consul, self).__init__(*args, **kwargs)
+
+    def connect(self, host, port, scheme, verify=True, cert=None):
+        return HTTPClient(host, port, scheme, verify, cert,
+                          timeout=self.timeout, pool_size=self.pool_size)
+
+
+class AsyncCounsel(object):
+    '''Asyncio counterpart of the Counsel app. Lookups are coroutines sharing
+       one pooled connection, so many of them run concurrently in a single
+       event loop. Errors are raised as Counsel.Error subclasses, the same
+       way as by Counsel.
+
+       Requires aiohttp, use as an async context manager or close() it:
+
+           async with AsyncCounsel('consul.local') as app:
+               nodes = await app.health_service('consul')
+    '''
+
+    def __init__(
+            self,
+            server='http://127.0.0.1:8500',
+            dc=None,
+            token=None,
+            consistency='default',
+            verify=True,
+            timeout=None,
+            pool_size=100):
+        if aiohttp is None:
+            raise RuntimeError('AsyncCounsel requires aiohttp, '
+                               'install counsel[aio]')
+
+        url = http_urlparse(server)
+        self.agent = Consul(
+            host=url.hostname,
+            port=url.port or 8500,
+            dc=dc,
+            token=token,
+            scheme=url.scheme,
+            consistency=consistency,
+            verify=verify,
+            timeout=timeout,
+            pool_size=pool_size)
+        self._tasks = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        '''Wait for background tasks and close the connections
+        '''
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.agent.http.close()
+
+    @staticmethod
+    async def _call(awaitable):
+        '''Await API call raising its errors as Counsel.Error
+        '''
+        try:
+            return await awaitable
+
+        except consul.base.NotFound as e:
+            raise Counsel.NotFound(str(e)) from e
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise Counsel.Unreachable(str(e) or type(e).__name__) from e
+
+        except consul.base.ConsulException as e:
+            raise Counsel.APIError(str(e)) from e
+
+    @property
+    def registry(self):
+        return QueryRegistry.open(self.agent.http.base_uri)
+
+    async def _registry(self, method, *args):
+        '''Call registry method in the default executor, the registry is
+           saved on every change and file I/O would block the event loop
+        '''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, getattr(self.registry, method), *args)
+
+    async def health_service(self, service, onlypassing=None, tag=None,
+                             dc=None):
+        '''Query service health
+
+           /v1/health/service/<service>
+        '''
+        _, result = await self._call(self.agent.health.service(
+            service, **dict_compact(dict(passing=onlypassing, tag=tag, dc=dc))))
+        return result
+
+    async def query_service(self, service, tags=None, dc=None,
+                            datacenters=None, onlypassing=None, limit=None):
+        '''Execute counsel prepared query for the service, the query is
+           created and registered when it doesn't exist yet. Prepared
+           queries are shared with the synchronous Counsel app.
+        '''
+        query = Counsel.Query()
+        query.options(service,
+                      tags=tags,
+                      datacenters=datacenters,
+                      onlypassing=onlypassing)
+        uniqname = query.uniqname
+
+        try:
+            result = await self._execute(uniqname, dc=dc, limit=limit)
+            await self._registry('add', uniqname)
+
+        except Counsel.NotFound:
+            log.info('query %s not found, creating', uniqname)
+            await self._registry('remove', uniqname)
+            try:
+                created = await self._call(self.agent.query.create(
+                    name=uniqname, **query._options))
+            except Counsel.APIError as e:
+                # another caller may have created it meanwhile (names are
+                # unique), then it's executed and registered by name
+                log.info('query %s not created, executing: %s', uniqname, e)
+                try:
+                    result = await self._execute(uniqname, dc=dc, limit=limit)
+                except Counsel.NotFound:
+                    raise e
+                await self._registry('add', uniqname)
+            else:
+                await self._registry('add', uniqname, created['ID'])
+                result = await self._execute(uniqname, dc=dc, limit=limit)
+
+        # prepared queries are kept for reuse, stale ones are trimmed
+        self.gc()
+        return result
+
+    async def _execute(self, name, dc=None, limit=None):
+        '''Execute query raising NotFound when it doesn't exist
+        '''
+        params = dict_compact({
+            'token': self.agent.token,
+            'dc': dc,
+            'limit': limit
+        })
+        return await self._call(self.agent.http.get(
+            consul.base.CB.json(allow_404=False),
+            '/v1/query/{}/execute'.format(name), params=list(params.items())))
+
+    async def health_services(self, services, **kwargs):
+        '''Query health of many services concurrently, keyed by service
+        '''
+        return await self._gather(self.health_service, services, **kwargs)
+
+    async def query_services(self, services, **kwargs):
+        '''Execute queries for many services concurrently, keyed by service
+        '''
+        return await self._gather(self.query_service, services, **kwargs)
+
+    @staticmethod
+    async def _gather(method, services, **kwargs):
+        services = list(dict.fromkeys(services))
+        results = await asyncio.gather(*(method(s, **kwargs)
+                                         for s in services))
+        return dict(zip(services, results))
+
+    def gc(self):
+        '''Trim stale counsel prepared queries in a background task, the
+           registry gc runs in the default executor and calls the API in
+           the event loop
+        '''
+        if not self.registry.claim_gc():
+            return None
+
+        loop = asyncio.get_event_loop()
+
+        def call(awaitable):
+            return asyncio.run_coroutine_threadsafe(
+                self._call(awaitable), loop).result()
+
+        def delete(query_id):
+            call(self.agent.query.delete(query_id))
+
+        def resolve():
+            return {
+                _query['Name']: _query['ID']
+                for _query in call(self.agent.query.list())
+                if _query['Name'].startswith('counsel-')
+            }
+
+        task = loop.run_in_executor(None, self.registry.gc, delete, resolve,
+                                    Counsel.Error)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
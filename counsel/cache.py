@@ -0,0 +1,180 @@
+import os
+import gzip
+import json
+import time
+import zlib
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlsplit
+
+import consul.base
+
+from counsel.log import log
+from counsel.timings import Timings
+from counsel.helpers import cache_path
+
+
+class ResponseCache(object):
+    '''On-disk cache of consul API responses.
+
+       Responses are keyed by the request uri (endpoint and params) and stored
+       along with their X-Consul-* headers and the time they were fetched.
+       Entries younger than max_age seconds are served instead of calling the
+       API, older ones are only served when the agent is unreachable. Entries
+       are stored gzip compressed. Lookups are counted (see stats) and
+       reported as cache timings events.
+
+       Every prune_interval seconds the least recently written entries
+       beyond max_entries or max_size bytes are removed.
+    '''
+
+    COMPRESSLEVEL = 1
+    MAX_ENTRIES = 4096
+    MAX_SIZE = 256 * 1024 * 1024
+    PRUNE_INTERVAL = 3600
+
+    # counter of the lookup results reported by timings events
+    RESULTS = {'hits': 'hit', 'misses': 'miss', 'stale': 'stale'}
+
+    def __init__(self, max_age, path=None, max_entries=MAX_ENTRIES,
+                 max_size=MAX_SIZE, prune_interval=PRUNE_INTERVAL):
+        self.max_age = max_age
+        self.path = path or cache_path('responses')
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.prune_interval = prune_interval
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale}
+
+    def _count(self, counter, uri, started=None):
+        '''Count lookup result and emit its timings event
+        '''
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+        if Timings.enabled():
+            result = self.RESULTS[counter]
+            Timings.record('cache', '{} {}'.format(result, urlsplit(uri).path),
+                           time.perf_counter() - started if started else 0.0,
+                           result=result)
+
+    def _file(self, uri):
+        return os.path.join(self.path,
+                            hashlib.sha256(uri.encode('utf-8')).hexdigest())
+
+    def get(self, uri):
+        '''Returns (age, response) of the cached entry or None
+        '''
+        try:
+            with open(self._file(uri), 'rb') as f:
+                data = f.read()
+            # entries cached by previous versions aren't compressed
+            if data[:2] == b'\x1f\x8b':
+                with Timings.span('decompress', 'cache', size=len(data)):
+                    data = gzip.decompress(data)
+            entry = json.loads(data.decode('utf-8'))
+        except (IOError, OSError, ValueError, EOFError, zlib.error):
+            return None
+
+        response = consul.base.Response(entry['code'], entry['headers'],
+                                        entry['body'])
+        return time.time() - entry['time'], response
+
+    def put(self, uri, response):
+        entry = {
+            'time': time.time(),
+            'code': response.code,
+            'headers': {
+                k: v for k, v in response.headers.items()
+                if k.lower().startswith('x-consul-')
+            },
+            'body': response.body
+        }
+
+        # entries may contain tokens protected data, mkstemp creates them 0600
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.response')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(gzip.compress(json.dumps(entry).encode('utf-8'),
+                                      compresslevel=self.COMPRESSLEVEL))
+            os.replace(tmp, self._file(uri))
+        except (IOError, OSError) as e:
+            log.warning('cannot cache response: %s', e)
+            return
+
+        if self.prune_due():
+            self.prune()
+
+    def _stamp(self):
+        return os.path.join(self.path, '.pruned')
+
+    def prune_due(self):
+        try:
+            return time.time() - os.path.getmtime(self._stamp()) > \
+                self.prune_interval
+        except OSError:
+            return True
+
+    def prune(self):
+        '''Remove the least recently written entries beyond max_entries or
+           max_size bytes
+        '''
+        try:
+            with open(self._stamp(), 'a'):
+                pass
+            os.utime(self._stamp())
+            files = list(os.scandir(self.path))
+        except OSError as e:
+            log.warning('cannot prune response cache: %s', e)
+            return
+
+        entries = []
+        for entry in files:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = 0
+        for pos, (_, size, path) in enumerate(sorted(entries, reverse=True)):
+            total += size
+            if pos >= self.max_entries or total > self.max_size:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def lookup(self, uri):
+        '''Returns (fresh, cached) where fresh is the response younger than
+           max_age and cached is any response available for uri.
+        '''
+        started = time.perf_counter()
+        cached = self.get(uri)
+        if cached and cached[0] <= self.max_age:
+            self._count('hits', uri, started)
+            return cached[1], cached[1]
+
+        self._count('misses', uri, started)
+        return None, cached and cached[1]
+
+    def fallback(self, uri, cached, error):
+        '''Returns stale response when the API is unavailable
+        '''
+        if cached is None:
+            return None
+
+        self._count('stale', uri)
+        log.warning('%s, serving stale response for %s', error,
+                    uri.split('?', 1)[0])
+        return cached
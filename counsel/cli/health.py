@@ -4,30 +4,66 @@
 """Query Consul service health
 
 Usage:
-  counsel health [(-h|--help)] (-s service|--service=service)
+  counsel health [(-h|--help)] ((-s service)... | --services-file=path)
                                [-t tag|--tag=tag]
-                               [-f filter|--filter=filter [--oneline|--multiline]]
+                               [(-f filter)...] [--oneline|--multiline|--ndjson|--format=format]
                                [--onlypassing]
+                               [--where=expression]
+                               [(--tag-filter=key=value)...]
+                               [--from-snapshot [--snapshot=path]]
+                               [--dcs=dc1,dc2 [--dc-timeout=seconds]]
+                               [--workers=number]
+                               [--jobs=number]
+                               [--stream]
 
 Options:
   -s service --service=service      query Consul for the given service [required]
+                                    repeat to query several services concurrently
+  --services-file=path              file with a service per line (- for stdin)
   -t tag --tags=tag                 tag to filter query results
-  -f filter --filter=filter         jinja template to format the result
+  -f filter --filter=filter         jinja template to format the result, repeat to render
+                                    several templates into rows (columns)
   --oneline                         output results as oneline [requires: --filter]
   --multiline                       output results split into many lines [requires: --filter]
+  --ndjson                          output newline delimited JSON, an entry per line
+  --format=format                   output format json|json-compact|ndjson|msgpack|oneline|
+                                    multiline|tsv|csv
   --onlypassing                     specify to filter query results only with healthy checks
+  --where=expression                only output entries matching the Consul filter expression
+                                    (e.g. 'Service.Tags contains "class:pio"')
+  --tag-filter=key=value            only output entries having the key:value tag (or the key
+                                    with any value), repeat to require several tags
+  --from-snapshot                   answer from the snapshot (see counsel snapshot) without
+                                    calling Consul
+  --snapshot=path                   snapshot file (default: per server and datacenter)
+  --dcs=dc1,dc2                     query all of the datacenters concurrently and merge results
+  --dc-timeout=seconds              per datacenter request timeout [default: 10]
+  --workers=number                  number of concurrent requests for several services [default: 8]
+  --jobs=number                     render a huge service by number of worker processes
+                                    (0 for the number of CPUs)
+  --stream                          decode the response incrementally, bounds memory use for
+                                    huge services (used with --filter for query)
   -h --help                         show this help message and exit
 
 Examples:
   counsel health -s service
   counsel health -s service --tag=eu-central-1
   counsel health -s service -f '{{ Node.Address }}'
+  counsel health -s service -f '{{ Node.Node }}' -f '{{ Node.Address }}' --format=tsv
+  counsel health -s service1 -s service2 -s service3
+  counsel health -s service --dcs=dc1,dc2 -f '{{ Datacenter }} {{ Node.Address }}'
+  counsel health -s service --where='Service.Tags contains "class:pio"'
+  counsel health -s service --from-snapshot
+  counsel health -s service --tag-filter=class=pio -f '{{ TagMap.instance_id }}'
 
 """
 from docopt import docopt
-from counsel.helpers import docopt_lstrip
+from counsel.helpers import docopt_filters, docopt_lstrip, \
+    docopt_services, docopt_strtolist
 
 
 def cli(argv):
-    parsed = docopt_lstrip(docopt(__doc__, argv=argv))
-    return parsed
+    parsed = docopt_strtolist(docopt_lstrip(docopt(__doc__, argv=argv)), 'dcs')
+    parsed = docopt_filters(parsed)
+    parsed['dc_timeout'] = float(parsed.pop('dc-timeout'))
+    return docopt_services(parsed)
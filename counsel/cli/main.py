@@ -9,6 +9,11 @@ Usage:
                                   [--dc=dc]
                                   [--token=token]
                                   [--consistency=mode]
+                                  [--timeout=seconds]
+                                  [--cache-max-age=seconds]
+                                  [--hedge=percentile]
+                                  [--no-daemon]
+                                  [--timings [--timings-format=format]]
                                   <command> [<args>...]
 
 Commands:
@@ -18,30 +23,65 @@ Commands:
   health -s service [<options>]
     Query service health
 
+  watch -s service [<options>]
+    Watch service health and output changes
+
+  serve [<options>]
+    Run daemon serving query and health commands over a unix socket
+
+  snapshot [<options>]
+    Snapshot services health into a local file used by --from-snapshot
+
 Options:
   -s server --server=server   specify Consul server host to connect [default: http://127.0.0.1:8500]
-                              also allows host:port and host specification
+                              also allows host:port and host specification, several comma
+                              separated servers are used by latency and availability
   --dc=dc                     default datacenter used for queries (default: is agent's dc)
   --token=uuid                default ACL token used for queries
   --consistency=mode          consitency mode (default|consistent|stale) [default: default]
+  --timeout=seconds           HTTP request timeout (default: no timeout)
+  --cache-max-age=seconds     serve responses cached locally for up to seconds,
+                              stale responses are used if Consul is unavailable
+  --hedge=percentile          with several servers, duplicate reads to the next server
+                              once they take longer than the latency percentile (e.g. 95)
   --verify                    specifify to verify the SSL certificate for HTTPS requests
                               [default: False]
+  --no-daemon                 run the command even if a counsel daemon is running
+  --timings                   report time spent in API calls, HTTP requests, decoding,
+                              rendering and output formatting on stderr
+  --timings-format=format     timings report format (summary|json) [default: summary]
   -q --quiet                  quiet mode suppresses error output
   -h --help                   show this help message and exit
   --version                   show version and exit
 """
+import os
+import sys
 import importlib
 import logging
 
 from docopt import docopt
 import counsel
 
-from counsel.log import console
+import counsel.results as results
+from counsel.log import log, console, attach_console
 from counsel.helpers import docopt_lstrip, dict_compact
 
 
-COMMANDS = ('query', 'health')
-app = counsel.Counsel()
+COMMANDS = ('query', 'health', 'watch', 'serve', 'snapshot')
+# commands the daemon serves, watch is long running and is run locally
+DAEMON_COMMANDS = ('query', 'health')
+_app = None
+_daemon_options = None
+
+
+def get_app():
+    '''Counsel app is created on the first use, which defers importing
+       consul and requests until they are actually needed.
+    '''
+    global _app
+    if _app is None:
+        _app = counsel.Counsel()
+    return _app
 
 
 def set_output_format(kwargs):
@@ -49,49 +89,229 @@ def set_output_format(kwargs):
         kwargs['format'] = 'oneline'
     if kwargs.pop('multiline', False):
         kwargs['format'] = 'multiline'
+    if kwargs.pop('ndjson', False):
+        kwargs['format'] = 'ndjson'
+
+    output_format = kwargs.get('format', 'json')
+    if output_format not in results.Formatter.FACTORY:
+        log.error('unknown output format: %s', output_format)
+        sys.exit(1)
 
-def query_service(**kwargs):
+    if not results.Formatter.FACTORY[output_format].available():
+        log.error('%s output format requires the %s package', output_format,
+                  output_format)
+        sys.exit(1)
+
+def set_where(kwargs):
+    '''Parse where expression and tag filters upfront, so that errors are
+       reported early
+    '''
+    tags = kwargs.pop('tag-filter', None)
+    if kwargs.get('where') or tags:
+        from counsel.where import Where
+        try:
+            kwargs['where'] = Where.create(kwargs.get('where'), tags)
+        except Where.Error as e:
+            log.error('%s', e)
+            sys.exit(1)
+
+def set_snapshot(kwargs):
+    '''Snapshot is given by its path, True stands for the default one
+    '''
+    path = kwargs.pop('snapshot', None)
+    if kwargs.pop('from-snapshot', False):
+        kwargs['snapshot'] = path or True
+
+def query_service(out=None, **kwargs):
     '''Invoke counsel query_service
     '''
     opts = dict_compact(kwargs, unwanted=('help', 'query'))
     set_output_format(opts)
-    app.display_query_service(**opts)
+    set_where(opts)
+    set_snapshot(opts)
+    get_app().display_query_service(out=out, **opts)
 
-def health_service(**kwargs):
+def health_service(out=None, **kwargs):
     opts = dict_compact(kwargs, unwanted=('help', 'health'))
     set_output_format(opts)
-    app.display_health_service(**opts)
+    set_where(opts)
+    set_snapshot(opts)
+    get_app().display_health_service(out=out, **opts)
+
+def watch_service(out=None, **kwargs):
+    opts = dict_compact(kwargs, unwanted=('help', 'watch'))
+    set_output_format(opts)
+    try:
+        get_app().display_watch_service(out=out, **opts)
+    except KeyboardInterrupt:
+        pass
+
+def snapshot(out=None, **kwargs):
+    '''Pull services health into the snapshot, outputs its stats
+    '''
+    stats = get_app().snapshot(services=kwargs.get('services'),
+                               path=kwargs.get('snapshot'),
+                               refresh=kwargs.get('refresh'),
+                               workers=kwargs.get('workers'))
+    results.Formatter(output_format='json', out=out).write(stats)
 
+def serve(**kwargs):
+    '''Run the daemon serving commands with the app kept warm
+    '''
+    from counsel import daemon
+    try:
+        daemon.serve(serve_request, kwargs.get('socket'))
+    except (OSError, RuntimeError) as e:
+        log.error('cannot start daemon: %s', e)
+        sys.exit(1)
 
-def main():
-    parsed = docopt(__doc__, version=counsel.__version__, options_first=True)
+
+def parse(argv=None):
+    '''Returns sub-command, its args and the global options
+    '''
+    parsed = docopt(__doc__, argv=argv, version=counsel.__version__,
+                    options_first=True)
     parsed = docopt_lstrip(parsed)
 
     # sub command and its args
     command = parsed.pop('<command>')
     args = [command] + parsed.pop('<args>')
 
-    # set consul default options
-    if parsed.pop('quiet'):
-        console.setLevel(logging.FATAL+1)
-
     parsed = dict_compact(parsed, unwanted=('help', 'version'))
-    app.connect_options(**parsed)
+    for option in ('timeout', 'cache-max-age', 'hedge'):
+        if option in parsed:
+            parsed[option.replace('-', '_')] = float(parsed.pop(option))
 
-    # override agent DC if given
-    dc = parsed.get('dc', None)
+    return command, args, parsed
+
+
+def dispatch(command, args, dc=None, out=None):
+    '''Run sub-command using the connected app
+    '''
+    if command not in COMMANDS:
+        return
 
-    # sub-command
-    if command in COMMANDS:
-        res = importlib.import_module('counsel.cli.{}'.format(command))
-        parsed = getattr(res, 'cli')(args)
+    res = importlib.import_module('counsel.cli.{}'.format(command))
+    parsed = getattr(res, 'cli')(args)
 
+    try:
         if command == 'query':
-            query_service(dc=dc, **parsed)
+            query_service(dc=dc, out=out, **parsed)
 
         if command == 'health':
-            health_service(dc=dc, **parsed)
+            health_service(dc=dc, out=out, **parsed)
 
+        if command == 'watch':
+            watch_service(dc=dc, out=out, **parsed)
+
+        if command == 'serve':
+            serve(**parsed)
+
+        if command == 'snapshot':
+            snapshot(out=out, **parsed)
+
+    except counsel.Counsel.Error as e:
+        log.error('%s', e)
+        sys.exit(1)
+
+
+def serve_request(argv, out):
+    '''Serve command sent to the daemon, returns its exit status or None
+       if the client has to run it (e.g. it uses other connect options).
+    '''
+    if '-h' in argv or '--help' in argv:
+        return None
+
+    try:
+        command, args, options = parse(argv)
+    except SystemExit:
+        return None
+
+    for option in ('quiet', 'no-daemon', 'timings-format'):
+        options.pop(option, None)
+
+    # timings are measured by the client
+    if options.pop('timings', False):
+        return None
+
+    if command not in DAEMON_COMMANDS or options != _daemon_options:
+        return None
+
+    # the daemon has its own cwd and stdin, relative paths and - are
+    # resolved by the client (parsed without reading the services file)
+    res = importlib.import_module('counsel.cli.{}'.format(command))
+    try:
+        parsed = docopt_lstrip(docopt(res.__doc__, argv=args))
+    except SystemExit:
+        return None
+    for option in ('services-file', 'snapshot'):
+        path = parsed.get(option)
+        if path and not os.path.isabs(path):
+            return None
+
+    # binary output can't be sent back by the daemon
+    binary = [name for name, formatter in results.Formatter.FACTORY.items()
+              if formatter.binary]
+    if any(arg.split('=')[-1] in binary for arg in args):
+        return None
+
+    try:
+        dispatch(command, args, dc=options.get('dc'), out=out)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        log.error('%s', e.code)
+        return 1
+    except Exception as e:
+        log.error('%s', e)
+        return 1
+
+    return 0
+
+
+def main(argv=None):
+    global _daemon_options
+
+    argv = sys.argv[1:] if argv is None else argv
+    command, args, options = parse(argv)
+    attach_console()
+
+    quiet = options.pop('quiet', False)
+    no_daemon = options.pop('no-daemon', False)
+    timings = options.pop('timings', False)
+    timings_format = options.pop('timings-format', 'summary')
+    if quiet:
+        console.setLevel(logging.FATAL+1)
+
+    if timings_format not in ('summary', 'json'):
+        log.error('unknown timings format: %s', timings_format)
+        sys.exit(1)
+
+    # let the running daemon serve the command
+    if command in DAEMON_COMMANDS and not (no_daemon or timings):
+        from counsel import daemon
+        status = daemon.request(argv, sys.stdout,
+                                None if quiet else sys.stderr)
+        if status is not None:
+            sys.exit(status)
+
+    # set consul default options
+    get_app().connect_options(**options)
+    _daemon_options = options
+
+    collector = None
+    if timings:
+        from counsel.timings import Timings, Collector
+        collector = Collector()
+        Timings.add_hook(collector)
+
+    # override agent DC if given
+    try:
+        dispatch(command, args, dc=options.get('dc'))
+    finally:
+        if collector:
+            Timings.remove_hook(collector)
+            collector.write(sys.stderr, timings_format)
 
 
 if __name__ == '__main__':
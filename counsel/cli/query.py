@@ -5,22 +5,47 @@
    Performs complex consul query providing Node, Service and Checks aggregated information
 
 Usage:
-  counsel query [(-h|--help)] (-s service|--service=service)
+  counsel query [(-h|--help)] ((-s service)... | --services-file=path)
                               [--limit=number]
                               [--tags=tag1,tag2]
                               [--datacenters=dc1,dc2]
-                              [-f filter|--filter=filter [--oneline|--multiline]]
+                              [(-f filter)...] [--oneline|--multiline|--ndjson|--format=format]
                               [--onlypassing]
+                              [--where=expression]
+                              [(--tag-filter=key=value)...]
+                              [--from-snapshot [--snapshot=path]]
+                              [--workers=number]
+                              [--jobs=number]
+                              [--stream]
 
 Options:
   -s service --service=service      query Consul for the given service [required]
+                                    repeat to query several services concurrently
+  --services-file=path              file with a service per line (- for stdin)
   --limit=number                    limit number result recieved from the query
   --tags=tag1,tag2                  list of tags to filter the query results
   --datacenters=dc1,dc2             list of datacenters to forward queries to
-  -f filter --filter=filter         jinja template to format the result
+  -f filter --filter=filter         jinja template to format the result, repeat to render
+                                    several templates into rows (columns)
   --oneline                         output results as oneline [requires: --filter]
   --multiline                       output results split into many lines [requires: --filter]
+  --ndjson                          output newline delimited JSON, an entry per line
+  --format=format                   output format json|json-compact|ndjson|msgpack|oneline|
+                                    multiline|tsv|csv
   --onlypassing                     specify to filter query results only with healthy checks
+  --where=expression                only output entries matching the Consul filter expression
+                                    (e.g. 'Service.Tags contains "class:pio"'),
+                                    evaluated locally for prepared queries
+  --tag-filter=key=value            only output entries having the key:value tag (or the key
+                                    with any value), repeat to require several tags
+  --from-snapshot                   answer from the snapshot (see counsel snapshot) without
+                                    calling Consul
+  --snapshot=path                   snapshot file (default: per server and datacenter)
+  --workers=number                  number of concurrent requests for several services [default: 8]
+  --jobs=number                     render a huge service by number of worker processes
+                                    (0 for the number of CPUs)
+  --stream                          decode the response incrementally, bounds memory use for
+                                    huge services (used with --filter for query)
   -h --help                         show this help message and exit
 
 Examples:
@@ -28,12 +53,16 @@ Examples:
   counsel query -s service --tags=tag1,tag2
   counsel query -s service --datacenters=dc2
   counsel query -s service -f '{{ Node.Address }}'
+  counsel query -s service --where='Node.Meta.rack == r1'
+  counsel query -s service -f '{{ Node.Node }}' -f '{{ Node.Address }}' --format=tsv
+  counsel query -s service1 -s service2 -s service3
 
 """
 from docopt import docopt
-from counsel.helpers import docopt_lstrip, docopt_strtolist
+from counsel.helpers import docopt_filters, docopt_lstrip, \
+    docopt_services, docopt_strtolist
 
 
 def cli(argv):
-    parsed = docopt_lstrip(docopt(__doc__, argv=argv))
-    return docopt_strtolist(parsed, 'tags', 'datacenters')
+    parsed = docopt_filters(docopt_lstrip(docopt(__doc__, argv=argv)))
+    return docopt_services(docopt_strtolist(parsed, 'tags', 'datacenters'))
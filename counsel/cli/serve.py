@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Run counsel daemon
+   Keeps the connection, templates and caches warm between invocations,
+   query and health commands are sent to the daemon over a unix socket
+   when it's running and use the same global options.
+
+Usage:
+  counsel serve [(-h|--help)] [--socket=path]
+
+Options:
+  --socket=path                     unix socket to listen on (default: $COUNSEL_SOCKET,
+                                    $XDG_RUNTIME_DIR/counsel.sock or the cache directory)
+  -h --help                         show this help message and exit
+
+Examples:
+  counsel -s consul.local serve &
+  counsel -s consul.local health -s service -f '{{ Node.Address }}'
+
+"""
+from docopt import docopt
+from counsel.helpers import docopt_lstrip
+
+
+def cli(argv):
+    return docopt_lstrip(docopt(__doc__, argv=argv))
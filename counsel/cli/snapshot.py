@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Snapshot Consul services health into a local file
+   The snapshot answers health and query commands given --from-snapshot
+
+Usage:
+  counsel snapshot [(-h|--help)] [(-s service)... | --services-file=path]
+                                 [--snapshot=path]
+                                 [--refresh]
+                                 [--workers=number]
+
+Options:
+  -s service --service=service      snapshot the given service, repeat to snapshot several
+                                    (default: all of the catalog services)
+  --services-file=path              file with a service per line (- for stdin)
+  --snapshot=path                   snapshot file (default: per server and datacenter
+                                    in the counsel cache directory)
+  --refresh                         only pull services whose Consul index moved since the
+                                    previous snapshot, the rest of it is kept
+  --workers=number                  number of concurrent requests [default: 8]
+  -h --help                         show this help message and exit
+
+Examples:
+  counsel snapshot
+  counsel snapshot --refresh
+  counsel snapshot -s service1 -s service2 --snapshot=/var/tmp/services.snap
+  counsel health -s service1 --from-snapshot --snapshot=/var/tmp/services.snap
+
+"""
+from docopt import docopt
+from counsel.helpers import docopt_lstrip, docopt_services
+
+
+def cli(argv):
+    parsed = docopt_services(docopt_lstrip(docopt(__doc__, argv=argv)))
+    service = parsed.pop('service')
+    parsed['services'] = [service] if isinstance(service, str) else service
+    return parsed
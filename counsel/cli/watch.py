@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""Watch Consul service health
+   Uses blocking queries and outputs the result each time it changes
+
+Usage:
+  counsel watch [(-h|--help)] (-s service|--service=service)
+                              [-t tag|--tag=tag]
+                              [(-f filter)...] [--oneline|--multiline|--ndjson|--format=format]
+                              [--onlypassing]
+                              [--wait=duration]
+                              [--min-interval=seconds]
+
+Options:
+  -s service --service=service      watch the given service [required]
+  -t tag --tag=tag                  tag to filter query results
+  -f filter --filter=filter         jinja template to format the result, repeat to render
+                                    several templates into rows (columns)
+  --oneline                         output results as oneline [requires: --filter]
+  --multiline                       output results split into many lines [requires: --filter]
+  --ndjson                          output newline delimited JSON, an entry per line
+  --format=format                   output format json|json-compact|ndjson|msgpack|oneline|
+                                    multiline|tsv|csv
+  --onlypassing                     specify to filter query results only with healthy checks
+  --wait=duration                   maximum blocking query duration [default: 5m]
+  --min-interval=seconds            minimum interval between consecutive queries [default: 1]
+  -h --help                         show this help message and exit
+
+Examples:
+  counsel watch -s service
+  counsel watch -s service -f '{{ Node.Address }}' --oneline
+
+"""
+from docopt import docopt
+from counsel.helpers import docopt_filters, docopt_lstrip
+
+
+def cli(argv):
+    parsed = docopt_filters(docopt_lstrip(docopt(__doc__, argv=argv)))
+    parsed['min_interval'] = float(parsed.pop('min-interval'))
+    return parsed
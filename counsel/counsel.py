@@ -1,31 +1,117 @@
-import sys
+import os
 import json
+import time
 import hashlib
+import itertools
+import contextvars
 from collections import namedtuple
 
 import consul
+import counsel.http
 import counsel.results as results
 import requests.exceptions
 from counsel.log import log
-from counsel.helpers import http_urlparse, dict_compact
+from counsel.cache import ResponseCache
+from counsel.where import Where
+from counsel.stream import iter_array
+from counsel.timings import Timings
+from counsel.registry import QueryRegistry
+from counsel.snapshot import Snapshot
+from counsel.helpers import http_urlparse, dict_compact, backoff_delay, \
+    cache_path
+
+
+class LazyAgent(object):
+    '''Creates the default consul agent on the first access
+    '''
+    def __get__(self, obj, cls):
+        if cls._agent is None:
+            cls._agent = counsel.http.Consul()
+        return cls._agent
 
 
 class Agent(object):
-    agent = consul.Consul()
+    _agent = None
+    agent = LazyAgent()
+
+
+class static_compatible(object):
+    '''Instance method which called on the class runs on an instance using
+       the default agent, as the method used to be static
+    '''
+    def __init__(self, method):
+        self.method = method
+        self.__doc__ = method.__doc__
+
+    def __get__(self, obj, cls):
+        return self.method.__get__(cls() if obj is None else obj, cls)
 
 
 class ConsulAPI(object):
+    def __init__(self, agent=None):
+        self._agent = agent
+
     @property
     def agent(self):
-        return Agent.agent
+        '''Consul agent of the instance, the default one unless it's given
+           (or connected with own options)
+        '''
+        return Agent.agent if self._agent is None else self._agent
 
     @agent.setter
     def agent(self, value):
-        Agent.agent = value
+        self._agent = value
+
+    class Error(Exception):
+        '''Base of the errors raised by counsel API calls
+        '''
+
+    class Unreachable(Error):
+        '''Consul agent can't be reached (connection error or timeout)
+        '''
+
+    class APIError(Error):
+        '''Consul API call failed
+        '''
+
+    class NotFound(APIError):
+        '''Requested object (e.g. prepared query) doesn't exist
+        '''
+
+    @staticmethod
+    def select(entries, where=None, projection=None):
+        '''Lazily filter entries by where and project them
+        '''
+        if where is not None:
+            entries = where.filter(entries)
+        if projection is not None:
+            entries = map(projection, entries)
+        return entries
+
+    @staticmethod
+    def entries(where=None, projection=None, key=None, allow_404=True):
+        '''API callback decoding the entries of a JSON array (under key of
+           the JSON object) one by one, each of them is filtered and
+           projected right away, so the whole response isn't held decoded.
+        '''
+        def callback(response):
+            consul.base.CB._status(response, allow_404=allow_404)
+            if response.code == 404:
+                return None
+            return list(ConsulAPI.select(iter_array([response.body], key=key),
+                                         where, projection))
+        return callback
 
     class Call(object):
-        def __init__(self, api_chain=None):
+        '''Invokes api method, errors are raised as ConsulAPI.Error
+
+           Timings spans are named after the api chain (e.g.
+           health.service), raw HTTP calls are named by the given operation.
+        '''
+        def __init__(self, api_chain=None, operation=None, chain=None):
             self.api = api_chain or Agent.agent
+            self.operation = operation
+            self.chain = chain
 
         def __enter__(self):
             return self
@@ -36,18 +122,23 @@ class ConsulAPI(object):
         def __call__(self, *args, **kwargs):
             '''Invoke api method
             '''
+            name = self.operation or self.chain or \
+                getattr(self.api, '__qualname__', None) or repr(self.api)
             try:
-                return self.api(*args, **dict_compact(kwargs))
+                with Timings.span('api', name):
+                    return self.api(*args, **dict_compact(kwargs))
+
+            except consul.base.NotFound as e:
+                # handled by callers which explicitly disallow 404
+                raise ConsulAPI.NotFound(str(e)) from e
 
-            except requests.exceptions.RequestException as e: 
-                log.error('%s', e)
-                sys.exit(1)
+            except requests.exceptions.RequestException as e:
+                raise ConsulAPI.Unreachable(str(e)) from e
 
             except consul.base.ConsulException as e:
-                log.error("%s\n\t==> %s\n", e,
-                          self.__class__.params_detail(dict_compact(kwargs))
-                         )
-                sys.exit(1)
+                raise ConsulAPI.APIError("{}\n\t==> {}\n".format(
+                    e, self.__class__.params_detail(dict_compact(kwargs))
+                )) from e
 
         def __getattr__(self, method_name):
             '''Forward requests to API.
@@ -55,10 +146,11 @@ class ConsulAPI(object):
             '''
             try:
                 chain_method = getattr(self.api, method_name)
-                return ConsulAPI.Call(chain_method)
+                return ConsulAPI.Call(chain_method, self.operation, '.'.join(
+                    filter(None, (self.chain, method_name))))
             except AttributeError as e:
-                log.error('Cannot invoke api method: %s', e)
-                sys.exit(1)
+                raise ConsulAPI.Error(
+                    'Cannot invoke api method: {}'.format(e)) from e
 
         @staticmethod
         def params_detail(kwargs):
@@ -67,102 +159,506 @@ class ConsulAPI(object):
 
 class Counsel(ConsulAPI):
     """Counsel App
+
+       Can be embedded: API errors are raised as ConsulAPI.Error subclasses
+       and the render_* methods return results instead of printing them.
     """
 
+    # default number of concurrent workers for batch queries
+    WORKERS = 8
+
     def connect_options(
             self, 
             server='http://127.0.0.1:8500',
             dc=None,
             token=None,
             consistency='default',
-            verify=True):
+            verify=True,
+            timeout=None,
+            cache_max_age=None,
+            session=None,
+            hedge=None):
         """
             Initializes consul api with the specified options.
             Some of the options including host, port have their defaults.
+            Given cache_max_age responses are cached locally for that long.
+            Given a requests session it's used for all of the API calls.
+
+            Several servers can be given as a list (or comma separated),
+            requests are then routed to the fastest available one. Given
+            hedge (a latency percentile) slow reads are duplicated to the
+            next server.
         """
-        url = http_urlparse(server)
-        self.agent = consul.Consul(
+        servers = server.split(',') if isinstance(server, str) else server
+        urls = [http_urlparse(s.strip()) for s in servers]
+        url = urls[0]
+        cache = None
+        if cache_max_age is not None:
+            cache = ResponseCache(max_age=cache_max_age)
+
+        self.agent = counsel.http.Consul(
             host=url.hostname,
-            port=url.port,
+            port=url.port or 8500,
             dc=dc,
             token=token,
             scheme=url.scheme,
             consistency=consistency,
-            verify=verify)
-
-    def __init__(self):
+            verify=verify,
+            timeout=timeout,
+            cache=cache,
+            session=session,
+            servers=['{}://{}:{}'.format(u.scheme, u.hostname, u.port or 8500)
+                     for u in urls[1:]],
+            hedge=hedge)
+
+    def __init__(self, **connect_options):
         super(Counsel, self).__init__()
+        if connect_options:
+            self.connect_options(**connect_options)
 
     @staticmethod
-    def jinja_filter(template, data):
+    def jinja_filter(template, data, lazy=False, jobs=None):
         '''Jinja filter applies jinja transformation for to the API reponse object.
+           Given a list of templates each object is rendered into a row.
+           Given lazy a list is rendered on demand, an iterator is returned.
+           Given jobs (0 for the CPU count) huge lists are rendered by that
+           many worker processes.
         '''
-        jinja = results.JinjaRender(template)
+        if jobs is not None and jobs != 1:
+            jinja = results.ParallelRender(template, jobs=jobs)
+        else:
+            jinja = results.ParallelRender.create(template)
+
+        if lazy and not isinstance(data, dict):
+            return jinja.iter_render(data)
         return jinja.render(data)
 
-    def display_query_service(
-            self, service, limit=None, tags=None,
-            dc=None, datacenters=None, onlypassing=None,
-            filter=None, format='json'):
-        '''Displays query service
+    def batch(self, method, services, workers=None):
+        '''Invokes method(service) concurrently for each of the services
+           over the shared HTTP session. Returns results keyed by service.
         '''
-        result = self.query_service(service, limit=limit, tags=tags,
-                                    dc=dc, datacenters=datacenters,
-                                    onlypassing=onlypassing)
+        services = list(dict.fromkeys(services))
+        workers = max(1, min(workers or self.WORKERS, len(services)))
+        self.agent.http.pool_size(workers)
 
-        # Filter query list, result contexts are stored in res['Nodes']
-        if filter:
-            data = result['Nodes']
-            result = self.jinja_filter(filter, data)
+        from concurrent.futures import ThreadPoolExecutor
 
-        # output the result
-        formatter = results.Formatter(output_format=format)
-        formatter.output(result)
+        # workers run in the caller's context (e.g. daemon log capture)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(s, executor.submit(contextvars.copy_context().run,
+                                           method, s)) for s in services]
 
-    def display_health_service(
-            self, service, filter=None, format='json',
-            tag=None, dc=None, onlypassing=None):
-        '''Displays health service query
+        return {service: future.result() for service, future in futures}
+
+    def display_query_service(self, service, format='json', out=None,
+                              **kwargs):
+        '''Displays query service, see render_query_service
         '''
-        result = self.health_service(service,
-                                     tag=tag,
-                                     dc=dc,
-                                     onlypassing=onlypassing)
-        if filter:
-            result = self.jinja_filter(filter, result)
+        formatter = results.Formatter(output_format=format, out=out)
+        formatter.write(self.render_query_service(service, **kwargs))
 
-        formatter = results.Formatter(output_format=format)
-        formatter.output(result)
+    def render_query_service(
+            self, service, limit=None, tags=None,
+            dc=None, datacenters=None, onlypassing=None,
+            filter=None, workers=None, stream=False, where=None,
+            snapshot=None, jobs=None, tag_filter=None):
+        '''Returns (filtered) query service result, a list of services is
+           queried concurrently into a dict keyed by service. Filtered
+           results of a single service are an iterator. Given where only
+           the matching nodes are returned. Given snapshot (its path, True
+           for the default one) the result is looked up in the snapshot.
+           Given jobs a single service is rendered by worker processes.
+           Given tag_filter (key=value or key) only nodes having all of
+           the tags are returned.
+        '''
+        options = dict(limit=limit, tags=tags, dc=dc,
+                       datacenters=datacenters, onlypassing=onlypassing,
+                       where=Where.create(where, tag_filter),
+                       snapshot=self.open_snapshot(snapshot))
+
+        def fetch(service):
+            if filter:
+                return list(self.iter_query_service(service, filter=filter,
+                                                    **options))
+            return self.query_service(service, **options)
+
+        if isinstance(service, list):
+            result = self.batch(fetch, service, workers=workers)
+        elif filter:
+            result = self.iter_query_service(service, filter=filter,
+                                             stream=stream, jobs=jobs,
+                                             **options)
+        else:
+            result = self.query_service(service, **options)
 
-    @staticmethod
-    def query_service(service, tags=None, dc=None,
-                      datacenters=None, onlypassing=None, limit=None):
-        '''Invoke query service api calls
+        return result
+
+    def display_health_service(self, service, format='json', out=None,
+                               **kwargs):
+        '''Displays health service query, see render_health_service
+        '''
+        formatter = results.Formatter(output_format=format, out=out)
+        formatter.write(self.render_health_service(service, **kwargs))
+
+    def render_health_service(
+            self, service, filter=None,
+            tag=None, dc=None, onlypassing=None, workers=None,
+            dcs=None, dc_timeout=None, stream=False, where=None,
+            snapshot=None, jobs=None, tag_filter=None):
+        '''Returns iterator of (filtered) service health entries, a list of
+           services is queried concurrently into a dict keyed by service.
+           Given dcs the service is queried in all of them. Given where
+           only the matching entries are returned. Given snapshot (its path,
+           True for the default one) entries are looked up in the snapshot.
+           Given jobs a single service is rendered by worker processes.
+           Given tag_filter (key=value or key) only entries having all of
+           the tags are returned.
         '''
+        options = dict(filter=filter, tag=tag, dc=dc, onlypassing=onlypassing,
+                       dcs=dcs, dc_timeout=dc_timeout,
+                       where=Where.create(where, tag_filter),
+                       snapshot=self.open_snapshot(snapshot))
+
+        if isinstance(service, list):
+            result = self.batch(
+                lambda s: list(self.iter_health_service(s, **options)),
+                service, workers=workers)
+        else:
+            result = self.iter_health_service(service, stream=stream,
+                                              jobs=jobs, **options)
+
+        return result
 
-        query = Counsel.Query()
+    def iter_query_service(self, service, filter=None, stream=False,
+                           jobs=None, **kwargs):
+        '''Yields (filtered) query service nodes one by one. Given stream
+           the nodes are decoded incrementally off the response. Nodes are
+           projected onto the keys used by the filter templates.
+        '''
+        if filter:
+            kwargs['projection'] = results.Projection.create(filter)
+
+        if stream:
+            data = self.query_service(service, stream=True, **kwargs)
+        else:
+            # Filter query list, result contexts are stored in res['Nodes']
+            data = self.query_service(service, **kwargs)['Nodes']
+
+        return self.jinja_filter(filter, data, lazy=True, jobs=jobs) \
+               if filter else iter(data)
+
+    def iter_health_service(self, service, filter=None, tag=None, dc=None,
+                            onlypassing=None, dcs=None, dc_timeout=None,
+                            stream=False, where=None, snapshot=None,
+                            jobs=None):
+        '''Yields (filtered) service health entries one by one, given dcs
+           the service is queried in all of them. Given stream the entries
+           are decoded incrementally off the response. Entries are projected
+           onto the keys used by the filter templates.
+        '''
+        projection = results.Projection.create(filter) if filter else None
+
+        if snapshot is not None:
+            if dcs:
+                raise ConsulAPI.Error('snapshot holds a single datacenter, '
+                                      'dcs are not supported')
+            result = self.snapshot_service(
+                snapshot, service, tags=[tag] if tag else None, dc=dc,
+                statuses=('passing',) if onlypassing else None)
+            result = ConsulAPI.select(result, where, projection)
+        elif stream and not dcs:
+            health = Counsel.Health(self.agent)
+            result = health.iter_service(service,
+                                         onlypassing=onlypassing,
+                                         tag=tag,
+                                         dc=dc,
+                                         where=where,
+                                         projection=projection)
+        elif dcs:
+            result = self.health_service_dcs(service, dcs,
+                                             timeout=dc_timeout,
+                                             tag=tag,
+                                             onlypassing=onlypassing,
+                                             where=where,
+                                             projection=projection)
+        else:
+            result = self.health_service(service,
+                                         tag=tag,
+                                         dc=dc,
+                                         onlypassing=onlypassing,
+                                         where=where,
+                                         projection=projection)
+
+        return self.jinja_filter(filter, result, lazy=True, jobs=jobs) \
+               if filter else iter(result)
+
+    def watch_health_service(
+            self, service, filter=None, tag=None, dc=None,
+            onlypassing=None, wait=None, min_interval=None):
+        '''Yields (filtered) service health each time it changes
+        '''
+        previous = None
+        updates = Counsel.Health(self.agent).watch(service,
+                                                   onlypassing=onlypassing,
+                                                   tag=tag,
+                                                   dc=dc,
+                                                   wait=wait,
+                                                   min_interval=min_interval)
+        projection = results.Projection.create(filter) if filter else None
+        for result in updates:
+            if projection:
+                result = list(map(projection, result))
+            if filter:
+                result = self.jinja_filter(filter, result)
+
+            # index changes don't necessarily affect the rendered result
+            if result != previous:
+                previous = result
+                yield result
+
+    def display_watch_service(
+            self, service, filter=None, format='json',
+            tag=None, dc=None, onlypassing=None,
+            wait=None, min_interval=None, out=None):
+        '''Displays service health query each time the result changes
+        '''
+        formatter = results.Formatter(output_format=format, out=out)
+        for result in self.watch_health_service(service,
+                                                filter=filter,
+                                                tag=tag,
+                                                dc=dc,
+                                                onlypassing=onlypassing,
+                                                wait=wait,
+                                                min_interval=min_interval):
+            formatter.output(result, allow_empty=True)
+
+    @static_compatible
+    def query_service(self, service, tags=None, dc=None,
+                      datacenters=None, onlypassing=None, limit=None,
+                      stream=False, where=None, projection=None,
+                      snapshot=None):
+        '''Invoke query service api calls, given stream an iterator of
+           the incrementally decoded result Nodes is returned. Prepared
+           queries don't support filters, so where is checked locally.
+           Given projection only the projected Nodes are returned. Given
+           snapshot the nodes are looked up in it, like the prepared query
+           would return them.
+        '''
+        if snapshot is not None:
+            if datacenters:
+                raise ConsulAPI.Error('snapshot holds a single datacenter, '
+                                      'datacenters are not supported')
+            nodes = Counsel.snapshot_service(
+                snapshot, service, tags=tags, dc=dc,
+                statuses=('passing',) if onlypassing
+                         else ('passing', 'warning'))
+            nodes = ConsulAPI.select(itertools.islice(nodes, limit),
+                                     Where.create(where), projection)
+            if stream:
+                return nodes
+            return {'Service': service, 'Nodes': list(nodes),
+                    'Datacenter': snapshot.info.get('dc')}
+
+        query = Counsel.Query(self.agent)
         query.options(service,
                       tags=tags,
                       datacenters=datacenters,
                       onlypassing=onlypassing)
 
-        # create, execute and cleanup the query
-        result = query.execute(dc=dc, limit=limit)
-        query.cleanup()
+        # prepared queries are kept for reuse, stale ones are trimmed
+        result = query.execute(dc=dc, limit=limit, stream=stream,
+                               where=Where.create(where),
+                               projection=projection)
+        query.gc()
 
         return result
 
-    @staticmethod
-    def health_service(service, onlypassing=None, tag=None, dc=None):
-        '''Invoke health service api call
+    @static_compatible
+    def health_service(self, service, onlypassing=None, tag=None, dc=None,
+                       where=None, projection=None):
+        '''Invoke health service api call, given where (an expression or
+           Where) the entries are filtered by consul.
         '''
-        health = Counsel.Health()
+        health = Counsel.Health(self.agent)
         result = health.service(service,
                                 onlypassing=onlypassing,
                                 tag=tag,
-                                dc=dc)
+                                dc=dc,
+                                where=Where.create(where),
+                                projection=projection)
         return result
 
+    def health_service_dcs(self, service, dcs, timeout=None,
+                           onlypassing=None, tag=None, where=None,
+                           projection=None):
+        '''Invoke health service api calls in all of the datacenters
+           concurrently. Each entry is tagged with its Datacenter and the
+           entries are merged into one list. A datacenter which fails or
+           doesn't respond within timeout is skipped, when none of them
+           answers the error of the first one is raised.
+        '''
+        def fetch(dc):
+            with self.agent.http.timeout_scope(timeout):
+                try:
+                    health = Counsel.Health(self.agent)
+                    return health.service(service,
+                                          onlypassing=onlypassing,
+                                          tag=tag,
+                                          dc=dc,
+                                          where=where,
+                                          projection=projection), None
+
+                except ConsulAPI.Error as e:
+                    log.warning('datacenter %s skipped: %s', dc, e)
+                    return None, e
+
+        dcs = list(dict.fromkeys(dcs))
+        results = self.batch(fetch, dcs, workers=len(dcs))
+
+        errors = [(dc, results[dc][1]) for dc in dcs if results[dc][1]]
+        if dcs and len(errors) == len(dcs):
+            error = errors[0][1]
+            raise type(error)('no datacenter answered: {}'.format(
+                ', '.join('{}: {}'.format(dc, e) for dc, e in errors)
+            )) from error
+
+        merged = []
+        for dc in dcs:
+            for entry in results[dc][0] or []:
+                entry['Datacenter'] = dc
+                merged.append(entry)
+
+        return merged
+
+    @static_compatible
+    def snapshot_path(self):
+        '''Default snapshot file of the connected server and datacenter
+        '''
+        agent = self.agent
+        key = '{} {}'.format(agent.http.base_uri, agent.dc or '')
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return cache_path('snapshots', '{}.snap'.format(digest[:16]))
+
+    @static_compatible
+    def open_snapshot(self, snapshot):
+        '''Returns Snapshot of the given path, True stands for the default
+           one. Snapshots and None are returned as they are.
+        '''
+        if snapshot is None or isinstance(snapshot, Snapshot):
+            return snapshot
+        try:
+            return Snapshot(self.snapshot_path() if snapshot is True
+                            else snapshot)
+        except Snapshot.Error as e:
+            raise ConsulAPI.Error(str(e)) from e
+
+    def snapshot(self, services=None, path=None, refresh=False,
+                 workers=None):
+        '''Pulls health of the services (all of the catalog services by
+           default) into the snapshot file. Given refresh the services whose
+           index didn't move are copied from the previous snapshot as they
+           are, without being decoded, refreshing selected services keeps
+           the other ones. Returns snapshot stats.
+        '''
+        path = path or self.snapshot_path()
+        previous = None
+        if refresh:
+            try:
+                previous = Snapshot(path)
+            except Snapshot.Error as e:
+                log.warning('%s, taking full snapshot', e)
+
+        selected = bool(services)
+        if not selected:
+            with ConsulAPI.Call(self.agent) as api:
+                _, catalog = api.catalog.services()
+            services = sorted(catalog)
+
+        health = Counsel.Health(self.agent)
+
+        def fetch(service):
+            '''Returns encoded service, None if its index didn't move
+            '''
+            index = previous.index(service) if previous else None
+
+            def callback(response):
+                consul.base.CB._status(response)
+                moved = int(response.headers.get('X-Consul-Index') or 0)
+                if moved and moved == index:
+                    return None
+                return Snapshot.encode(moved, iter_array([response.body]))
+
+            uri = '/v1/health/service/{}'.format(service)
+            with ConsulAPI.Call(self.agent.http, 'health.service') as api:
+                return api.get(callback, uri, params=health.params())
+
+        try:
+            blocks = self.batch(fetch, services, workers=workers) \
+                if services else {}
+            updated = [s for s in blocks if blocks[s] is not None]
+            # refresh of selected services keeps the rest of the snapshot
+            if previous and selected:
+                blocks.update((s, None) for s in previous.services
+                              if s not in blocks)
+            Snapshot.write(path, ((s, blocks[s] or previous.block(s))
+                                  for s in sorted(blocks)),
+                           server=self.agent.http.base_uri,
+                           dc=self.agent.dc,
+                           time=int(time.time()))
+        except (IOError, OSError) as e:
+            raise ConsulAPI.Error('cannot write snapshot {}: {}'.format(
+                path, e)) from e
+        finally:
+            if previous:
+                previous.close()
+
+        return {'path': path, 'services': len(blocks),
+                'updated': len(updated), 'size': os.path.getsize(path)}
+
+    @staticmethod
+    def snapshot_service(snapshot, service, tags=None, dc=None,
+                         statuses=None):
+        '''Returns iterator of the service entries in snapshot having all of
+           the tags (!tag excludes the tag). Given statuses only entries with
+           all of the checks in one of them are returned.
+        '''
+        if dc and dc != snapshot.info.get('dc'):
+            raise ConsulAPI.Error('snapshot {} is not of datacenter {}'.format(
+                snapshot.path, dc))
+        try:
+            tag_counts = snapshot.meta(service)['tags']
+        except Snapshot.NotFound as e:
+            raise ConsulAPI.NotFound(str(e)) from e
+
+        tags = [t for t in tags or () if t]
+        required = set(t for t in tags if not t.startswith('!'))
+        excluded = set(t[1:] for t in tags if t.startswith('!'))
+
+        def match(entry):
+            if required or excluded:
+                entry_tags = set((entry.get('Service') or {}).get('Tags') or ())
+                if not required <= entry_tags or excluded & entry_tags:
+                    return False
+            return not statuses or all(check.get('Status') in statuses
+                                       for check in entry.get('Checks') or ())
+
+        # entries are looked up by the rarest of the tags
+        tag = min(required, key=lambda t: tag_counts.get(t, (0, 0))[1],
+                  default=None)
+        return filter(match, snapshot.entries(service, tag=tag))
+
+    def query_services(self, services, workers=None, **kwargs):
+        '''Invoke query service api calls for many services concurrently
+        '''
+        return self.batch(lambda s: self.query_service(s, **kwargs),
+                          services, workers=workers)
+
+    def health_services(self, services, workers=None, **kwargs):
+        '''Invoke health service api calls for many services concurrently
+        '''
+        return self.batch(lambda s: self.health_service(s, **kwargs),
+                          services, workers=workers)
+
 
     class Query(ConsulAPI):
         '''Creates prepared service query
@@ -171,29 +667,88 @@ class Counsel(ConsulAPI):
         class CachedQuery(namedtuple('CachedQuery', 'uniqname id')):
             pass
 
-        def __init__(self):
-            super(self.__class__, self).__init__()
+        def __init__(self, agent=None):
+            super(self.__class__, self).__init__(agent)
             # self.service_match = "${match(0)}"
             self._options = {}
-            self.query_cache = {}
 
-        def execute(self, token=None, dc=None, near=None, limit=None):
-            ''' Perform prepared service query
+        @property
+        def registry(self):
+            return QueryRegistry.open(self.agent.http.base_uri)
+
+        def execute(self, token=None, dc=None, near=None, limit=None,
+                    stream=False, where=None, projection=None):
+            ''' Perform prepared service query, given stream returns iterator
+                of the incrementally decoded result Nodes. Nodes are filtered
+                by where, given projection only the projected Nodes are
+                returned (decoded one by one).
 
                 /v1/query/<query or name>/execute
             '''
-            result = None
-
-            # Prepared queries can be executed only up by name!
+            # Prepared queries can be executed only up by name! So the query
+            # is executed straight away and gets created only if it's missing.
+            uniqname = self.uniqname
+            try:
+                result = self._execute(uniqname, token=token, dc=dc,
+                                       near=near, limit=limit, stream=stream,
+                                       where=where, projection=projection)
+                self.registry.add(uniqname)
+
+            except ConsulAPI.NotFound:
+                log.info('query %s not found, creating', uniqname)
+                self.registry.remove(uniqname)
+                try:
+                    self.create()
+                except ConsulAPI.APIError as e:
+                    # another caller may have created it meanwhile (names
+                    # are unique), then it's executed and registered by name
+                    log.info('query %s not created, executing: %s',
+                             uniqname, e)
+                    try:
+                        result = self._execute(
+                            uniqname, token=token, dc=dc, near=near,
+                            limit=limit, stream=stream, where=where,
+                            projection=projection)
+                    except ConsulAPI.NotFound:
+                        raise e
+                    self.registry.add(uniqname)
+                    return result
+
+                result = self._execute(uniqname, token=token, dc=dc,
+                                       near=near, limit=limit, stream=stream,
+                                       where=where, projection=projection)
 
-            with ConsulAPI.Call() as api:
-                result = api.query.execute(
-                    self.query.uniqname,
-                    token=token,
-                    dc=dc,
-                    near=near,
-                    limit=limit)
+            return result
 
+        def _execute(self, name, token=None, dc=None, near=None, limit=None,
+                     stream=False, where=None, projection=None):
+            '''Execute query raising NotFound when it doesn't exist
+            '''
+            params = dict_compact({
+                'token': token or self.agent.token,
+                'dc': dc,
+                'near': near,
+                'limit': limit
+            })
+
+            path = '/v1/query/{}/execute'.format(name)
+            with ConsulAPI.Call(self.agent.http, 'query.execute') as api:
+                if stream:
+                    return ConsulAPI.select(
+                        api.stream(path, params=list(params.items()),
+                                   key='Nodes'), where, projection)
+
+                if projection is not None:
+                    callback = ConsulAPI.entries(where, projection,
+                                                 key='Nodes', allow_404=False)
+                    return {'Nodes': api.get(callback, path,
+                                             params=list(params.items()))}
+
+                result = api.get(consul.base.CB.json(allow_404=False), path,
+                                 params=list(params.items()))
+
+            if where is not None:
+                result['Nodes'] = list(where.filter(result['Nodes']))
             return result
 
         def options(self, service_or_match,
@@ -212,34 +767,16 @@ class Counsel(ConsulAPI):
                 'tags': tags
             }
 
-        @property
-        def query(self):
-            '''Retrieves query from in-mem cache if it exists otherwise
-               create consul "prepared" query and cache it.
+        def create(self):
+            '''Create consul "prepared" query and register it.
             '''
             uniqname = self.uniqname
+            with ConsulAPI.Call(self.agent) as api:
+                query_id = api.query.create(name=uniqname,
+                                            **self._options)['ID']
 
-            if uniqname not in self.query_cache.keys():
-                with ConsulAPI.Call() as api:
-                    cached_query = None
-
-                    # Query might exist in consul but not in the local cache
-                    for _query in api.query.list():
-                        if _query['Name'] == uniqname:
-                            cached_query = self.CachedQuery(
-                                uniqname=uniqname, id=_query['ID'])
-
-                    # Create query
-                    if not cached_query:
-                        query_id = api.query.create(name=uniqname,
-                                                    **self._options)['ID']
-
-                        cached_query = self.CachedQuery(
-                            uniqname=uniqname, id=query_id)
-
-                    self.query_cache[uniqname] = cached_query
-
-            return cached_query
+            self.registry.add(uniqname, query_id)
+            return self.CachedQuery(uniqname=uniqname, id=query_id)
 
         @property
         def uniqname(self):
@@ -250,15 +787,24 @@ class Counsel(ConsulAPI):
             sha256 = hashlib.sha256(serialized).hexdigest()
             return 'counsel-{}'.format(sha256)
 
-        def cleanup(self):
-            ''' Trim Counsel prepared queries
-            '''
-            for query in list(self.query_cache.values()):
-                with ConsulAPI.Call() as api:
-                    api.query.delete(query.id)
-                    self.query_cache.pop(query.uniqname)
+        def _delete(self, query_id):
+            with ConsulAPI.Call(self.agent) as api:
+                api.query.delete(query_id)
 
-            return True
+        def _index(self):
+            '''Map counsel query names to their IDs
+            '''
+            with ConsulAPI.Call(self.agent) as api:
+                return {
+                    _query['Name']: _query['ID'] for _query in api.query.list()
+                    if _query['Name'].startswith('counsel-')
+                }
+
+        def gc(self):
+            ''' Trim stale Counsel prepared queries in background
+            '''
+            return self.registry.gc_async(self._delete, self._index,
+                                          ConsulAPI.Error)
 
 
     class Health(ConsulAPI):
@@ -269,20 +815,71 @@ class Counsel(ConsulAPI):
                tag=None, dc=None, near=None, token=None)
         '''
 
-        def __init__(self):
-            super(self.__class__, self).__init__()
+        def __init__(self, agent=None):
+            super(self.__class__, self).__init__(agent)
 
-        @staticmethod
-        def service(service, onlypassing=None, tag=None, dc=None, near=None, token=None):
-            '''Query service health
+        def params(self, onlypassing=None, tag=None, dc=None, near=None,
+                   token=None, where=None):
+            '''Query params of the raw health service requests
+            '''
+            agent = self.agent
+            params = dict_compact({
+                'passing': '1' if onlypassing else None,
+                'tag': tag,
+                'dc': dc or agent.dc,
+                'near': near,
+                'token': token or agent.token,
+                'filter': where.server if where else None
+            })
+            if agent.consistency in ('consistent', 'stale'):
+                params[agent.consistency] = '1'
+            return list(params.items())
+
+        def filtered(self, request, where, onlypassing=None, tag=None,
+                     dc=None, near=None, token=None):
+            '''Invoke request(params) filtered by Consul, when Consul
+               rejects the filter (agents not supporting filters) it's
+               invoked again without it and the caller filters locally
+            '''
+            try:
+                return request(self.params(onlypassing, tag, dc, near, token,
+                                           where))
+
+            except ConsulAPI.APIError as e:
+                if where is None or \
+                        not isinstance(e.__cause__, consul.base.BadRequest):
+                    raise
+                log.warning('filter rejected by consul, filtering '
+                            'locally: %s', e.__cause__)
+
+            return request(self.params(onlypassing, tag, dc, near, token))
+
+        def service(self, service, onlypassing=None, tag=None, dc=None,
+                    near=None, token=None, where=None, projection=None):
+            '''Query service health, given where (Where predicate) entries
+               are filtered by Consul and checked locally, so that agents not
+               supporting filters still return only the matching ones. Given
+               projection entries are projected as they are decoded.
 
                /v1/health/service/<service>
             '''
             result = None
 
+            if where is not None or projection is not None:
+                path = '/v1/health/service/{}'.format(service)
+                callback = ConsulAPI.entries(where, projection)
+
+                def get(params):
+                    with ConsulAPI.Call(self.agent.http,
+                                        'health.service') as api:
+                        return api.get(callback, path, params=params)
+
+                return self.filtered(get, where, onlypassing, tag, dc, near,
+                                     token)
+
             # Prepared query templates can only be resolved up by name
             # (during execution only)
-            with ConsulAPI.Call() as api:
+            with ConsulAPI.Call(self.agent) as api:
                 _, result = api.health.service(
                     service,
                     passing=onlypassing,
@@ -292,3 +889,66 @@ class Counsel(ConsulAPI):
                     token=token)
 
             return result
+
+        def iter_service(self, service, onlypassing=None, tag=None, dc=None,
+                         near=None, token=None, where=None, projection=None):
+            '''Query service health decoding entries incrementally
+
+               /v1/health/service/<service>
+            '''
+            path = '/v1/health/service/{}'.format(service)
+
+            def stream(params):
+                with ConsulAPI.Call(self.agent.http, 'health.service') as api:
+                    return api.stream(path, params=params)
+
+            result = self.filtered(stream, where, onlypassing, tag, dc, near,
+                                   token)
+            return ConsulAPI.select(result, where, projection)
+
+        def watch(self, service, onlypassing=None, tag=None, dc=None,
+                  near=None, token=None, wait=None, min_interval=None,
+                  max_backoff=None):
+            '''Watch service health using blocking queries
+
+               Yields the service health result initially and whenever
+               X-Consul-Index changes. Failed calls are retried with jittered
+               backoff, index churn is rate limited by min_interval seconds.
+            '''
+            wait = wait or '5m'
+            min_interval = 1.0 if min_interval is None else min_interval
+            max_backoff = max_backoff or 60.0
+
+            index = None
+            failures = 0
+            while True:
+                started = time.time()
+                try:
+                    with ConsulAPI.Call(self.agent) as api:
+                        new_index, result = api.health.service(
+                            service,
+                            index=index,
+                            wait=wait,
+                            passing=onlypassing,
+                            tag=tag,
+                            dc=dc,
+                            near=near,
+                            token=token)
+
+                except ConsulAPI.Error as e:
+                    failures += 1
+                    delay = backoff_delay(failures, cap=max_backoff)
+                    log.warning('watch failed: %s, retrying in %.1fs', e, delay)
+                    time.sleep(delay)
+                    continue
+
+                failures = 0
+                if new_index != index:
+                    # index going backwards must reset the blocking query
+                    reset = index and int(new_index) < int(index)
+                    index = None if reset else new_index
+                    yield result
+
+                elapsed = time.time() - started
+                if elapsed < min_interval:
+                    time.sleep(min_interval - elapsed)
@@ -0,0 +1,250 @@
+import os
+import json
+import socket
+import logging
+import threading
+import contextvars
+import socketserver
+from contextlib import contextmanager
+
+from counsel.log import log, OutputFormatter
+from counsel.helpers import cache_path
+
+
+def socket_path():
+    '''Daemon socket path, COUNSEL_SOCKET overrides the default location
+       ($XDG_RUNTIME_DIR/counsel.sock or the counsel cache directory).
+    '''
+    path = os.environ.get('COUNSEL_SOCKET')
+    if path:
+        return path
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'counsel.sock')
+
+    return cache_path('counsel.sock')
+
+
+class CaptureHandler(logging.Handler):
+    '''Log handler writing records into the buffer of the current context,
+       so that errors of a request can be sent back to its client. Threads
+       working on the request run in a copy of its context (see batch).
+    '''
+    buffer = contextvars.ContextVar('counsel_capture', default=None)
+
+    def emit(self, record):
+        buf = self.buffer.get()
+        if buf is not None:
+            buf.write(self.format(record) + '\n')
+
+    @contextmanager
+    def capture(self, buf):
+        token = self.buffer.set(buf)
+        try:
+            yield buf
+        finally:
+            self.buffer.reset(token)
+
+
+class FrameWriter(object):
+    '''File-like object sending what's written to the client as JSON line
+       frames {name: text}. Writes are buffered up to BUFFER_SIZE, unless
+       it's unbuffered. Writers of a request share the lock, so that their
+       frames (written by several threads) don't interleave.
+    '''
+
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, wfile, name, lock, buffered=True):
+        self.wfile = wfile
+        self.name = name
+        self.lock = lock
+        self.buffered = buffered
+        self.written = False
+        self._buffer = []
+        self._size = 0
+
+    def write(self, text):
+        if text:
+            with self.lock:
+                self._buffer.append(text)
+                self._size += len(text)
+                if not self.buffered or self._size >= self.BUFFER_SIZE:
+                    self._send()
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            self._send()
+
+    def _send(self):
+        if not self._buffer:
+            return
+
+        frame = {self.name: ''.join(self._buffer)}
+        self._buffer = []
+        self._size = 0
+        self.wfile.write(json.dumps(frame).encode('utf-8') + b'\n')
+        self.wfile.flush()
+        self.written = True
+
+
+class ErrorWriter(FrameWriter):
+    '''Unbuffered writer of the log messages, a client which went away
+       is ignored (the output writer fails the command).
+    '''
+
+    def __init__(self, wfile, lock):
+        super(ErrorWriter, self).__init__(wfile, 'stderr', lock,
+                                          buffered=False)
+
+    def _send(self):
+        try:
+            super(ErrorWriter, self)._send()
+        except OSError:
+            pass
+
+
+class Handler(socketserver.StreamRequestHandler):
+    '''Serves a single request: a JSON line {"argv": [...]} is answered
+       with {"stdout": str} and {"stderr": str} frames as the command
+       writes its output and messages, followed by {"status": int}. Given
+       {"fallback": true} the client should run the command itself.
+    '''
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # connection probe, see alive()
+            return
+
+        try:
+            request = json.loads(line.decode('utf-8'))
+            argv = request['argv']
+        except (ValueError, KeyError, TypeError) as e:
+            log.error('bad daemon request: %s', e)
+            return
+
+        lock = threading.Lock()
+        out = FrameWriter(self.wfile, 'stdout', lock)
+        err = ErrorWriter(self.wfile, lock)
+        try:
+            with self.server.capture.capture(err):
+                status = self.server.handle_argv(argv, out)
+            out.flush()
+        except OSError as e:
+            log.info('daemon client went away: %s', e)
+            return
+
+        if status is None:
+            reply = {'fallback': True}
+        else:
+            reply = {'status': status}
+
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Counsel daemon listening on a unix socket.
+
+       handle_argv(argv, out) runs a command writing its output into out and
+       returns the exit status, or None when the command can't be served.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, handle_argv):
+        self.path = path
+        self.handle_argv = handle_argv
+        self.capture = CaptureHandler()
+        self.capture.setFormatter(OutputFormatter())
+        log.addHandler(self.capture)
+
+        if os.path.exists(path):
+            if alive(path):
+                raise RuntimeError('counsel daemon is already running on '
+                                   '{}'.format(path))
+            os.unlink(path)
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        # socket is only accessible by the user, requests use its token
+        umask = os.umask(0o077)
+        try:
+            super(Server, self).__init__(path, Handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super(Server, self).server_close()
+        log.removeHandler(self.capture)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def serve(handle_argv, path=None):
+    '''Serve requests until interrupted
+    '''
+    path = path or socket_path()
+    server = Server(path, handle_argv)
+    log.info('counsel daemon listening on %s', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def alive(path):
+    '''Check whether a daemon accepts connections on the socket
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+def request(argv, out, err=None, path=None, timeout=None):
+    '''Send command to the running daemon writing its output into out and
+       its messages into err as they arrive. Returns the exit status or
+       None if the daemon is not running or asks to run the command locally.
+    '''
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+
+    written = False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps({'argv': argv}).encode('utf-8') + b'\n')
+
+            for line in sock.makefile('rb'):
+                frame = json.loads(line.decode('utf-8'))
+                if 'stdout' in frame:
+                    out.write(frame['stdout'])
+                    out.flush()
+                    written = True
+                elif 'stderr' in frame:
+                    if err is not None:
+                        err.write(frame['stderr'])
+                elif frame.get('fallback'):
+                    return None
+                else:
+                    return frame['status']
+
+    except (OSError, ValueError) as e:
+        # output can't be taken back, the command isn't run again
+        if written:
+            log.error('counsel daemon connection failed: %s', e)
+            return 1
+        return None
+
+    if written:
+        log.error('counsel daemon closed the connection')
+        return 1
+    return None
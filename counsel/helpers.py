@@ -1,3 +1,6 @@
+import os
+import sys
+import random
 from urllib.parse import urlparse
 
 
@@ -35,3 +38,61 @@ def docopt_strtolist(adict, *args):
            else v
         for k, v in adict.items()
     }
+
+
+def cache_path(*parts):
+    '''Return path inside of the counsel cache directory.
+       COUNSEL_CACHE_DIR overrides the default ($XDG_CACHE_HOME/counsel).
+    '''
+    base = os.environ.get('COUNSEL_CACHE_DIR')
+    if not base:
+        xdg_cache = os.environ.get('XDG_CACHE_HOME') or \
+                    os.path.join(os.path.expanduser('~'), '.cache')
+        base = os.path.join(xdg_cache, 'counsel')
+
+    return os.path.join(base, *parts)
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    '''Exponential backoff delay with full jitter for the given attempt.
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def read_lines(path):
+    '''Read non-empty stripped lines of a file, - stands for stdin.
+       Lines starting with # are ignored.
+    '''
+    if path == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as f:
+            lines = f.readlines()
+
+    lines = (line.strip() for line in lines)
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def docopt_services(adict):
+    '''Merge repeated service options and services file into the service
+       list. A single service is left as a string.
+    '''
+    services = list(adict.pop('service') or [])
+    services_file = adict.pop('services-file', None)
+    if services_file:
+        services.extend(read_lines(services_file))
+
+    adict['service'] = services if len(services) != 1 or services_file \
+                       else services[0]
+    adict['workers'] = int(adict['workers']) if adict.get('workers') else None
+    adict['jobs'] = int(adict['jobs']) if adict.get('jobs') else None
+    return adict
+
+
+def docopt_filters(adict):
+    '''Repeated filter option gives a list of templates, a single template
+       is left as a string.
+    '''
+    filters = adict.get('filter') or []
+    adict['filter'] = filters[0] if len(filters) == 1 else filters or None
+    return adict
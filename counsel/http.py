@@ -0,0 +1,517 @@
+import os
+import json
+import time
+import zlib
+import queue
+import hashlib
+import tempfile
+import threading
+import collections
+from contextlib import closing, contextmanager
+
+import consul.std
+import requests.adapters
+import requests.exceptions
+import urllib3.exceptions
+
+from counsel.log import log
+from counsel.stream import iter_array
+from counsel.timings import Timings
+from counsel.helpers import backoff_delay, cache_path
+
+
+class Endpoint(object):
+    '''Consul server tracked by its latency (EWMA and a window of recent
+       samples for percentiles) and errors. A failing endpoint is avoided
+       for a jittered backoff growing with consecutive failures.
+    '''
+
+    ALPHA = 0.3
+    WINDOW = 128
+    MIN_SAMPLES = 10
+
+    def __init__(self, base_uri):
+        self.base_uri = base_uri
+        self.latency = None
+        self.samples = collections.deque(maxlen=self.WINDOW)
+        self.failures = 0
+        self.down_until = 0.0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Endpoint({!r})'.format(self.base_uri)
+
+    def ok(self, latency):
+        with self._lock:
+            self.samples.append(latency)
+            self.latency = latency if self.latency is None else \
+                self.ALPHA * latency + (1 - self.ALPHA) * self.latency
+            self.failures = 0
+            self.down_until = 0.0
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            self.down_until = time.time() + backoff_delay(self.failures,
+                                                          cap=30.0)
+
+    def available(self, now=None):
+        return self.down_until <= (now or time.time())
+
+    def percentile(self, percent):
+        '''Latency percentile of the recent requests, None until there are
+           enough samples.
+        '''
+        with self._lock:
+            if len(self.samples) < self.MIN_SAMPLES:
+                return None
+            samples = sorted(self.samples)
+
+        return samples[min(len(samples) - 1,
+                           int(len(samples) * percent / 100.0))]
+
+    def state(self):
+        with self._lock:
+            return {'latency': self.latency, 'samples': list(self.samples),
+                    'failures': self.failures, 'down_until': self.down_until}
+
+    def restore(self, state):
+        with self._lock:
+            self.latency = state.get('latency')
+            self.samples.extend(state.get('samples') or ())
+            self.failures = state.get('failures') or 0
+            self.down_until = state.get('down_until') or 0.0
+
+
+class EndpointStats(object):
+    '''Endpoint latency and failures kept on disk between the runs, so that
+       a short lived process routes (and hedges) by the requests of the
+       previous ones. Stats are written at most every SAVE_INTERVAL seconds,
+       failure to read or write them is not fatal.
+    '''
+
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, endpoints, path=None):
+        uris = ' '.join(sorted(e.base_uri for e in endpoints))
+        digest = hashlib.sha1(uris.encode('utf-8')).hexdigest()
+        self.path = path or cache_path('endpoints',
+                                       '{}.json'.format(digest[:16]))
+        self.endpoints = endpoints
+        self.saved = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        for endpoint in self.endpoints:
+            if isinstance(data.get(endpoint.base_uri), dict):
+                endpoint.restore(data[endpoint.base_uri])
+
+    def save(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and self.saved is not None and \
+                    now - self.saved < self.SAVE_INTERVAL:
+                return
+            self.saved = now
+
+        data = {e.base_uri: e.state() for e in self.endpoints}
+        try:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.endpoints')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except (IOError, OSError) as e:
+            log.debug('cannot save endpoint stats: %s', e)
+
+
+class HTTPClient(consul.std.HTTPClient):
+    '''Consul HTTP client which funnels all requests through request(),
+       supports request timeouts and an optional response cache. Given
+       a session it's used instead of the own one and left as it is.
+
+       Given several servers requests are routed to the fastest available
+       one, failed reads are retried on the next one (the same one given a
+       single server, unless it timed out) within the request timeout and
+       with hedge (a latency percentile) a duplicate read
+       is sent to the next server once the request takes longer than that
+       percentile of recent ones. Latencies of several servers are kept
+       between the runs (see EndpointStats).
+    '''
+
+    CHUNK_SIZE = 64 * 1024
+
+    # retries of failed reads, each one goes to the next server
+    RETRIES = 2
+    RETRY_DELAY = 0.05
+    # encodings read() decompresses, others (e.g. br) aren't negotiated
+    HEADERS = {'Accept-Encoding': 'gzip, deflate'}
+
+    def __init__(self, *args, timeout=None, cache=None, session=None,
+                 servers=None, hedge=None, **kwargs):
+        super(HTTPClient, self).__init__(*args, **kwargs)
+        self.shared_session = session is not None
+        if self.shared_session:
+            self.session = session
+        self.timeout = timeout
+        self.cache = cache
+        self.hedge = hedge
+        self.endpoints = [Endpoint(uri) for uri in
+                          dict.fromkeys([self.base_uri] + list(servers or ()))]
+        self.stats = None
+        if len(self.endpoints) > 1:
+            self.stats = EndpointStats(self.endpoints)
+            self.stats.load()
+        self.local = threading.local()
+        self.pool_maxsize = requests.adapters.DEFAULT_POOLSIZE
+        self._lock = threading.Lock()
+
+    def pool_size(self, size):
+        '''Allows the session to keep size connections to the server,
+           the pool is only ever grown.
+        '''
+        with self._lock:
+            if self.shared_session or size <= self.pool_maxsize:
+                return
+
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=size)
+            for prefix in ('http://', 'https://'):
+                self.session.mount(prefix, adapter)
+            self.pool_maxsize = size
+
+    @contextmanager
+    def timeout_scope(self, timeout):
+        '''Override request timeout for the calls of the current thread
+        '''
+        previous = getattr(self.local, 'timeout', None)
+        self.local.timeout = timeout
+        try:
+            yield
+        finally:
+            self.local.timeout = previous
+
+    @property
+    def request_timeout(self):
+        return getattr(self.local, 'timeout', None) or self.timeout
+
+    def request(self, method, callback, path, params=None, data=None):
+        uri = self.uri(path, params)
+        blocking = self.blocking(params)
+        if not self.cacheable(method, params):
+            return self.decode(callback, path,
+                               self.send(method, uri, data, blocking=blocking))
+
+        fresh, cached = self.cache.lookup(uri)
+        if fresh:
+            return self.decode(callback, path, fresh)
+
+        try:
+            response = self.send(method, uri, data, blocking=blocking)
+        except requests.exceptions.RequestException as e:
+            response = self.cache.fallback(uri, cached, e)
+            if response is None:
+                raise
+            return self.decode(callback, path, response)
+
+        # agent is up, but it can't serve the request (e.g. no leader)
+        if response.code >= 500:
+            response = self.cache.fallback(uri, cached, response.body) \
+                       or response
+        elif response.code == 200:
+            self.cache.put(uri, response)
+
+        return self.decode(callback, path, response)
+
+    def stream(self, path, params=None, key=None):
+        '''Request JSON array (or the array under key of JSON object) and
+           return iterator decoding its entries incrementally off the wire.
+           The request is performed and its status checked right away,
+           streamed responses bypass the response cache.
+        '''
+        uri = self.uri(path, params)
+        response = self.route('GET', uri, stream=True)
+        if response.status_code != 200:
+            with closing(response):
+                consul.base.CB._status(self.response(response),
+                                       allow_404=False)
+
+        response.encoding = 'utf-8'
+        return self._iter_stream(response, key)
+
+    def _iter_stream(self, response, key):
+        with closing(response):
+            chunks = response.iter_content(chunk_size=self.CHUNK_SIZE,
+                                           decode_unicode=True)
+            for item in iter_array(chunks, key=key):
+                yield item
+
+    def send(self, method, uri, data=None, blocking=False):
+        return self.response(self.route(method, uri, data, blocking=blocking))
+
+    def route(self, method, uri, data=None, blocking=False, stream=False):
+        '''Send request to the best endpoint, reads which fail (or get 5xx)
+           are retried on the next endpoints (round robin) with a jittered
+           backoff. An endpoint which timed out isn't retried and all of the
+           attempts share the request timeout. Blocking requests are neither
+           hedged nor counted in the endpoint latency.
+        '''
+        endpoints = self.ranked()
+        retries = self.RETRIES if method == 'GET' else 0
+        timeout = self.request_timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        hedge = not blocking and self.hedge and method == 'GET' and \
+            not stream
+
+        # the outcome of the latest attempt, an exception or a 5xx response
+        failure = None
+        timed_out = set()
+        for attempt in range(retries + 1):
+            endpoint = endpoints[attempt % len(endpoints)]
+            if attempt:
+                if endpoint in timed_out:
+                    break
+                delay = backoff_delay(attempt, base=self.RETRY_DELAY, cap=1.0)
+                if deadline is not None and \
+                        time.monotonic() + delay >= deadline:
+                    break
+                time.sleep(delay)
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+
+            hedged = hedge and len(endpoints) > attempt + 1
+            try:
+                if hedged:
+                    # records the endpoints which timed out itself
+                    response = self.hedged(endpoint, endpoints[attempt + 1],
+                                           method, uri, data, timeout,
+                                           timed_out)
+                else:
+                    response = self.dispatch(endpoint, method, uri, data,
+                                             timeout, stream, blocking)
+            except requests.exceptions.Timeout as e:
+                if not hedged:
+                    timed_out.add(endpoint)
+                failure = self._replace(failure, e)
+                continue
+            except requests.exceptions.RequestException as e:
+                failure = self._replace(failure, e)
+                continue
+
+            if response.status_code < 500:
+                self._replace(failure, None)
+                return response
+            failure = self._replace(failure, response)
+
+        if isinstance(failure, Exception):
+            raise failure
+        return failure
+
+    @staticmethod
+    def _replace(failure, outcome):
+        '''Close the previous failed response, returns the new outcome
+        '''
+        if failure is not None and not isinstance(failure, Exception):
+            failure.close()
+        return outcome
+
+    def ranked(self):
+        '''Endpoints ordered by preference: available ones by their latency
+           (not yet measured ones after them in the given order), then the
+           unavailable ones by their recovery.
+        '''
+        if len(self.endpoints) == 1:
+            return self.endpoints
+
+        now = time.time()
+        return sorted(self.endpoints, key=lambda e: (
+            not e.available(now),
+            e.down_until if not e.available(now) else
+            (e.latency is None, e.latency or 0.0)))
+
+    def dispatch(self, endpoint, method, uri, data, timeout, stream=False,
+                 blocking=False):
+        '''Send request to the endpoint updating its stats, blocking requests
+           only count as failures (they wait for changes, not the server)
+        '''
+        uri = endpoint.base_uri + uri[len(self.base_uri):]
+        name = method + ' ' + uri.split('?', 1)[0][len(endpoint.base_uri):]
+        started = time.perf_counter()
+        with Timings.span('http', name, stream=stream) as attrs:
+            if len(self.endpoints) > 1:
+                attrs['server'] = endpoint.base_uri
+            try:
+                response = self.session.request(method, uri, data=data,
+                                                headers=self.HEADERS,
+                                                verify=self.verify,
+                                                cert=self.cert,
+                                                timeout=timeout,
+                                                stream=True)
+                if not stream:
+                    attrs['wire_size'] = self.read(response, name)
+            except requests.exceptions.RequestException:
+                endpoint.failed()
+                self.save_stats()
+                raise
+
+            attrs['code'] = response.status_code
+            attrs['index'] = response.headers.get('X-Consul-Index')
+            if not stream:
+                attrs['size'] = len(response.content)
+
+        if response.status_code >= 500:
+            endpoint.failed()
+        elif not blocking:
+            endpoint.ok(time.perf_counter() - started)
+        self.save_stats()
+        return response
+
+    def save_stats(self):
+        if self.stats is not None:
+            self.stats.save()
+
+    @staticmethod
+    def read(response, name):
+        '''Read the body as it was sent and decompress it, so that the time
+           spent decompressing is measured. Returns the number of bytes read.
+        '''
+        try:
+            raw = response.raw.read(decode_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            response.close()
+            raise requests.exceptions.ConnectionError(e, response=response)
+
+        body = raw
+        encoding = response.headers.get('Content-Encoding', '').lower()
+        if raw and encoding in ('gzip', 'deflate'):
+            with Timings.span('decompress', name, size=len(raw)) as attrs:
+                try:
+                    # gzip or zlib header, some servers send raw deflate
+                    body = zlib.decompress(raw, zlib.MAX_WBITS | 32)
+                except zlib.error:
+                    try:
+                        body = zlib.decompress(raw, -zlib.MAX_WBITS)
+                    except zlib.error as e:
+                        response.close()
+                        raise requests.exceptions.ContentDecodingError(
+                            e, response=response)
+                attrs['decompressed'] = len(body)
+
+        # the whole body is consumed, close() returns the connection
+        response._content = body
+        response._content_consumed = True
+        response.close()
+        return len(raw)
+
+    def hedged(self, primary, secondary, method, uri, data, timeout,
+               timed_out=None):
+        '''Send request to the primary endpoint and if it's not done within
+           the hedge percentile of its latency also to the secondary one.
+           The first successful response wins. Requests are sent by daemon
+           threads, so that the losing one doesn't hold the process exit.
+           Endpoints whose received outcome is a timeout are added to the
+           timed_out set.
+        '''
+        timed_out = set() if timed_out is None else timed_out
+        delay = primary.percentile(self.hedge)
+        if delay is None:
+            try:
+                return self.dispatch(primary, method, uri, data, timeout)
+            except requests.exceptions.Timeout:
+                timed_out.add(primary)
+                raise
+
+        outcomes = queue.Queue()
+
+        def send(endpoint):
+            try:
+                outcomes.put((endpoint, self.dispatch(endpoint, method, uri,
+                                                      data, timeout)))
+            except requests.exceptions.RequestException as e:
+                outcomes.put((endpoint, e))
+
+        def start(endpoint):
+            threading.Thread(target=send, args=(endpoint,),
+                             name='counsel-hedge', daemon=True).start()
+
+        start(primary)
+        sent = 1
+        try:
+            endpoint, outcome = outcomes.get(timeout=delay)
+        except queue.Empty:
+            start(secondary)
+            sent += 1
+            endpoint, outcome = outcomes.get()
+
+        received = 1
+        while True:
+            if isinstance(outcome, requests.exceptions.Timeout):
+                timed_out.add(endpoint)
+            elif not isinstance(outcome, Exception) and \
+                    outcome.status_code < 500:
+                break
+            if received == sent:
+                break
+            endpoint, outcome = outcomes.get()
+            received += 1
+
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    @staticmethod
+    def decode(callback, path, response):
+        '''Invoke the API callback (status check and JSON decoding)
+        '''
+        with Timings.span('decode', path, size=len(response.body or '')):
+            return callback(response)
+
+    def cacheable(self, method, params):
+        '''Only plain reads are cached, blocking queries are never.
+        '''
+        if not self.cache or method != 'GET':
+            return False
+
+        return not self.blocking(params)
+
+    @staticmethod
+    def blocking(params):
+        return any(k == 'index' for k, _ in params or ())
+
+    def get(self, callback, path, params=None):
+        return self.request('GET', callback, path, params)
+
+    def put(self, callback, path, params=None, data=''):
+        return self.request('PUT', callback, path, params, data)
+
+    def delete(self, callback, path, params=None):
+        return self.request('DELETE', callback, path, params)
+
+    def post(self, callback, path, params=None, data=''):
+        return self.request('POST', callback, path, params, data)
+
+
+class Consul(consul.std.Consul):
+    '''Consul API client using counsel HTTPClient
+    '''
+
+    def __init__(self, *args, timeout=None, cache=None, session=None,
+                 servers=None, hedge=None, **kwargs):
+        self.timeout = timeout
+        self.cache = cache
+        self.session = session
+        self.servers = servers
+        self.hedge = hedge
+        super(Consul, self).__init__(*args, **kwargs)
+
+    def connect(self, host, port, scheme, verify=True, cert=None):
+        return HTTPClient(host, port, scheme, verify, cert,
+                          timeout=self.timeout, cache=self.cache,
+                          session=self.session, servers=self.servers,
+                          hedge=self.hedge)
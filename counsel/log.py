@@ -10,15 +10,21 @@ class OutputFormatter(logging.Formatter):
         fmt = '[{levelname}] {message}'.format(**args)
         return fmt % record.args
 
-## Use root logger. Since a child handler is created with a level
-# (different from NOTSET) it will effectively process message with
-# with eaqual or higher priorities
+## Counsel logger, the console handler is only attached by the CLI
+# (see attach_console), so that embedding applications control where
+# counsel messages go.
 #
 # To silience logging set console.setLevel(60) (which is more than critical)
 #
 
-log = logging.getLogger()
+log = logging.getLogger('counsel')
 console = logging.StreamHandler()
 console.setLevel(logging.WARN)
 console.setFormatter(OutputFormatter())
-log.addHandler(console)
+
+
+def attach_console():
+    '''Send counsel messages to stderr
+    '''
+    if console not in log.handlers:
+        log.addHandler(console)
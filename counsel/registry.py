@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from counsel.log import log
+from counsel.helpers import cache_path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class QueryRegistry(object):
+    '''Persistent registry of counsel prepared queries.
+
+       Maps a query uniqname to its consul ID and usage times, so that
+       prepared queries survive the process and get reused by subsequent
+       invocations. Stale queries are garbage collected by TTL and LRU.
+
+       Changes are made under a lock of the registry file which is read
+       again first, so that concurrent processes keep each other's entries.
+    '''
+
+    TTL = 24 * 3600
+    MAX_ENTRIES = 256
+    GC_INTERVAL = 3600
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path, ttl=TTL, max_entries=MAX_ENTRIES,
+                 gc_interval=GC_INTERVAL):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.gc_interval = gc_interval
+        self._lock = threading.RLock()
+        self._data = None
+
+    @classmethod
+    def open(cls, base_uri):
+        '''Returns registry shared by all queries of the given consul server.
+        '''
+        with cls._instances_lock:
+            if base_uri not in cls._instances:
+                digest = hashlib.sha1(base_uri.encode('utf-8')).hexdigest()
+                path = cache_path('queries', '{}.json'.format(digest[:16]))
+                cls._instances[base_uri] = cls(path)
+
+            return cls._instances[base_uri]
+
+    @property
+    def data(self):
+        with self._lock:
+            if self._data is None:
+                self._data = self._read()
+            return self._data
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            data.setdefault('queries', {})
+            return data
+        except (IOError, OSError, ValueError):
+            return {'gc': 0, 'queries': {}}
+
+    def save(self):
+        '''Atomically write the registry to disk.
+           Failure to persist is not fatal, the registry then only lives in-mem.
+        '''
+        with self._lock:
+            try:
+                directory = os.path.dirname(self.path)
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=directory, prefix='.queries')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.data, f)
+                os.replace(tmp, self.path)
+            except (IOError, OSError) as e:
+                log.warning('cannot save query registry: %s', e)
+
+    def _flock(self):
+        '''Returns descriptor of the locked registry lock file, None if it
+           can't be locked
+        '''
+        if fcntl is None:
+            return None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        except (IOError, OSError):
+            return None
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except (IOError, OSError):
+            os.close(fd)
+            return None
+        return fd
+
+    @contextmanager
+    def update(self):
+        '''Yields the registry data read again under the file lock and saves
+           it afterwards. Without the lock the in-mem data is changed.
+        '''
+        with self._lock:
+            fd = self._flock()
+            try:
+                if fd is not None:
+                    self._data = self._read()
+                yield self.data
+                self.save()
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+    def get(self, uniqname):
+        '''Returns registered query entry and marks it as recently used.
+           The entry ID is None for queries only known to exist by name.
+        '''
+        with self.update() as data:
+            entry = data['queries'].get(uniqname)
+            if entry:
+                entry['used'] = time.time()
+            return entry
+
+    def add(self, uniqname, query_id=None):
+        '''Register query or mark it as recently used.
+        '''
+        with self.update() as data:
+            now = time.time()
+            entry = data['queries'].setdefault(uniqname, {'created': now})
+            entry['id'] = query_id or entry.get('id')
+            entry['used'] = now
+            return entry
+
+    def remove(self, uniqname):
+        with self.update() as data:
+            return data['queries'].pop(uniqname, None)
+
+    def expired(self, now=None):
+        '''List (uniqname, entry) pairs which are not used longer than TTL
+           or fall out of the MAX_ENTRIES most recently used ones.
+        '''
+        now = now or time.time()
+        with self._lock:
+            lru = sorted(self.data['queries'].items(),
+                         key=lambda item: item[1]['used'], reverse=True)
+
+        return [
+            (uniqname, entry) for pos, (uniqname, entry) in enumerate(lru)
+            if pos >= self.max_entries or now - entry['used'] > self.ttl
+        ]
+
+    def gc_due(self):
+        return time.time() - self.data.get('gc', 0) > self.gc_interval
+
+    def claim_gc(self):
+        '''Returns True if garbage collection is due and claims the run,
+           so that concurrent callers don't start another one.
+        '''
+        with self._lock:
+            if not self.gc_due():
+                return False
+            with self.update() as data:
+                if not self.gc_due():
+                    return False
+                data['gc'] = time.time()
+                return True
+
+    def gc(self, delete, resolve, errors=()):
+        '''Delete expired queries, delete is invoked with the query ID.
+           IDs of queries registered by name only are looked up with
+           resolve, which returns a name to ID mapping. Given errors raised
+           by delete or resolve are logged, the queries are then kept for
+           the next run.
+        '''
+        with self.update() as data:
+            data['gc'] = time.time()
+
+        expired = self.expired()
+        if any(entry['id'] is None for _, entry in expired):
+            try:
+                index = resolve()
+            except errors as e:
+                log.warning('cannot list stale queries: %s', e)
+                expired = [(uniqname, entry) for uniqname, entry in expired
+                           if entry['id']]
+            else:
+                for uniqname, entry in expired:
+                    entry['id'] = entry['id'] or index.get(uniqname)
+
+        for uniqname, entry in expired:
+            try:
+                if entry['id']:
+                    delete(entry['id'])
+                    log.info('removed stale query %s', uniqname)
+            except errors as e:
+                log.warning('cannot remove stale query %s: %s', uniqname, e)
+                continue
+            self.remove(uniqname)
+
+    def gc_async(self, delete, resolve, errors=()):
+        '''Run garbage collection in a background thread if it's due.
+           The thread is not daemonic, so it completes before the exit.
+        '''
+        if not self.claim_gc():
+            return None
+
+        thread = threading.Thread(target=self.gc,
+                                  args=(delete, resolve, errors),
+                                  name='counsel-registry-gc')
+        thread.start()
+        return thread
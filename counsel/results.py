@@ -1,10 +1,22 @@
+import io
+import os
+import re
+import csv
+import sys
 import json
-import jinja2
-import inspect
+import time
+import hashlib
+import operator
+import textwrap
+import itertools
+import threading
+import collections
 
 import counsel.jinja_filters
 
 from counsel.log import log
+from counsel.timings import Timings
+from counsel.helpers import cache_path
 
 
 class Render(object):
@@ -25,19 +37,45 @@ class Render(object):
         '''
 
         if isinstance(data, list):
-            combined = []
-            for context in data:
-                rendered = self._render(context, **kwargs)
-                if rendered:
-                    combined.append(rendered)
-            return combined
+            return list(self.iter_render(data, **kwargs))
 
         elif isinstance(data, dict):
-            return self._render(data, **kwargs)
+            with Timings.span('render', self.__class__.__name__, count=1):
+                return self._render(data, **kwargs)
         else:
             raise Render.Error("Expects dict or list, %s provided" %
                                type(self))
 
+    def iter_render(self, data, **kwargs):
+        '''Lazily invokes _render method for each object of the iterable
+        '''
+        if Timings.enabled():
+            return self._timed_iter_render(data, **kwargs)
+        return self._iter_render(data, **kwargs)
+
+    def _iter_render(self, data, **kwargs):
+        for context in data:
+            rendered = self._render(context, **kwargs)
+            if rendered:
+                yield rendered
+
+    def _timed_iter_render(self, data, **kwargs):
+        '''iter_render recording the time spent rendering (only)
+        '''
+        duration = 0.0
+        count = 0
+        try:
+            for context in data:
+                started = time.perf_counter()
+                rendered = self._render(context, **kwargs)
+                duration += time.perf_counter() - started
+                count += 1
+                if rendered:
+                    yield rendered
+        finally:
+            Timings.record('render', self.__class__.__name__, duration,
+                           count=count)
+
     def _render(self, data, **kwargs):
         '''Invokes render_method
         '''
@@ -52,70 +90,723 @@ class Render(object):
 
 class JinjaRender(Render):
     '''Renders template for an object or a collection of objects.
-       Each object is used as the Jinja context.
+       Each object is used as the Jinja context. Jinja is imported on demand,
+       so that commands without filters don't pay for it.
+
+       Templates are compiled by the shared environment, which keeps an
+       in-process LRU of compiled templates and an on-disk bytecode cache
+       keyed by the template hash.
     '''
 
+    CACHE_SIZE = 128
+
+    _environment = None
+    _sources = {}
+    _lock = threading.RLock()
+
     def __init__(self, template):
         self.template = template
+        self.compiled = JinjaRender.get_template(template)
 
-        render_method = JinjaRender.get_render_method(template)
-        super(self.__class__, self).__init__(render_method)
+        render_method = self.compiled.render if self.compiled else None
+        super(JinjaRender, self).__init__(render_method)
 
     @staticmethod
-    def get_render_method(template):
-        '''Make template with custom filters preloaded
+    def create(template):
+        '''Returns the fastest render capable of rendering the template
         '''
+        paths = PathRender.parse(template)
+        if paths:
+            return PathRender(template, *paths)
+
+        return JinjaRender(template)
+
+    @classmethod
+    def environment(cls):
+        '''Make environment with custom filters preloaded
+        '''
+        with cls._lock:
+            if cls._environment is None:
+                import inspect
+                import jinja2
+
+                jinja = jinja2.Environment(
+                    loader=jinja2.FunctionLoader(cls._sources.get),
+                    bytecode_cache=cls.bytecode_cache(),
+                    cache_size=cls.CACHE_SIZE,
+                    auto_reload=False)
+
+                filter_functions = inspect.getmembers(counsel.jinja_filters,
+                                                      inspect.isfunction)
+                for func_name, func in filter_functions:
+                    jinja.filters[func_name] = func
+
+                cls._environment = jinja
+
+            return cls._environment
+
+    @staticmethod
+    def bytecode_cache():
+        import jinja2
+
+        directory = cache_path('jinja')
         try:
-            render_method = None
-            jinja = jinja2.Environment()
-            filter_functions = inspect.getmembers(counsel.jinja_filters,
-                                                  inspect.isfunction)
-            for func_name, func in filter_functions:
-                jinja.filters[func_name] = func
+            os.makedirs(directory, exist_ok=True)
+            return jinja2.FileSystemBytecodeCache(directory)
+        except OSError as e:
+            log.warning('jinja bytecode cache disabled: %s', e)
+
+    @classmethod
+    def compile(cls, template):
+        '''Returns compiled template, templates are named by their hash.
+           The loader gets the source only while it's being looked up, so
+           sources aren't kept beyond the LRU.
+        '''
+        name = hashlib.sha256(template.encode('utf-8')).hexdigest()
+        with cls._lock:
+            cls._sources[name] = template
+            try:
+                return cls.environment().get_template(name)
+            finally:
+                del cls._sources[name]
 
-            render_method = jinja.from_string(template).render
+    @staticmethod
+    def get_template(template):
+        '''Make template with custom filters preloaded
+        '''
+        import jinja2
+
+        try:
+            return JinjaRender.compile(template)
 
         except jinja2.exceptions.TemplateSyntaxError as e:
             log.error('jinja2 syntax error: %s', e)
 
-        return render_method
+    @staticmethod
+    def get_render_method(template):
+        compiled = JinjaRender.get_template(template)
+        return compiled.render if compiled else None
+
+    @classmethod
+    def variables(cls, data, **kwargs):
+        '''Build Jinja context variables for data, these can be shared
+           by several templates rendered for the same data.
+        '''
+        variables = dict(cls.environment().globals)
+        variables.update(data, **kwargs)
+        return variables
+
+    def render_shared(self, variables):
+        '''Render template using prebuilt context variables
+        '''
+        context = self.compiled.new_context(variables, shared=True)
+        try:
+            return self.compiled.environment.concat(
+                self.compiled.root_render_func(context))
+        except Exception:
+            self.compiled.environment.handle_exception()
+
+
+class PathRender(JinjaRender):
+    '''Renders templates which are plain attribute paths such as
+       {{ Node.Address }} or tuples of them {{ Node.Address, Service.Port }}
+       by looking the values up directly, bypassing Jinja.
+
+       Paths are resolved the way Jinja does for JSON data, entries which
+       can't be resolved (e.g. missing keys) are rendered by Jinja.
+    '''
+
+    PATH = r'[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*'
+    TEMPLATE = re.compile(
+        r'\A\{\{\s*(%s(?:\s*,\s*%s)*)\s*(,?)\s*\}\}\Z' % (PATH, PATH))
+
+    # names which Jinja doesn't resolve as plain dict keys
+    RESERVED = frozenset(dir(dict)) | frozenset((
+        'true', 'false', 'none', 'True', 'False', 'None'))
+
+    def __init__(self, template, paths, as_tuple):
+        self.template = template
+        self.paths = paths
+        self.getters = [self.getter(path) for path in paths]
+        self.as_tuple = as_tuple
+        self._fallback = None
+        Render.__init__(self, self.render_path)
+
+    @classmethod
+    def parse(cls, template):
+        '''Returns (paths, as_tuple) if template is pure paths or None
+        '''
+        match = cls.TEMPLATE.match(template)
+        if not match:
+            return None
+
+        paths = [
+            tuple(path.strip().split('.'))
+            for path in match.group(1).split(',')
+        ]
+        if any(key in cls.RESERVED for path in paths for key in path):
+            return None
+
+        return paths, len(paths) > 1 or bool(match.group(2))
+
+    @staticmethod
+    def getter(path):
+        '''Returns item-getter chain for the path. Non-dict JSON values
+           raise TypeError on a key lookup, just like dicts raise KeyError.
+        '''
+        getters = [operator.itemgetter(key) for key in path]
+        if len(getters) == 1:
+            return getters[0]
+
+        def get(data):
+            for item in getters:
+                data = item(data)
+            return data
+        return get
+
+    def render_path(self, data, **kwargs):
+        try:
+            if self.as_tuple:
+                value = tuple(get(data) for get in self.getters)
+            else:
+                value = self.getters[0](data)
+        except (KeyError, TypeError):
+            return self.fallback(data, **kwargs)
+
+        return value if value.__class__ is str else str(value)
+
+    def fallback(self, data, **kwargs):
+        if self._fallback is None:
+            self._fallback = JinjaRender.get_render_method(self.template)
+        return self._fallback(data, **kwargs)
+
+
+class ColumnRender(Render):
+    '''Renders several templates in a single pass over the data. Each object
+       produces a row with a column per template, the Jinja context is built
+       once per object and shared by all of the templates.
+    '''
+
+    def __init__(self, templates):
+        self.templates = templates
+        self.renders = [JinjaRender.create(t) for t in templates]
+
+        if not all(render.render_method for render in self.renders):
+            super(ColumnRender, self).__init__()
+        else:
+            super(ColumnRender, self).__init__(self.render_row)
+
+    def render_row(self, data, **kwargs):
+        variables = None
+        row = []
+        for render in self.renders:
+            try:
+                if isinstance(render, PathRender):
+                    row.append(render.render_path(data, **kwargs))
+                    continue
+
+                if variables is None:
+                    variables = JinjaRender.variables(data, **kwargs)
+                row.append(render.render_shared(variables))
+
+            except Exception as e:
+                log.error('render failed: %s', e)
+                row.append('')
+
+        return row if any(row) else None
+
+
+class ParallelRender(Render):
+    '''Renders the entries in chunks by a pool of worker processes, output
+       order is preserved. Templates are sent to the workers once, each of
+       them compiles them (from the shared bytecode cache) when it starts.
+       Fewer entries than threshold are rendered serially, as starting the
+       pool wouldn't pay off.
+    '''
+
+    THRESHOLD = 5000
+    CHUNK_SIZE = 500
+
+    # render of the worker process
+    _worker = None
+
+    def __init__(self, template, jobs=None, threshold=THRESHOLD,
+                 chunk_size=CHUNK_SIZE):
+        self.template = template
+        self.jobs = jobs or os.cpu_count() or 1
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.serial = self.create(template)
+        super(ParallelRender, self).__init__(self.serial.render_method)
+
+    @staticmethod
+    def create(template):
+        '''Returns render of the template, a list of templates is rendered
+           into rows
+        '''
+        if isinstance(template, (list, tuple)):
+            return ColumnRender(template)
+        return JinjaRender.create(template)
+
+    @classmethod
+    def init_worker(cls, template):
+        cls._worker = cls.create(template)
+
+    @classmethod
+    def render_chunk(cls, chunk):
+        return list(cls._worker._iter_render(chunk))
+
+    def iter_render(self, data, **kwargs):
+        data = iter(data)
+        head = list(itertools.islice(data, self.threshold))
+        if self.jobs < 2 or len(head) < self.threshold or kwargs or \
+                not self.render_method:
+            return self.serial.iter_render(itertools.chain(head, data),
+                                           **kwargs)
+
+        return self._parallel_render(itertools.chain(head, data))
+
+    def chunks(self, data):
+        while True:
+            chunk = list(itertools.islice(data, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _parallel_render(self, data):
+        '''Yields rendered entries, at most two chunks per worker are in
+           flight, so that streamed data is consumed as it's rendered.
+        '''
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # workers aren't forked from the caller, which may be the
+        # multi-threaded daemon (forking it could deadlock the workers)
+        context = None
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+
+        chunks = self.chunks(data)
+        first = next(chunks)
+        try:
+            pool = ProcessPoolExecutor(max_workers=self.jobs,
+                                       mp_context=context,
+                                       initializer=self.init_worker,
+                                       initargs=(self.template,))
+            pending = collections.deque([pool.submit(self.render_chunk,
+                                                     first)])
+        except OSError as e:
+            log.warning('parallel render disabled: %s', e)
+            yield from self.serial.iter_render(itertools.chain(first, data))
+            return
+
+        # time spent waiting for the workers, not for the consumer
+        duration = 0.0
+        count = len(first)
+        try:
+            for chunk in chunks:
+                pending.append(pool.submit(self.render_chunk, chunk))
+                count += len(chunk)
+                if len(pending) > 2 * self.jobs:
+                    started = time.perf_counter()
+                    rendered = pending.popleft().result()
+                    duration += time.perf_counter() - started
+                    yield from rendered
+
+            while pending:
+                started = time.perf_counter()
+                rendered = pending.popleft().result()
+                duration += time.perf_counter() - started
+                yield from rendered
+        finally:
+            pool.shutdown(cancel_futures=True)
+            if Timings.enabled():
+                Timings.record('render', self.__class__.__name__, duration,
+                               count=count, jobs=self.jobs)
+
+
+class TagMap(dict):
+    '''Service tags split into key:value pairs (at the first colon), tags
+       without a colon map to an empty string.
+    '''
+
+    @classmethod
+    def parse(cls, entry):
+        tags = (entry.get('Service') or {}).get('Tags') or ()
+        return cls(tag.partition(':')[::2] for tag in tags)
+
+
+class Projection(object):
+    '''Projects entries onto the keys referenced by templates, so that only
+       the data which is rendered is kept. Keys are found by walking the
+       template AST for attribute and constant item lookups on the context
+       variables; a variable used otherwise (e.g. passed to a filter or
+       iterated over) is kept whole.
+
+       tree maps keys to their subtrees, True meaning the whole value, None
+       keeps entries whole. Given tagmap entries get their TagMap added
+       before they are projected.
+    '''
+
+    # attributes Jinja resolves as dict methods rather than keys
+    METHODS = frozenset(dir(dict))
+
+    def __init__(self, tree, tagmap=False):
+        self.tree = tree
+        self.tagmap = tagmap
+
+    def __call__(self, entry):
+        if self.tagmap:
+            entry['TagMap'] = TagMap.parse(entry)
+        if self.tree is None:
+            return entry
+        return self.project(entry, self.tree)
+
+    @classmethod
+    def create(cls, templates):
+        '''Returns projection for the template (or a list of them) or None
+           if the entries are used as they are.
+        '''
+        if isinstance(templates, str):
+            templates = [templates]
+
+        tree = {}
+        for template in templates:
+            try:
+                if not cls.analyse(template, tree):
+                    tree = None
+                    break
+            except Exception as e:
+                log.debug('template projection skipped: %s', e)
+                tree = None
+                break
+
+        tagmap = any('TagMap' in template for template in templates)
+        if tree is None and not tagmap:
+            return None
+        return cls(tree, tagmap)
+
+    @classmethod
+    def analyse(cls, template, tree):
+        '''Add keys referenced by the template to tree, returns False when
+           the template can use unknown data (includes, imports).
+        '''
+        from jinja2 import nodes
+
+        ast = JinjaRender.environment().parse(template)
+        if any(ast.find_all((nodes.Include, nodes.Import, nodes.FromImport,
+                             nodes.Extends))):
+            return False
+
+        # variables assigned by the template keep their context values whole
+        stored = {node.name for node in ast.find_all(nodes.Name)
+                  if node.ctx in ('store', 'param')}
+
+        def lookup(node):
+            '''Returns (name, keys) for a chain of lookups on a variable
+            '''
+            keys = []
+            while isinstance(node, (nodes.Getattr, nodes.Getitem)):
+                if isinstance(node, nodes.Getattr):
+                    key = node.attr
+                elif isinstance(node.arg, nodes.Const):
+                    key = node.arg.value
+                else:
+                    # dynamic lookup, the object is needed whole
+                    visit(node.arg)
+                    keys = []
+                    node = node.node
+                    continue
+
+                if isinstance(key, int):
+                    # list index, keys apply to the list items
+                    pass
+                elif not isinstance(key, str) or key in cls.METHODS:
+                    keys = []
+                else:
+                    keys.append(key)
+                node = node.node
+
+            if isinstance(node, nodes.Name):
+                return node.name, keys[::-1]
+            visit(node)
+            return None, None
+
+        def visit(node):
+            if isinstance(node, nodes.Call) and \
+                    isinstance(node.node, nodes.Getattr):
+                # method call, the object it's called on is needed whole
+                cls.add(tree, *lookup(node.node.node))
+                children = list(node.iter_child_nodes())[1:]
+            elif isinstance(node, (nodes.Name, nodes.Getattr, nodes.Getitem)):
+                name, keys = lookup(node)
+                if name in stored:
+                    keys = []
+                cls.add(tree, name, keys)
+                return
+            else:
+                children = node.iter_child_nodes()
+
+            for child in children:
+                visit(child)
+
+        visit(ast)
+        return True
+
+    @staticmethod
+    def add(tree, name, keys=None):
+        if name is None:
+            return
+
+        path = [name] + list(keys or ())
+        for key in path[:-1]:
+            subtree = tree.setdefault(key, {})
+            if subtree is True:
+                return
+            tree = subtree
+        tree[path[-1]] = True
+
+    @classmethod
+    def project(cls, value, tree):
+        if tree is True:
+            return value
+        if isinstance(value, dict):
+            return {
+                key: cls.project(value[key], subtree)
+                for key, subtree in tree.items() if key in value
+            }
+        if isinstance(value, list):
+            return [cls.project(item, tree) for item in value]
+        return value
 
 
 class Formatter(object):
+    '''Formats data for output. Lists and iterators are written entry by
+       entry as soon as each of them is available, so neither the data nor
+       its serialized copy has to be held in memory.
+
+       Compact formats are encoded by ENCODER (a name of an Encoders
+       method), by default by the fastest one installed.
+    '''
+
+    class Encoders(object):
+        '''Compact JSON encoders (no whitespace, non-ASCII characters are
+           kept as they are). Their output is the same except for floats,
+           orjson writes exponents as 1e100 and 1e-7 (json as 1e+100 and
+           1e-07) and NaN and Infinity as null.
+        '''
+
+        @staticmethod
+        def json(data, sort_keys=False):
+            return json.dumps(data, sort_keys=sort_keys, separators=(',', ':'),
+                              ensure_ascii=False)
+
+        @staticmethod
+        def orjson(data, sort_keys=False):
+            import orjson
+
+            try:
+                return orjson.dumps(
+                    data, option=orjson.OPT_SORT_KEYS if sort_keys else 0
+                ).decode('utf-8')
+            except TypeError:
+                # e.g. integers out of the 64-bit range
+                return Formatter.Encoders.json(data, sort_keys=sort_keys)
+
+    ENCODER = None
+
+    @classmethod
+    def encoder(cls):
+        '''Returns the compact JSON encoder
+        '''
+        if cls.ENCODER is None:
+            try:
+                import orjson  # noqa: F401
+                cls.ENCODER = 'orjson'
+            except ImportError:
+                cls.ENCODER = 'json'
+        return getattr(cls.Encoders, cls.ENCODER)
 
     class Base(object):
+        # output is bytes, written into the binary buffer of out
+        binary = False
+        terminator = '\n'
+
         @staticmethod
         def json(data, sort_keys=True, **kwargs):
             return json.dumps(data, sort_keys=sort_keys, **kwargs)
 
+        @staticmethod
+        def available():
+            return True
+
+        @classmethod
+        def line(cls, row):
+            '''Rows of multi-template renders are joined by space
+            '''
+            if isinstance(row, list):
+                return ' '.join(row)
+            return row if isinstance(row, str) else cls.json(row)
+
+        def stream(self, items, out):
+            '''Write entries of the iterable, by default the whole output
+               is formatted at once.
+            '''
+            items = list(items)
+            if items:
+                out.write(self.output(items) + '\n')
+
     class JSON(Base):
         def output(self, data):
             return self.json(data, indent=4)
 
+        def stream(self, items, out):
+            # produces exactly the same output as output() for the list
+            separator = '[\n'
+            for item in items:
+                out.write(separator)
+                out.write(textwrap.indent(self.json(item, indent=4), '    '))
+                separator = ',\n'
+
+            if separator != '[\n':
+                out.write('\n]\n')
+
+    class NDJSON(Base):
+        def output(self, data):
+            if isinstance(data, list):
+                return '\n'.join(map(self.json, data))
+            else:
+                return self.json(data)
+
+        def stream(self, items, out):
+            for item in items:
+                out.write(self.json(item) + '\n')
+                out.flush()
+
     class Oneline(Base):
         def output(self, data):
             if isinstance(data, list):
-                return ' '.join(data)
+                return ' '.join(map(self.line, data))
             else:
                 return self.json(data)
 
+        def stream(self, items, out):
+            separator = ''
+            for item in items:
+                out.write(separator + self.line(item))
+                separator = ' '
+
+            if separator:
+                out.write('\n')
+
     class Multiline(Base):
         def output(self, data):
             if isinstance(data, list):
-                res = "\n".join(data)
+                res = "\n".join(map(self.line, data))
                 return res
             else:
                 return self.json(data)
 
+        def stream(self, items, out):
+            for item in items:
+                out.write(self.line(item) + '\n')
+
+    class CSV(Base):
+        dialect = csv.excel
+
+        def output(self, data):
+            if not isinstance(data, list):
+                return self.json(data)
+
+            buf = io.StringIO()
+            self.stream(data, buf)
+            return buf.getvalue().rstrip('\n')
+
+        def stream(self, items, out):
+            writer = csv.writer(out, dialect=self.dialect, lineterminator='\n')
+            for row in items:
+                writer.writerow(row if isinstance(row, list) else [row])
+
+    class TSV(CSV):
+        dialect = csv.excel_tab
+
+    class CompactJSON(Base):
+        '''Single line JSON, keys are kept in the order Consul sent them
+        '''
+        def output(self, data):
+            return Formatter.encoder()(data)
+
+        def stream(self, items, out):
+            # produces exactly the same output as output() for the list
+            encode = Formatter.encoder()
+            separator = '['
+            for item in items:
+                out.write(separator + encode(item))
+                separator = ','
+
+            if separator != '[':
+                out.write(']\n')
+
+    class MsgPack(Base):
+        '''MessagePack objects, lists are written as a sequence of objects
+           (an object per entry) to be read by a streaming unpacker.
+        '''
+        binary = True
+        terminator = b''
+
+        def __init__(self):
+            import msgpack
+            self.packer = msgpack.Packer()
+
+        @staticmethod
+        def available():
+            try:
+                import msgpack  # noqa: F401
+                return True
+            except ImportError:
+                return False
+
+        def output(self, data):
+            if isinstance(data, list):
+                return b''.join(map(self.packer.pack, data))
+            return self.packer.pack(data)
+
+        def stream(self, items, out):
+            for item in items:
+                out.write(self.packer.pack(item))
+
     FACTORY = {
         'json': JSON,
+        'json-compact': CompactJSON,
+        'ndjson': NDJSON,
+        'msgpack': MsgPack,
         'oneline': Oneline,
-        'multiline': Multiline
+        'multiline': Multiline,
+        'csv': CSV,
+        'tsv': TSV
     }
 
-    def __init__(self, output_format):
+    def __init__(self, output_format, out=None):
         self.formatter = self.FACTORY[output_format]()
+        self.out = out or sys.stdout
+        if self.formatter.binary:
+            self.out = getattr(self.out, 'buffer', self.out)
+
+    def output(self, data, allow_empty=False):
+        if data or allow_empty:
+            with Timings.span('format', self.formatter.__class__.__name__):
+                self.out.write(self.formatter.output(data) +
+                               self.formatter.terminator)
+                self.out.flush()
+
+    def write(self, data):
+        '''Output data, lists and iterators are streamed entry by entry.
+           Timings of streamed output include producing the entries.
+        '''
+        if data is None or isinstance(data, dict):
+            return self.output(data)
 
-    def output(self, data):
-        if data:
-            print(self.formatter.output(data))
+        with Timings.span('format', self.formatter.__class__.__name__,
+                          stream=True):
+            self.formatter.stream(data, self.out)
+            self.out.flush()
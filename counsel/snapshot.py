@@ -0,0 +1,210 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import tempfile
+import itertools
+from collections import namedtuple
+
+from counsel.timings import Timings
+
+
+class Snapshot(object):
+    '''Memory-mapped snapshot of the catalog services health.
+
+       The file starts with the magic and the location of the header, the
+       header (JSON written after the data) maps service names to their
+       blocks. A block is the service entries encoded one by one, followed
+       by the packed entry bounds, the packed entry numbers of every tag
+       and the block meta (JSON). Looking up a service or a tag only decodes
+       the block meta and the entries returned.
+
+       Entries are deflated one by one with a preset dictionary made of the
+       first entries of the service. Entries of a service are alike, so they
+       compress well even on their own.
+    '''
+
+    MAGIC = b'CNSLSNP1'
+    PREFIX = struct.Struct('<8sQQ')
+    ZDICT_SIZE = 32768
+    COMPRESSLEVEL = 6
+
+    class Error(Exception): pass
+
+    class NotFound(Error): pass
+
+    class Block(namedtuple('Block', 'index data meta_offset meta_length')):
+        '''Encoded service: its entries, entry bounds, tag lists and meta.
+           Offsets inside of a block are relative to its start, so blocks are
+           copied between snapshots as they are.
+        '''
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            raise self.Error('cannot open snapshot {}: {}'.format(path, e))
+
+        try:
+            magic, offset, length = self.PREFIX.unpack_from(self.mm)
+            if magic != self.MAGIC:
+                raise ValueError('bad magic')
+            header = json.loads(self.mm[offset:offset + length].decode('utf-8'))
+        except (struct.error, ValueError) as e:
+            self.close()
+            raise self.Error('invalid snapshot {}: {}'.format(path, e))
+
+        self.info = header['info']
+        self.services = header['services']
+        self._meta = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, service):
+        return service in self.services
+
+    def close(self):
+        self.mm.close()
+
+    def index(self, service):
+        '''Consul index of the service, None if it isn't in the snapshot
+        '''
+        record = self.services.get(service)
+        return record and record[4]
+
+    def meta(self, service):
+        if service not in self._meta:
+            try:
+                offset, _, meta_offset, meta_length, _ = self.services[service]
+            except KeyError:
+                raise self.NotFound('service {} not in snapshot {}'.format(
+                    service, self.path))
+            start = offset + meta_offset
+            meta = json.loads(self.mm[start:start + meta_length].decode('utf-8'))
+            meta['offset'] = offset
+            self._meta[service] = meta
+        return self._meta[service]
+
+    def block(self, service):
+        offset, length, meta_offset, meta_length, index = \
+            self.services[service]
+        return self.Block(index, self.mm[offset:offset + length],
+                     meta_offset, meta_length)
+
+    def entries(self, service, tag=None):
+        '''Yields service entries, given tag only the entries having it
+        '''
+        meta = self.meta(service)
+        offset = meta['offset']
+        bounds = offset + meta['bounds']
+        if tag is None:
+            numbers = range(meta['count'])
+        else:
+            start, count = meta['tags'].get(tag, (0, 0))
+            numbers = struct.unpack_from('<{}I'.format(count), self.mm,
+                                         offset + start)
+
+        zdict = None
+        if 'zdict' in meta:
+            start, length = meta['zdict']
+            zdict = self.mm[offset + start:offset + start + length]
+
+        # decompression is timed as a whole, like rendering
+        timed = zdict is not None and Timings.enabled()
+        duration = 0.0
+        size = 0
+        try:
+            for number in numbers:
+                start, end = struct.unpack_from('<QQ', self.mm,
+                                                bounds + number * 8)
+                data = self.mm[offset + start:offset + end]
+                if zdict is not None:
+                    started = time.perf_counter() if timed else 0
+                    data = zlib.decompressobj(-zlib.MAX_WBITS,
+                                              zdict=zdict).decompress(data)
+                    if timed:
+                        duration += time.perf_counter() - started
+                        size += end - start
+                yield json.loads(data.decode('utf-8'))
+        finally:
+            if timed:
+                Timings.record('decompress', 'snapshot', duration, size=size)
+
+    @classmethod
+    def encode(cls, index, entries):
+        '''Encode service entries into a block
+        '''
+        encoded = ((entry, json.dumps(entry, separators=(',', ':')).encode(
+            'utf-8')) for entry in entries)
+
+        # the dictionary is made of the first entries
+        head = []
+        size = 0
+        for item in encoded:
+            head.append(item)
+            size += len(item[1])
+            if size >= cls.ZDICT_SIZE:
+                break
+        zdict = b''.join(item[1] for item in head)[-cls.ZDICT_SIZE:]
+        compressor = zlib.compressobj(cls.COMPRESSLEVEL, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS, zdict=zdict)
+
+        data = bytearray(zdict)
+        bounds = [len(data)]
+        tags = {}
+        for number, (entry, item) in enumerate(itertools.chain(head, encoded)):
+            compress = compressor.copy()
+            data += compress.compress(item) + compress.flush()
+            bounds.append(len(data))
+            for tag in (entry.get('Service') or {}).get('Tags') or ():
+                tags.setdefault(tag, []).append(number)
+
+        meta = {'count': len(bounds) - 1, 'bounds': len(data), 'tags': {},
+                'zdict': (0, len(zdict))}
+        data += struct.pack('<{}Q'.format(len(bounds)), *bounds)
+        for tag, numbers in tags.items():
+            meta['tags'][tag] = (len(data), len(numbers))
+            data += struct.pack('<{}I'.format(len(numbers)), *numbers)
+
+        meta_offset = len(data)
+        data += json.dumps(meta, separators=(',', ':')).encode('utf-8')
+        return cls.Block(index, bytes(data), meta_offset,
+                         len(data) - meta_offset)
+
+    @classmethod
+    def write(cls, path, blocks, **info):
+        '''Atomically write snapshot of (service, block) pairs, readers of
+           the replaced snapshot keep their mapping.
+        '''
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.snapshot')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b'\0' * cls.PREFIX.size)
+                services = {}
+                for service, block in blocks:
+                    offset = f.tell()
+                    f.write(block.data)
+                    services[service] = (offset, len(block.data),
+                                         block.meta_offset, block.meta_length,
+                                         block.index)
+
+                header = json.dumps({'info': info, 'services': services},
+                                    separators=(',', ':')).encode('utf-8')
+                offset = f.tell()
+                f.write(header)
+                f.seek(0)
+                f.write(cls.PREFIX.pack(cls.MAGIC, offset, len(header)))
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
@@ -0,0 +1,121 @@
+import json
+
+
+class JSONStream(object):
+    '''Incremental decoder of a JSON array arriving in text chunks.
+
+       Only the array elements are decoded as a whole (with the stdlib
+       raw_decode), so at most one element and a chunk are held in memory.
+    '''
+
+    WHITESPACE = ' \t\n\r'
+    NUMBER = '0123456789.eE+-'
+
+    class Error(ValueError): pass
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        '''Read the next chunk dropping the consumed part of the buffer
+        '''
+        for chunk in self.chunks:
+            if chunk:
+                self.buf = self.buf[self.pos:] + chunk
+                self.pos = 0
+                return True
+
+        self.eof = True
+        return False
+
+    def peek(self):
+        '''Returns the next non-whitespace character without consuming it
+        '''
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise self.Error('unexpected end of JSON stream')
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise self.Error('expected {!r} at {!r}'.format(
+                chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        '''Decode the next value, reading more chunks until it's complete.
+           A value ending right at the buffer end might be truncated
+           (e.g. a number), so it's decoded again once more data arrives,
+           so is a number followed by the start of its fraction or exponent
+           (e.g. 1. or 1e-).
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if self.eof or end < len(self.buf) and not (
+                        isinstance(value, (int, float)) and
+                        not self.buf[end:].lstrip(self.NUMBER)):
+                    self.pos = end
+                    return value
+
+            except ValueError:
+                if self.eof:
+                    raise
+
+            if not self.fill():
+                self.eof = True
+
+    def array(self):
+        '''Yields elements of the array starting at the current position
+        '''
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def member(self, key):
+        '''Position the stream at the value of key in the current object
+        '''
+        self.expect('{')
+        if self.peek() == '}':
+            raise self.Error('key {!r} not found'.format(key))
+
+        while True:
+            name = self.value()
+            self.expect(':')
+            if name == key:
+                return
+
+            # skip values of other keys, these are expected to be small
+            self.value()
+            if self.expect(',}') == '}':
+                raise self.Error('key {!r} not found'.format(key))
+
+
+def iter_array(chunks, key=None):
+    '''Yields elements of a JSON array decoded from text chunks. Given key
+       the array is the value of that key in the top level object.
+    '''
+    stream = JSONStream(chunks)
+    if key is not None:
+        stream.member(key)
+
+    for item in stream.array():
+        yield item
@@ -0,0 +1,109 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Timings(object):
+    '''Instrumentation of the request/render pipeline.
+
+       Events are dicts with kind (api, http, cache, decompress, decode,
+       render, format), name, duration_ms and kind specific attributes
+       (e.g. size, wire_size and index of http requests, result of cache
+       lookups). They are passed to the registered hooks, nothing is
+       measured while there are no hooks.
+    '''
+
+    hooks = []
+
+    @classmethod
+    def add_hook(cls, hook):
+        '''Register callable invoked with every event
+        '''
+        cls.hooks = cls.hooks + [hook]
+
+    @classmethod
+    def remove_hook(cls, hook):
+        cls.hooks = [h for h in cls.hooks if h is not hook]
+
+    @classmethod
+    def enabled(cls):
+        return bool(cls.hooks)
+
+    @classmethod
+    def record(cls, kind, name, duration, **attrs):
+        '''Emit event, duration is given in seconds
+        '''
+        event = dict(kind=kind, name=name,
+                     duration_ms=round(duration * 1000, 3), **attrs)
+        for hook in cls.hooks:
+            hook(event)
+
+    @classmethod
+    @contextmanager
+    def span(cls, kind, name, **attrs):
+        '''Time the block, attributes can be added to the yielded dict
+        '''
+        if not cls.hooks:
+            yield attrs
+            return
+
+        started = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            cls.record(kind, name, time.perf_counter() - started, **attrs)
+
+
+class Collector(object):
+    '''Timings hook collecting events, which are then summarized per kind
+       and name on stderr or dumped as JSON.
+    '''
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def aggregate(self):
+        '''Per kind and name count, total and max duration, total size and
+           size on the wire (compressed)
+        '''
+        groups = {}
+        for event in self.events:
+            group = groups.setdefault((event['kind'], event['name']), {
+                'kind': event['kind'],
+                'name': event['name'],
+                'count': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'size': 0,
+                'wire_size': 0
+            })
+            group['count'] += 1
+            group['total_ms'] += event['duration_ms']
+            group['max_ms'] = max(group['max_ms'], event['duration_ms'])
+            group['size'] += event.get('size') or 0
+            group['wire_size'] += event.get('wire_size') or 0
+
+        return list(groups.values())
+
+    def summary(self):
+        lines = ['{:<10} {:<48} {:>5} {:>10} {:>10} {:>10} {:>10}'.format(
+            'kind', 'name', 'count', 'total ms', 'max ms', 'bytes', 'wire')]
+        for group in self.aggregate():
+            lines.append('{kind:<10} {name:<48.48} {count:>5} '
+                         '{total_ms:>10.1f} {max_ms:>10.1f} {size:>10} '
+                         '{wire_size:>10}'.format(**group))
+        return '\n'.join(lines)
+
+    def json(self):
+        return json.dumps({'events': self.events,
+                           'summary': self.aggregate()})
+
+    def write(self, out, output_format='summary'):
+        out.write((self.json() if output_format == 'json'
+                   else self.summary()) + '\n')
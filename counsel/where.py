@@ -0,0 +1,287 @@
+import re
+import json
+
+
+class Where(object):
+    '''Predicate over API entries in the Consul filter expression syntax,
+       e.g. 'Service.Tags contains "class:pio" and Checks.Status == passing'.
+
+       The expression is sent to Consul as the server-side filter and is
+       compiled into match(), which evaluates it client-side for agents (or
+       endpoints) not supporting filtering. Supported are ==, !=, contains,
+       in, is empty, matches (and their negations), and, or, not and
+       parentheses. Selectors crossing lists match if any of the elements
+       does, like they do in Consul, so do ==, != and matches on list values
+       (e.g. Service.Tags).
+
+       server is the part of the expression sent to Consul, None if none of
+       it can be.
+    '''
+
+    class Error(ValueError): pass
+
+    TOKEN = re.compile(r'''
+        \s*(?:
+            (?P<paren>[()])
+          | (?P<op>==|!=)
+          | "(?P<string>(?:[^"\\]|\\.)*)"
+          | `(?P<raw>[^`]*)`
+          | (?P<word>[^\s()"`=!]+)
+        )''', re.VERBOSE)
+
+    KEYWORDS = frozenset(('and', 'or', 'not', 'in', 'contains', 'is',
+                          'empty', 'matches'))
+
+    def __init__(self, expression, server=False):
+        self.expression = expression
+        self.server = expression if server is False else server
+        self.tokens = self.tokenize(expression)
+        self.pos = 0
+        self.match = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise self.Error('unexpected {!r} in where expression'.format(
+                self.tokens[self.pos][1]))
+
+    @classmethod
+    def create(cls, where, tags=None):
+        '''Returns predicate for the expression, predicates and None are
+           returned as they are. Given tags (see tags()) the predicate also
+           requires entries to have them.
+        '''
+        if tags:
+            pushed, local = cls.tags(tags)
+            if where is not None:
+                pushed.insert(0, '({})'.format(
+                    getattr(where, 'expression', where)))
+            return cls(' and '.join(pushed + local),
+                       server=' and '.join(pushed) or None)
+
+        if where is None or isinstance(where, cls):
+            return where
+        return cls(where)
+
+    @classmethod
+    def tags(cls, tags):
+        '''Returns terms matching entries having all of the key:value service
+           tags given as key=value, a plain key matches any of its values.
+           Terms are split into the ones Consul evaluates and the local ones,
+           as Consul doesn't support matches on lists.
+        '''
+        pushed = []
+        local = []
+        for tag in tags:
+            key, sep, value = tag.partition('=')
+            if not key:
+                raise cls.Error('invalid tag filter {!r}'.format(tag))
+            if sep:
+                pushed.append('Service.Tags contains {}'.format(
+                    json.dumps('{}:{}'.format(key, value))))
+            else:
+                local.append('Service.Tags matches {}'.format(
+                    json.dumps('^{}(:|$)'.format(re.escape(key)))))
+        return pushed, local
+
+    def __call__(self, entry):
+        return self.match(entry)
+
+    def filter(self, entries):
+        '''Yields the matching entries
+        '''
+        match = self.match
+        for entry in entries:
+            if match(entry):
+                yield entry
+
+    @classmethod
+    def tokenize(cls, expression):
+        tokens = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            token = cls.TOKEN.match(expression, pos)
+            if not token:
+                raise cls.Error('invalid where expression at {!r}'.format(
+                    expression[pos:]))
+            kind = token.lastgroup
+            value = token.group(kind)
+            if kind == 'string':
+                try:
+                    value = json.loads('"{}"'.format(value))
+                except ValueError as e:
+                    raise cls.Error('invalid string {!r}: {}'.format(value, e))
+            elif kind == 'raw':
+                kind = 'string'
+            elif kind == 'word' and value in cls.KEYWORDS:
+                kind = 'keyword'
+            tokens.append((kind, value))
+            pos = token.end()
+        return tokens
+
+    def peek(self, *values):
+        if self.pos < len(self.tokens) and self.tokens[self.pos][1] in values \
+                and self.tokens[self.pos][0] != 'string':
+            return self.tokens[self.pos][1]
+        return None
+
+    def take(self, *kinds):
+        if self.pos >= len(self.tokens):
+            raise self.Error('unexpected end of where expression')
+        kind, value = self.tokens[self.pos]
+        if kinds and kind not in kinds:
+            raise self.Error('unexpected {!r} in where expression'.format(
+                value))
+        self.pos += 1
+        return value
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek('or'):
+            self.pos += 1
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda entry: any(term(entry) for term in terms)
+
+    def parse_and(self):
+        terms = [self.parse_unary()]
+        while self.peek('and'):
+            self.pos += 1
+            terms.append(self.parse_unary())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda entry: all(term(entry) for term in terms)
+
+    def parse_unary(self):
+        if self.peek('not'):
+            self.pos += 1
+            term = self.parse_unary()
+            return lambda entry: not term(entry)
+
+        if self.peek('('):
+            self.pos += 1
+            term = self.parse_or()
+            if self.take('paren') != ')':
+                raise self.Error('missing ) in where expression')
+            return term
+
+        return self.parse_match()
+
+    def parse_match(self):
+        first_kind, first = self.tokens[self.pos] if \
+            self.pos < len(self.tokens) else (None, None)
+        self.take('word', 'string')
+
+        # "value" in Selector, "value" not in Selector
+        negate = bool(self.peek('not'))
+        if negate:
+            self.pos += 1
+        if self.peek('in'):
+            self.pos += 1
+            selector = self.selector(self.take('word'))
+            return self.negate(
+                lambda entry: any(self.contains(value, first)
+                                  for value in selector(entry)), negate)
+        if negate:
+            # Selector not contains|matches "value"
+            self.pos -= 1
+
+        if first_kind != 'word':
+            raise self.Error('selector expected instead of {!r}'.format(first))
+        selector = self.selector(first)
+
+        if self.peek('is'):
+            self.pos += 1
+            negate = bool(self.peek('not'))
+            if negate:
+                self.pos += 1
+            if self.take('keyword') != 'empty':
+                raise self.Error('"is" must be followed by [not] empty')
+            return self.negate(
+                lambda entry: all(self.empty(value)
+                                  for value in selector(entry)), negate)
+
+        negate = bool(self.peek('not'))
+        if negate:
+            self.pos += 1
+        op = self.take('op', 'keyword')
+        operand = self.take('word', 'string')
+
+        if op in ('==', '!='):
+            test = lambda value: any(self.text(item) == operand
+                                     for item in self.elements(value))
+            negate = op == '!='
+        elif op == 'contains':
+            test = lambda value: self.contains(value, operand)
+        elif op == 'matches':
+            try:
+                pattern = re.compile(operand)
+            except re.error as e:
+                raise self.Error('invalid regular expression: {}'.format(e))
+            test = lambda value: any(isinstance(item, str) and
+                                     bool(pattern.search(item))
+                                     for item in self.elements(value))
+        else:
+            raise self.Error('unknown operator {!r}'.format(op))
+
+        return self.negate(
+            lambda entry: any(test(value) for value in selector(entry)),
+            negate)
+
+    @staticmethod
+    def negate(term, negate):
+        return (lambda entry: not term(entry)) if negate else term
+
+    @staticmethod
+    def selector(path):
+        '''Returns function listing values of the path in an entry, lists
+           met on the way are expanded.
+        '''
+        keys = path.split('.')
+
+        def values(entry):
+            current = [entry]
+            for key in keys:
+                found = []
+                for value in current:
+                    if isinstance(value, list):
+                        value = [item.get(key) for item in value
+                                 if isinstance(item, dict) and key in item]
+                        found.extend(value)
+                    elif isinstance(value, dict) and key in value:
+                        found.append(value[key])
+                current = found
+            return current
+        return values
+
+    @staticmethod
+    def elements(value):
+        '''Elements of a list value, other values are a single element
+        '''
+        return value if isinstance(value, list) else (value,)
+
+    @staticmethod
+    def text(value):
+        '''Value as it's spelled in expressions
+        '''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, str):
+            return value
+        return json.dumps(value)
+
+    @classmethod
+    def contains(cls, value, operand):
+        if isinstance(value, str):
+            return operand in value
+        if isinstance(value, dict):
+            return operand in value
+        if isinstance(value, list):
+            # list membership runs in C, only non-strings need converting
+            return operand in value or any(
+                cls.text(item) == operand for item in value
+                if not isinstance(item, str))
+        return False
+
+    @staticmethod
+    def empty(value):
+        return value is None or (hasattr(value, '__len__') and not len(value))
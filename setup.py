@@ -19,6 +19,11 @@ setup(
     author='Denis Baryshev',
     author_email='dennybaa@gmail.com',
     install_requires=install_reqs,
+    extras_require={
+        'aio': ['aiohttp>=3.0'],
+        'orjson': ['orjson>=3.0'],
+        'msgpack': ['msgpack>=1.0']
+    },
     dependency_links=dep_links,
     packages=find_packages(exclude=['setuptools', 'tests']),
     include_package_data=True,
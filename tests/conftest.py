@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+from counsel.results import JinjaRender
+from counsel.registry import QueryRegistry
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'benchmarks'))
+from fakeconsul import FakeConsul  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    '''Keeps the counsel cache (registries, bytecode, responses, endpoint
+       stats) of every test in its tmp_path
+    '''
+    path = tmp_path / 'cache'
+    monkeypatch.setenv('COUNSEL_CACHE_DIR', str(path))
+    # shared objects hold paths inside of the previous cache directory
+    monkeypatch.setattr(JinjaRender, '_environment', None)
+    monkeypatch.setattr(QueryRegistry, '_instances', {})
+    yield path
+    JinjaRender._environment = None
+
+
+@pytest.fixture
+def fake_consul():
+    '''Starts benchmarks/fakeconsul.py servers, configured by the test
+       through their attributes, with 4 instances per service by default
+    '''
+    started = []
+
+    def start(instances=4, **kwargs):
+        started.append(FakeConsul(('127.0.0.1', 0), instances=instances,
+                                  **kwargs).start())
+        return started[-1]
+
+    yield start
+    for server in started:
+        server.shutdown()
+        server.server_close()
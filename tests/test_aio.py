@@ -0,0 +1,97 @@
+import time
+import socket
+import threading
+import asyncio
+import logging
+
+import pytest
+
+from counsel.counsel import Counsel
+
+pytest.importorskip('aiohttp')
+from counsel.aio import AsyncCounsel  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    '''Address of a closed port'''
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return '127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+def test_unreachable(server):
+    async def health():
+        async with AsyncCounsel(server, timeout=5) as app:
+            await app.health_service('web')
+
+    with pytest.raises(Counsel.Unreachable):
+        asyncio.run(health())
+
+
+def test_gc_keeps_entries(server, caplog):
+    '''Failure to list the queries is logged and the entries are kept'''
+    async def gc():
+        async with AsyncCounsel(server, timeout=5) as app:
+            registry = app.registry
+            registry.add('counsel-named')
+            registry.add('counsel-known', 'id-known')
+            with registry.update() as data:
+                for entry in data['queries'].values():
+                    entry['used'] = time.time() - 2 * registry.ttl
+            await app.gc()
+            return registry
+
+    with caplog.at_level(logging.WARNING, logger='counsel'):
+        registry = asyncio.run(gc())
+
+    assert sorted(registry.data['queries']) == ['counsel-known',
+                                                'counsel-named']
+    assert 'cannot list stale queries' in caplog.text
+    assert 'cannot remove stale query counsel-known' in caplog.text
+
+
+def test_query_create_race(fake_consul):
+    '''Concurrent first executes of a query don't fail on the one created
+       by the other, names of queries are unique'''
+    consul = fake_consul()
+    arrived, barrier = [], threading.Barrier(2, timeout=5)
+
+    def create():
+        arrived.append(True)
+        if len(arrived) <= 2:
+            barrier.wait()
+    consul.hooks['query.create'] = create
+
+    async def query():
+        async with AsyncCounsel(consul.uri, timeout=5) as app:
+            return await asyncio.gather(app.query_service('web'),
+                                        app.query_service('web'))
+
+    results = asyncio.run(query())
+    assert [len(result['Nodes']) for result in results] == [4, 4]
+    assert len(consul.queries) == 1
+
+
+def test_gc(fake_consul):
+    '''Expired queries are deleted, the ones known by name are resolved'''
+    consul = fake_consul()
+
+    async def gc():
+        async with AsyncCounsel(consul.uri, timeout=5) as app:
+            await app.query_service('web')
+            await app.query_service('db')
+            registry = app.registry
+            with registry.update() as data:
+                data['queries'][min(data['queries'])]['id'] = None
+                for entry in data['queries'].values():
+                    entry['used'] = time.time() - 2 * registry.ttl
+            with registry.update() as data:
+                data['gc'] = 0
+            await app.gc()
+            assert app.gc() is None
+            return registry
+
+    registry = asyncio.run(gc())
+    assert registry.data['queries'] == {}
+    assert consul.queries == {}
@@ -0,0 +1,88 @@
+import os
+import time
+
+import pytest
+import consul.base
+
+from counsel.cache import ResponseCache
+from counsel.timings import Timings
+
+
+URI = 'http://127.0.0.1:8500/v1/health/service/web?token=secret'
+
+
+def response(body='[]', index='7'):
+    return consul.base.Response(200, {'X-Consul-Index': index,
+                                      'Content-Type': 'application/json'},
+                                body)
+
+
+@pytest.fixture
+def events():
+    events = []
+    hook = events.append
+    Timings.add_hook(hook)
+    yield events
+    Timings.remove_hook(hook)
+
+
+def test_lookup(tmp_path, events):
+    cache = ResponseCache(60, path=str(tmp_path))
+    assert cache.lookup(URI) == (None, None)
+
+    cache.put(URI, response('[1]'))
+    fresh, cached = cache.lookup(URI)
+    assert fresh.body == '[1]' and fresh.headers == {'X-Consul-Index': '7'}
+    assert cached is fresh
+
+    assert cache.stats == {'hits': 1, 'misses': 1, 'stale': 0}
+    assert [(e['kind'], e['name'], e['result']) for e in events
+            if e['kind'] == 'cache'] == [
+        ('cache', 'miss /v1/health/service/web', 'miss'),
+        ('cache', 'hit /v1/health/service/web', 'hit')]
+
+
+def test_stale(tmp_path, events):
+    cache = ResponseCache(0, path=str(tmp_path))
+    cache.put(URI, response('[1]'))
+    time.sleep(0.01)
+
+    fresh, cached = cache.lookup(URI)
+    assert fresh is None and cached.body == '[1]'
+    assert cache.fallback(URI, cached, 'unreachable') is cached
+    assert cache.fallback(URI, None, 'unreachable') is None
+
+    assert cache.stats == {'hits': 0, 'misses': 1, 'stale': 1}
+    assert [e['result'] for e in events if e['kind'] == 'cache'] == \
+        ['miss', 'stale']
+
+
+def test_prune(tmp_path):
+    cache = ResponseCache(60, path=str(tmp_path), max_entries=3)
+    for n in range(5):
+        cache.put('{}&n={}'.format(URI, n), response())
+        path = cache._file('{}&n={}'.format(URI, n))
+        os.utime(path, (time.time() - 100 + n, time.time() - 100 + n))
+
+    # pruned once per interval
+    assert len(os.listdir(str(tmp_path))) == 6
+    cache.prune()
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        ['.pruned'] + [os.path.basename(cache._file('{}&n={}'.format(URI, n)))
+                       for n in (2, 3, 4)])
+
+
+def test_prune_size(tmp_path):
+    cache = ResponseCache(60, path=str(tmp_path), prune_interval=0)
+    for n in range(3):
+        cache.put('{}&n={}'.format(URI, n), response('[{}]'.format(n)))
+        path = cache._file('{}&n={}'.format(URI, n))
+        os.utime(path, (time.time() - 100 + n, time.time() - 100 + n))
+    size = os.path.getsize(cache._file(URI + '&n=0'))
+
+    # entry sizes differ slightly, by the length of their times
+    cache.max_size = 2 * size + size // 2
+    cache.put(URI, response('[9]'))
+    assert len([name for name in os.listdir(str(tmp_path))
+                if not name.startswith('.')]) == 2
+    assert cache.get(URI)[1].body == '[9]'
@@ -0,0 +1,162 @@
+import time
+import threading
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from counsel.counsel import Counsel, Agent
+from counsel.where import Where
+
+
+def entries(node, service):
+    return [{
+        'Node': {'Node': node, 'Address': '10.0.0.1'},
+        'Service': {'Service': service, 'Tags': []},
+        'Checks': []
+    }]
+
+
+@pytest.fixture
+def servers(fake_consul):
+    '''Two servers with the services on the node named after the server
+    '''
+    started = []
+    for name in ('a', 'b'):
+        server = fake_consul()
+        server.services = {service: entries(name, service)
+                           for service in ('web', 'db')}
+        started.append(server.uri)
+    return started
+
+
+def nodes(app, **kwargs):
+    return list(app.render_health_service('web', filter='{{Node.Node}}',
+                                          **kwargs))
+
+
+def test_agent_per_instance(servers):
+    '''Clients connected with own options don't retarget each other'''
+    first = Counsel(server=servers[0])
+    second = Counsel(server=servers[1])
+
+    assert first.agent is not second.agent
+    assert nodes(first) == ['a']
+    assert nodes(second) == ['b']
+    assert nodes(first, dcs=['dc1', 'dc2']) == ['a', 'a']
+    assert first.snapshot_path() != second.snapshot_path()
+
+    health = second.render_health_service(['web', 'db'])
+    assert [entry['Node']['Node'] for entry in health['db']] == ['b']
+
+
+def test_default_agent(servers):
+    '''Clients without options share the default agent'''
+    assert Counsel().agent is Counsel().agent
+    assert Counsel().agent is not Counsel(server=servers[0]).agent
+
+
+def test_query_create_race(fake_consul):
+    '''Concurrent first executes of a query don't fail on the one created
+       by the other, names of queries are unique'''
+    server = fake_consul()
+    server.services = {'web': entries('a', 'web')}
+    arrived, barrier = [], threading.Barrier(2, timeout=5)
+
+    def create():
+        # both executes missed the query before either creates it
+        arrived.append(True)
+        if len(arrived) <= 2:
+            barrier.wait()
+    server.hooks['query.create'] = create
+
+    def execute():
+        result = Counsel(server=server.uri).query_service('web')
+        return [node['Node']['Node'] for node in result['Nodes']]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(execute) for _ in range(2)]
+    assert [future.result() for future in futures] == [['a'], ['a']]
+    assert len(server.queries) == 1
+
+    # the loser registered the query by name only
+    query = Counsel.Query(Counsel(server=server.uri).agent)
+    query.options('web')
+    assert query.registry.get(query.uniqname)['id'] in \
+        (None, next(iter(server.queries)))
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_filter_rejected(fake_consul, stream, caplog):
+    '''Filters rejected by Consul are applied locally'''
+    server = fake_consul()
+    server.codes = [400]
+    app = Counsel(server=server.uri)
+
+    health = Counsel.Health(app.agent)
+    where = Where.create('Service.Port == 8000')
+    if stream:
+        entries = list(health.iter_service('web', where=where))
+    else:
+        entries = health.service('web', where=where)
+
+    assert [entry['Node']['Node'] for entry in entries] == ['node-0']
+    assert [parse_qs(urlsplit(path).query).get('filter') for _, path in
+            server.requests] == [[where.server], None]
+    assert 'filter rejected by consul' in caplog.text
+
+
+def test_dcs_merge_order(fake_consul):
+    '''Entries are merged in the order of the datacenters, not answers'''
+    server = fake_consul()
+    server.dc_latency = {'dc1': 0.2}
+    app = Counsel(server=server.uri)
+
+    entries = app.health_service_dcs('web', ['dc1', 'dc2', 'dc1', 'dc3'])
+    assert [entry['Datacenter'] for entry in entries] == \
+        ['dc1'] * 4 + ['dc2'] * 4 + ['dc3'] * 4
+
+
+def test_dcs_timeout(fake_consul, caplog):
+    '''Datacenter not answering within the timeout is skipped'''
+    server = fake_consul()
+    server.dc_latency = {'dc2': 2.0}
+    app = Counsel(server=server.uri)
+
+    started = time.monotonic()
+    entries = app.health_service_dcs('web', ['dc1', 'dc2'], timeout=0.3)
+    assert time.monotonic() - started < 1.5
+    assert {entry['Datacenter'] for entry in entries} == {'dc1'}
+    assert 'datacenter dc2 skipped' in caplog.text
+
+
+def test_dcs_failing(fake_consul):
+    '''Error is raised when none of the datacenters answers'''
+    server = fake_consul()
+    server.down = {'dc1', 'dc2'}
+    app = Counsel(server=server.uri)
+
+    with pytest.raises(Counsel.APIError, match='no datacenter answered'):
+        app.health_service_dcs('web', ['dc1', 'dc2'])
+
+    server.down = set()
+    server.dc_latency = {'dc1': 2.0, 'dc2': 2.0}
+    with pytest.raises(Counsel.Unreachable):
+        app.health_service_dcs('web', ['dc1', 'dc2'], timeout=0.3)
+
+
+def test_static_compatible(servers, monkeypatch):
+    '''Methods which used to be static can be called on the class, they
+       use the default agent'''
+    default = Counsel(server=servers[1]).agent
+    monkeypatch.setattr(Agent, '_agent', default)
+
+    entries = Counsel.health_service('web')
+    assert [entry['Node']['Node'] for entry in entries] == ['b']
+    nodes = Counsel.query_service('web')['Nodes']
+    assert [node['Node']['Node'] for node in nodes] == ['b']
+    assert Counsel.snapshot_path() == Counsel().snapshot_path()
+
+    # instances keep their own agent
+    assert [entry['Node']['Node'] for entry in
+            Counsel(server=servers[0]).health_service('web')] == ['a']
@@ -0,0 +1,189 @@
+import io
+import os
+import sys
+import socket
+import threading
+import subprocess
+
+import pytest
+
+from counsel import daemon
+from counsel.log import log
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def handle_argv(argv, out):
+    '''Writes the arguments as lines, logs a warning and exits 3'''
+    if argv == ['local']:
+        return None
+
+    for arg in argv:
+        out.write(arg + '\n')
+        if arg == 'wait':
+            # the lines written before are at the client already
+            out.flush()
+            assert handle_argv.flushed.wait(5)
+    log.warning('served %s', len(argv))
+    return 3
+
+
+class Output(io.StringIO):
+    '''Signals that the line before "wait" arrived'''
+
+    def write(self, text):
+        super(Output, self).write(text)
+        if 'first' in self.getvalue():
+            handle_argv.flushed.set()
+        return len(text)
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / 'counsel.sock')
+    server = daemon.Server(path, handle_argv)
+    threading.Thread(target=server.serve_forever, args=(0.05,),
+                     daemon=True).start()
+    handle_argv.flushed = threading.Event()
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def test_request(path):
+    out, err = Output(), io.StringIO()
+    assert daemon.request(['first', 'wait', 'last'], out, err,
+                          path=path) == 3
+    assert out.getvalue() == 'first\nwait\nlast\n'
+    assert err.getvalue() == '[WARNING] served 3\n'
+
+
+def test_large_output(path):
+    lines = ['line {}'.format(n) for n in range(50000)]
+    out = io.StringIO()
+    assert daemon.request(lines, out, path=path) == 3
+    assert out.getvalue() == ''.join(line + '\n' for line in lines)
+
+
+def test_fallback(path):
+    out = io.StringIO()
+    assert daemon.request(['local'], out, path=path) is None
+    assert out.getvalue() == ''
+
+
+def test_not_running(tmp_path):
+    assert daemon.request(['first'], io.StringIO(),
+                          path=str(tmp_path / 'missing.sock')) is None
+
+
+def test_worker_messages(tmp_path):
+    '''Messages logged by the batch workers of a request reach its client'''
+    from counsel.counsel import Counsel
+
+    def handle_argv(argv, out):
+        app = Counsel(server='127.0.0.1:1')
+        app.batch(lambda service: log.warning('%s skipped', service), argv)
+        return 0
+
+    path = str(tmp_path / 'counsel.sock')
+    server = daemon.Server(path, handle_argv)
+    threading.Thread(target=server.serve_forever, args=(0.05,),
+                     daemon=True).start()
+    try:
+        err = io.StringIO()
+        assert daemon.request(['dc1', 'dc2'], io.StringIO(), err,
+                              path=path) == 0
+        assert sorted(err.getvalue().splitlines()) == \
+            ['[WARNING] dc1 skipped', '[WARNING] dc2 skipped']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_cli(*argv, socket=None):
+    '''Run the counsel CLI, the daemon socket is given by COUNSEL_SOCKET'''
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    if socket:
+        env['COUNSEL_SOCKET'] = socket
+    return subprocess.run([sys.executable, '-m', 'counsel.cli.main'] +
+                          list(argv), env=env, capture_output=True,
+                          text=True, timeout=60)
+
+
+@pytest.fixture
+def counsel_daemon(tmp_path, fake_consul, monkeypatch):
+    '''CLI daemon connected to the fake Consul, served commands are
+       collected in its served list'''
+    from counsel.cli import main
+
+    consul = fake_consul()
+    consul.services = {'web': [
+        {'Node': {'Node': node, 'Address': '10.0.0.1'},
+         'Service': {'Service': 'web', 'Tags': []}, 'Checks': []}
+        for node in ('a', 'b')]}
+
+    # options of the daemon started as counsel -s <server> serve
+    _, _, options = main.parse(['-s', consul.uri, 'serve'])
+    for option in ('quiet', 'no-daemon', 'timings', 'timings-format'):
+        options.pop(option, None)
+    monkeypatch.setattr(main, '_app', None)
+    monkeypatch.setattr(main, '_daemon_options', options)
+    main.get_app().connect_options(**options)
+
+    def serve_request(argv, out):
+        status = main.serve_request(argv, out)
+        server.served.append((argv, status))
+        return status
+
+    path = str(tmp_path / 'counsel.sock')
+    server = daemon.Server(path, serve_request)
+    server.consul = consul
+    server.served = []
+    threading.Thread(target=server.serve_forever, args=(0.05,),
+                     daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_cli_served(counsel_daemon):
+    '''The CLI sends commands to the running daemon'''
+    argv = ['-s', counsel_daemon.consul.uri, 'health', '-s', 'web',
+            '-f', '{{ Node.Node }}', '--format=oneline']
+    cli = run_cli(*argv, socket=counsel_daemon.server_address)
+
+    assert cli.returncode == 0, cli.stderr
+    assert cli.stdout == 'a b\n'
+    assert counsel_daemon.served == [(argv, 0)]
+
+
+def test_cli_other_options(counsel_daemon):
+    '''Commands with other connect options are run by the CLI'''
+    argv = ['-s', counsel_daemon.consul.uri, '--dc=dc2', 'health', '-s',
+            'web', '-f', '{{ Node.Node }}', '--format=oneline']
+    cli = run_cli(*argv, socket=counsel_daemon.server_address)
+
+    assert cli.returncode == 0, cli.stderr
+    assert cli.stdout == 'a b\n'
+    assert counsel_daemon.served == [(argv, None)]
+
+
+@pytest.mark.parametrize('stale', [False, True])
+def test_cli_without_daemon(fake_consul, tmp_path, stale):
+    '''The CLI runs commands itself when the daemon socket is missing or
+       nobody listens on it'''
+    consul = fake_consul()
+    path = str(tmp_path / 'counsel.sock')
+    if stale:
+        # socket file left behind by a killed daemon
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+        assert os.path.exists(path) and not daemon.alive(path)
+
+    cli = run_cli('-s', consul.uri, 'health', '-s', 'web', '-f',
+                  '{{ Node.Node }}', '--format=oneline', socket=path)
+    assert cli.returncode == 0, cli.stderr
+    assert cli.stdout == ' '.join('node-{}'.format(n) for n in range(4)) + \
+        '\n'
+    assert [path for _, path in consul.requests if 'health' in path]
@@ -0,0 +1,222 @@
+import time
+import socket
+import threading
+
+import pytest
+import requests.exceptions
+
+from counsel.http import HTTPClient
+from counsel.timings import Timings
+
+
+@pytest.fixture
+def servers(fake_consul):
+    '''Fake Consul servers which answer /v1/status/leader by their name
+       after their delay, codes are the statuses of the next requests
+    '''
+    def start(name, delay=0.0, codes=()):
+        server = fake_consul(latency=delay)
+        server.leader = name
+        server.codes = list(codes)
+        return server
+    return start
+
+
+def client(*servers, **kwargs):
+    host, port = servers[0].server_address
+    return HTTPClient(host, port, servers=[s.uri for s in servers[1:]],
+                      **kwargs)
+
+
+def get(http):
+    return http.route('GET', http.uri('/v1/status/leader'))
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_timeout_not_retried(servers):
+    '''A single slow server is given the request timeout once'''
+    slow = servers('slow', delay=1.0)
+    http = client(slow, timeout=0.3)
+
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout):
+        get(http)
+    assert time.monotonic() - started < 0.9
+    assert len(slow.requests) == 1
+
+
+def test_attempts_share_timeout(servers):
+    '''Retries on the next servers don't extend the request timeout'''
+    slow = [servers('slow{}'.format(n), delay=1.0) for n in range(3)]
+    http = client(*slow, timeout=0.3)
+
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout):
+        get(http)
+    assert time.monotonic() - started < 0.9
+
+
+def test_retry_server_error(servers):
+    '''5xx of the single server is retried on it'''
+    server = servers('only', codes=[500, 503])
+    http = client(server)
+
+    response = get(http)
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+
+
+def test_server_error_returned(servers):
+    '''The last 5xx response is returned once the retries run out'''
+    server = servers('only', codes=[500, 500, 502])
+    http = client(server)
+
+    assert get(http).status_code == 502
+    assert len(server.requests) == HTTPClient.RETRIES + 1
+
+
+def test_failover(servers):
+    '''Unreachable server is retried on the next one and avoided later'''
+    server = servers('up')
+    http = HTTPClient('127.0.0.1', closed_port(), servers=[server.uri])
+
+    assert get(http).json() == 'up'
+    assert get(http).json() == 'up'
+    # the failed server is ranked after the one which answered
+    assert len(server.requests) == 2
+    assert http.endpoints[0].failures == 1
+
+
+def test_connection_error_retried(servers):
+    '''Connection errors of the single server are retried and raised'''
+    http = HTTPClient('127.0.0.1', closed_port())
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        get(http)
+    assert http.endpoints[0].failures == HTTPClient.RETRIES + 1
+
+
+def test_ranked_by_latency(servers):
+    fast, slow = servers('fast'), servers('slow', delay=0.05)
+    http = client(slow, fast)
+    for endpoint in http.endpoints:
+        http.dispatch(endpoint, 'GET', http.uri('/v1/status/leader'), None,
+                      None)
+
+    assert [e.base_uri for e in http.ranked()] == [fast.uri, slow.uri]
+    assert get(http).json() == 'fast'
+
+
+def test_unmeasured_ranked_last(servers):
+    first, second = servers('first'), servers('second')
+    http = client(first, second)
+    assert get(http).json() == 'first'
+    assert get(http).json() == 'first'
+    assert not second.requests
+
+
+def test_stats_persisted(servers):
+    '''A new client routes by the latencies measured by the previous one'''
+    fast, slow = servers('fast'), servers('slow', delay=0.05)
+    http = client(slow, fast)
+    for endpoint in http.endpoints:
+        http.dispatch(endpoint, 'GET', http.uri('/v1/status/leader'), None,
+                      None)
+    http.stats.save(force=True)
+
+    http = client(slow, fast)
+    assert all(e.latency is not None for e in http.endpoints)
+    assert get(http).json() == 'fast'
+
+
+def hedge_threads():
+    return [t for t in threading.enumerate() if t.name == 'counsel-hedge']
+
+
+def test_hedged(servers):
+    '''Slow read is sent to the next server, the loser is left behind'''
+    slow, fast = servers('slow', delay=1.0), servers('fast')
+    http = client(slow, fast, hedge=50)
+    http.endpoints[0].restore({'latency': 0.001, 'samples': [0.001] * 10})
+    http.endpoints[1].restore({'latency': 0.002, 'samples': [0.002] * 10})
+
+    started = time.monotonic()
+    assert get(http).json() == 'fast'
+    assert time.monotonic() - started < 0.5
+    assert len(slow.requests) == len(fast.requests) == 1
+
+    # the process exit doesn't wait for the slow server
+    assert hedge_threads()
+    assert all(thread.daemon for thread in hedge_threads())
+
+
+def test_not_hedged(servers):
+    '''Reads within the percentile and reads without samples go to one
+       server only'''
+    primary, secondary = servers('primary'), servers('secondary')
+    http = client(primary, secondary, hedge=50)
+
+    assert get(http).json() == 'primary'
+    http.endpoints[0].restore({'samples': [1.0] * 10})
+    assert get(http).json() == 'primary'
+    assert not secondary.requests
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate', 'raw-deflate', None])
+def test_read(fake_consul, encoding):
+    '''Compressed responses are decoded, the wire size is the size of the
+       body as it was sent'''
+    server = fake_consul(instances=100, encoding=encoding)
+    body = server.health('web', 'dc1')
+    assert len(body) >= server.GZIP_MIN_SIZE
+
+    events = []
+    hook = events.append
+    Timings.add_hook(hook)
+    try:
+        http = client(server)
+        response = http.route('GET', http.uri('/v1/health/service/web'))
+    finally:
+        Timings.remove_hook(hook)
+
+    assert response.content == body
+    [event] = [e for e in events if e['kind'] == 'http']
+    wire_size = len(server.compress(body)) if encoding else len(body)
+    assert event['wire_size'] == wire_size
+    decompressed = [e for e in events if e['kind'] == 'decompress']
+    if encoding:
+        assert wire_size < len(body)
+        assert [(e['size'], e['decompressed']) for e in decompressed] == \
+            [(wire_size, len(body))]
+    else:
+        assert decompressed == []
+
+
+def test_read_corrupted(fake_consul):
+    server = fake_consul(instances=100)
+    server.compress = lambda body: b'not compressed'
+    http = client(server)
+
+    with pytest.raises(requests.exceptions.ContentDecodingError):
+        http.route('GET', http.uri('/v1/health/service/web'))
+
+
+def test_hedged_timeout_blame(servers):
+    '''Timeout of the hedged request is recorded against the endpoint
+       which timed out, not the primary one'''
+    primary = servers('primary', delay=0.1, codes=[500])
+    secondary = servers('secondary', delay=2.0)
+    http = client(primary, secondary, hedge=50, timeout=0.5)
+    http.endpoints[0].restore({'latency': 0.001, 'samples': [0.001] * 10})
+
+    timed_out = set()
+    with pytest.raises(requests.exceptions.Timeout):
+        http.hedged(http.endpoints[0], http.endpoints[1], 'GET',
+                    http.uri('/v1/status/leader'), None, 0.5, timed_out)
+    assert timed_out == {http.endpoints[1]}
+    assert [e.failures for e in http.endpoints] == [1, 1]
@@ -0,0 +1,141 @@
+import time
+
+import pytest
+
+from counsel.registry import QueryRegistry
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'queries' / 'registry.json')
+
+
+def used(registry, uniqname, ago):
+    with registry.update() as data:
+        data['queries'][uniqname]['used'] = time.time() - ago
+
+
+def test_persisted(path):
+    registry = QueryRegistry(path)
+    registry.add('counsel-a', 'id-a')
+    registry.add('counsel-b')
+
+    registry = QueryRegistry(path)
+    assert registry.get('counsel-a')['id'] == 'id-a'
+    assert registry.get('counsel-b')['id'] is None
+    assert registry.get('counsel-c') is None
+
+    registry.remove('counsel-a')
+    assert sorted(QueryRegistry(path).data['queries']) == ['counsel-b']
+
+
+def test_concurrent_writers(path):
+    '''Registries of concurrent processes keep each other's entries'''
+    first, second = QueryRegistry(path), QueryRegistry(path)
+    first.add('counsel-x', 'id-x')
+    second.add('counsel-y', 'id-y')
+    first.add('counsel-z', 'id-z')
+
+    assert sorted(QueryRegistry(path).data['queries']) == \
+        ['counsel-x', 'counsel-y', 'counsel-z']
+    assert second.get('counsel-z')['id'] == 'id-z'
+
+    second.remove('counsel-x')
+    first.add('counsel-z')
+    assert sorted(QueryRegistry(path).data['queries']) == \
+        ['counsel-y', 'counsel-z']
+
+
+def test_claim_gc(path):
+    first, second = QueryRegistry(path), QueryRegistry(path)
+    assert first.data and second.data
+    assert first.claim_gc()
+    assert not second.claim_gc()
+    assert not first.claim_gc()
+
+
+def test_expired(path):
+    registry = QueryRegistry(path, ttl=60, max_entries=2)
+    for n, ago in enumerate([0, 10, 20, 120]):
+        registry.add('counsel-{}'.format(n), 'id-{}'.format(n))
+        used(registry, 'counsel-{}'.format(n), ago)
+
+    # counsel-2 falls out of the two most recently used, counsel-3 is old
+    assert sorted(name for name, _ in registry.expired()) == \
+        ['counsel-2', 'counsel-3']
+
+
+def test_gc(path):
+    registry = QueryRegistry(path, ttl=60)
+    registry.add('counsel-old', 'id-old')
+    registry.add('counsel-new', 'id-new')
+    used(registry, 'counsel-old', 120)
+
+    deleted = []
+    registry.gc(deleted.append, dict)
+    assert deleted == ['id-old']
+    assert sorted(QueryRegistry(path).data['queries']) == ['counsel-new']
+    assert not QueryRegistry(path).gc_due()
+
+
+def test_gc_errors_keep_entries(path):
+    registry = QueryRegistry(path, ttl=60)
+    registry.add('counsel-old', 'id-old')
+    used(registry, 'counsel-old', 120)
+
+    def delete(query_id):
+        raise RuntimeError('unavailable')
+
+    registry.gc(delete, dict, errors=RuntimeError)
+    assert 'counsel-old' in QueryRegistry(path).data['queries']
+
+
+def test_gc_resolves_names(path):
+    '''IDs of queries registered by name only are looked up once'''
+    registry = QueryRegistry(path, ttl=60)
+    registry.add('counsel-named')
+    registry.add('counsel-gone')
+    registry.add('counsel-known', 'id-known')
+    for uniqname in ('counsel-named', 'counsel-gone', 'counsel-known'):
+        used(registry, uniqname, 120)
+
+    deleted, resolved = [], []
+
+    def resolve():
+        resolved.append(True)
+        return {'counsel-named': 'id-named', 'counsel-other': 'id-other'}
+
+    registry.gc(deleted.append, resolve)
+    assert resolved == [True]
+    assert sorted(deleted) == ['id-known', 'id-named']
+    # queries which don't exist anymore are dropped
+    assert QueryRegistry(path).data['queries'] == {}
+
+
+def test_gc_resolve_error(path):
+    '''Entries which can't be resolved are kept for the next run'''
+    registry = QueryRegistry(path, ttl=60)
+    registry.add('counsel-named')
+    registry.add('counsel-known', 'id-known')
+    for uniqname in ('counsel-named', 'counsel-known'):
+        used(registry, uniqname, 120)
+
+    def resolve():
+        raise RuntimeError('unavailable')
+
+    deleted = []
+    registry.gc(deleted.append, resolve, errors=RuntimeError)
+    assert deleted == ['id-known']
+    assert sorted(QueryRegistry(path).data['queries']) == ['counsel-named']
+
+
+def test_gc_async(path):
+    registry = QueryRegistry(path, ttl=60)
+    registry.add('counsel-old', 'id-old')
+    used(registry, 'counsel-old', 120)
+
+    deleted = []
+    registry.gc_async(deleted.append, dict).join()
+    assert deleted == ['id-old']
+    # claimed, not due again
+    assert registry.gc_async(deleted.append, dict) is None
@@ -0,0 +1,310 @@
+import io
+
+import pytest
+
+from counsel.results import Formatter, JinjaRender, PathRender, Projection, \
+    ParallelRender, ColumnRender
+
+
+ENTRIES = [{
+    'Node': {'Node': 'node{}'.format(n), 'Address': '10.0.0.{}'.format(n),
+             'Meta': {'rack': 'r{}'.format(n % 2)}},
+    'Service': {'Service': 'web', 'Port': 8000 + n,
+                'Tags': ['class:pio', 'instance_id:i-{}'.format(n)],
+                'Meta': {}},
+    'Checks': [{'Name': 'serf', 'Status': 'passing'},
+               {'Name': 'http', 'Status': 'critical' if n else 'passing'}],
+} for n in range(3)]
+
+
+def tree(template):
+    projection = Projection.create(template)
+    return projection and projection.tree
+
+
+@pytest.mark.parametrize('template, expected', [
+    ('{{ Node.Address }}', {'Node': {'Address': True}}),
+    ('{{ Node.Address }}:{{ Service.Port }}',
+     {'Node': {'Address': True}, 'Service': {'Port': True}}),
+    ("{{ Node['Address'] }}", {'Node': {'Address': True}}),
+    ('{{ Node }}', {'Node': True}),
+    ('{{ Node.Address }} {{ Node }}', {'Node': True}),
+    # list indexes apply to the items
+    ('{{ Checks[0].Status }}', {'Checks': {'Status': True}}),
+    # filters get the whole value
+    ('{{ Service.Tags | join(",") }}', {'Service': {'Tags': True}}),
+    # loop variables aren't entry keys, they're kept whole harmlessly
+    ('{% for check in Checks %}{{ check.Name }}{% endfor %}',
+     {'Checks': True, 'check': True}),
+    # dynamic lookups and method calls need the object whole
+    ('{{ Node.Meta[Service.Service] }}',
+     {'Node': {'Meta': True}, 'Service': {'Service': True}}),
+    ('{{ Node.Meta.get("rack") }}', {'Node': {'Meta': True}}),
+    ('{{ Node.Meta.items() | list }}', {'Node': {'Meta': True}}),
+    ('{{ Node.keys() | list }}', {'Node': True}),
+    # assigned variables shadow the context ones
+    ('{% set Node = Service %}{{ Node.Port }}', {'Node': True,
+                                                 'Service': True}),
+])
+def test_analyse(template, expected):
+    assert tree(template) == expected
+
+
+@pytest.mark.parametrize('template', [
+    '{% include "other" %}',
+    '{% import "macros" as m %}{{ m.address(Node) }}',
+    '{% extends "base" %}',
+])
+def test_whole_entries(template):
+    assert Projection.create(template) is None
+
+
+def test_several_templates():
+    assert tree(['{{ Node.Node }}', '{{ Node.Address }}']) == \
+        {'Node': {'Node': True, 'Address': True}}
+    assert tree(['{{ Node.Node }}', '{% include "x" %}']) is None
+
+
+def test_project():
+    projection = Projection.create(['{{ Node.Address }}',
+                                    '{{ Checks[1].Status }}',
+                                    '{{ Missing.Key }}'])
+    assert projection(dict(ENTRIES[1])) == {
+        'Node': {'Address': '10.0.0.1'},
+        'Checks': [{'Status': 'passing'}, {'Status': 'critical'}]}
+
+
+def test_tagmap():
+    projection = Projection.create('{{ TagMap.instance_id }}')
+    assert projection(dict(ENTRIES[2])) == {'TagMap': {'instance_id': 'i-2'}}
+
+
+@pytest.mark.parametrize('template', [
+    '{{ Node.Address }}:{{ Service.Port }}',
+    "{{ Node['Node'] }} {{ Node.Meta.rack }}",
+    '{{ Checks[1].Status }}',
+    '{{ Checks | map(attribute="Status") | join(",") }}',
+    '{% for check in Checks if check.Status != "passing" %}'
+    '{{ check.Name }}{% endfor %}',
+    '{{ Service.Tags | select("equalto", "class:pio") | list }}',
+    '{{ Node.Meta.get("rack", "none") }}',
+    '{{ Node.Meta[Service.Service] | default("-") }}',
+    '{% set n = Node %}{{ n.Node }}/{{ n.Address }}',
+    '{% if Service.Meta %}{{ Service.Meta }}{% else %}'
+    '{{ Service.Port + 1 }}{% endif %}',
+    '{{ Node.Missing | default("-") }} {{ Service.Missing.Key }}',
+])
+def test_projected_render(template):
+    '''Projected entries render the same as the whole ones'''
+    projection = Projection.create(template)
+    render = JinjaRender(template)
+    assert render.render([projection(dict(entry)) for entry in ENTRIES]) == \
+        render.render(ENTRIES)
+
+
+@pytest.mark.parametrize('template, paths', [
+    ('{{ Node.Address }}', ([('Node', 'Address')], False)),
+    ('{{Node.Address}}', ([('Node', 'Address')], False)),
+    ('{{ Node.Node, Service.Port }}',
+     ([('Node', 'Node'), ('Service', 'Port')], True)),
+    ('{{ Node.Address, }}', ([('Node', 'Address')], True)),
+    ('{{ Node.Address }} ', None),
+    ('{{ Node.Address | upper }}', None),
+    ("{{ Node['Address'] }}", None),
+    ('{{ Node.items }}', None),
+    ('{{ Node.None }}', None),
+    ('{{ Node.Address }}{{ Node.Node }}', None),
+])
+def test_path_parse(template, paths):
+    assert PathRender.parse(template) == paths
+
+
+DATA = [
+    {'Node': {'Address': '10.0.0.1', 'Node': 'nöde1'},
+     'Service': {'Port': 8080, 'Weights': {'Passing': 1.5}, 'Tags': ['a'],
+                 'EnableTagOverride': False, 'Meta': None,
+                 'Proxy': {'Upstreams': []}}},
+    {'Node': {'Address': '10.0.0.2'}, 'Service': {}},
+    {'Node': None, 'Service': 'web'},
+    {},
+]
+
+
+@pytest.mark.parametrize('template', [
+    '{{ Node.Address }}',
+    '{{ Node.Node }}',
+    '{{ Service.Port }}',
+    '{{ Service.Weights.Passing }}',
+    '{{ Service.Weights }}',
+    '{{ Service.Tags }}',
+    '{{ Service.EnableTagOverride }}',
+    '{{ Service.Meta }}',
+    '{{ Service.Proxy.Upstreams }}',
+    '{{ Node.Address, Service.Port }}',
+    '{{ Node.Address, }}',
+    '{{ Service.Missing.Key }}',
+])
+def test_path_render(template):
+    '''PathRender renders the same as Jinja, missing keys included'''
+    render = JinjaRender.create(template)
+    assert isinstance(render, PathRender)
+    assert render.render(DATA) == JinjaRender(template).render(DATA)
+
+
+ROWS = {
+    'entries': ENTRIES,
+    'strings': ['10.0.0.1', 'nöde "2"', 'a,b'],
+    'columns': [['node1', '10.0.0.1'], ['node2', '10.0.0.2']],
+    'single': ['10.0.0.1'],
+}
+
+
+@pytest.mark.parametrize('output_format', ['json', 'json-compact', 'ndjson',
+                                           'oneline', 'multiline', 'csv',
+                                           'tsv'])
+@pytest.mark.parametrize('rows', sorted(ROWS))
+def test_stream(output_format, rows):
+    '''Streamed entries are formatted as the whole list would be'''
+    data = ROWS[rows]
+    if output_format in ('csv', 'tsv') and rows == 'entries':
+        pytest.skip('entries are not rows')
+
+    streamed, whole = io.StringIO(), io.StringIO()
+    Formatter(output_format, out=streamed).write(iter(data))
+    Formatter(output_format, out=whole).output(data)
+    assert streamed.getvalue() == whole.getvalue()
+
+
+@pytest.mark.parametrize('output_format', ['json', 'ndjson', 'oneline'])
+def test_stream_empty(output_format):
+    out = io.StringIO()
+    Formatter(output_format, out=out).write(iter([]))
+    assert out.getvalue() == ''
+
+
+def test_write_dict():
+    out = io.StringIO()
+    Formatter('json', out=out).write({'web': ['10.0.0.1']})
+    assert out.getvalue() == '{\n    "web": [\n        "10.0.0.1"\n    ]\n}\n'
+
+
+def instances(count):
+    return [{
+        'Node': {'Node': 'node{}'.format(n), 'Address': '10.0.0.{}'.format(n)},
+        'Service': {'Service': 'web', 'Port': n % 50},
+    } for n in range(count)]
+
+
+@pytest.mark.parametrize('template', [
+    '{{ Node.Node }}',
+    '{{ Node.Node }}:{{ 8000 + Service.Port }}',
+    ['{{ Node.Address }}', '{{ Service.Port }}'],
+])
+def test_parallel_render(template):
+    '''Worker processes render in the order of the entries'''
+    data = instances(1000)
+    render = ParallelRender(template, jobs=2, threshold=100, chunk_size=30)
+    assert list(render.iter_render(iter(data))) == \
+        ParallelRender.create(template).render(data)
+
+
+def test_parallel_render_error():
+    '''Entries failing to render in the workers are skipped, like by the
+       serial render'''
+    template = '{{ Node.Node }} {{ 100 // Service.Port }}'
+    data = instances(1000)
+    rendered = list(ParallelRender(template, jobs=2, threshold=100,
+                                   chunk_size=30).iter_render(iter(data)))
+    assert rendered == ParallelRender.create(template).render(data)
+    assert len(rendered) == 980
+
+
+def test_parallel_render_threshold(monkeypatch):
+    '''Fewer entries than threshold are rendered without the pool'''
+    import concurrent.futures
+
+    def pool(*args, **kwargs):
+        raise AssertionError('pool started')
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', pool)
+
+    data = instances(99)
+    render = ParallelRender('{{ Node.Node }}', jobs=2, threshold=100)
+    assert list(render.iter_render(iter(data))) == \
+        ['node{}'.format(n) for n in range(99)]
+
+
+COLUMNS = [
+    '{{ Service.Port }}',
+    '{{ Node.Node | upper }}',
+    '{{ Node.Address }}',
+    '{% for tag in Service.Tags %}{{ tag }};{% endfor %}',
+]
+
+
+def test_column_render():
+    '''Rows hold a column per template, in the order of the templates'''
+    render = ColumnRender(COLUMNS)
+    columns = [JinjaRender.create(t).render(ENTRIES) for t in COLUMNS]
+    assert render.render(ENTRIES) == [list(row) for row in zip(*columns)]
+    assert render.render(ENTRIES)[1] == \
+        ['8001', 'NODE1', '10.0.0.1', 'class:pio;instance_id:i-1;']
+
+    assert ColumnRender(COLUMNS[::-1]).render(ENTRIES) == \
+        [row[::-1] for row in render.render(ENTRIES)]
+
+
+def test_column_render_shared(monkeypatch):
+    '''The Jinja context of an entry is built once for all of the
+       templates, paths are rendered without it'''
+    built = []
+    variables = JinjaRender.variables.__func__
+
+    def counted(cls, data, **kwargs):
+        built.append(data['Node']['Node'])
+        return variables(cls, data, **kwargs)
+    monkeypatch.setattr(JinjaRender, 'variables', classmethod(counted))
+
+    render = ColumnRender(COLUMNS)
+    assert len(render.render(ENTRIES)) == len(ENTRIES)
+    assert built == ['node0', 'node1', 'node2']
+
+    built.clear()
+    ColumnRender(['{{ Node.Node }}', '{{ Service.Port }}']).render(ENTRIES)
+    assert built == []
+
+
+def test_column_render_error():
+    '''Column failing to render is left empty, empty rows are skipped'''
+    render = ColumnRender(['{{ Node.Node }}', '{{ 100 // Service.Port }}'])
+    data = [dict(ENTRIES[0], Service={'Port': 0}), ENTRIES[1]]
+    assert render.render(data) == [['node0', ''], ['node1', '0']]
+
+    render = ColumnRender(['{{ Node.Missing }}', '{{ Service.Missing }}'])
+    assert render.render(ENTRIES) == []
+
+
+def test_encoders():
+    '''Compact encoders produce the same output, floats aside'''
+    pytest.importorskip('orjson')
+    data = ENTRIES + [{'name': 'nöde "2"', 'weight': 0.5, 'big': 2 ** 70}]
+    for sort_keys in (False, True):
+        assert Formatter.Encoders.orjson(data, sort_keys=sort_keys) == \
+            Formatter.Encoders.json(data, sort_keys=sort_keys)
+
+    floats = [1e100, 1e-7, float('nan')]
+    assert Formatter.Encoders.orjson(floats) == '[1e100,1e-7,null]'
+    assert Formatter.Encoders.json(floats) == '[1e+100,1e-07,NaN]'
+
+
+def test_msgpack():
+    '''MessagePack objects are written per entry to the binary buffer'''
+    msgpack = pytest.importorskip('msgpack')
+    out = io.TextIOWrapper(io.BytesIO())
+    Formatter('msgpack', out=out).write(iter(ENTRIES))
+    assert list(msgpack.Unpacker(io.BytesIO(out.buffer.getvalue()))) == \
+        ENTRIES
+
+    out = io.TextIOWrapper(io.BytesIO())
+    Formatter('msgpack', out=out).output(ENTRIES)
+    assert list(msgpack.Unpacker(io.BytesIO(out.buffer.getvalue()))) == \
+        ENTRIES
@@ -0,0 +1,116 @@
+import pytest
+
+from counsel.snapshot import Snapshot
+
+
+def instances(service, count, index=1):
+    return [{
+        'Node': {'Node': 'node{}'.format(n), 'Address': '10.0.0.{}'.format(n)},
+        'Service': {'Service': service, 'Port': 8000 + n,
+                    'Tags': ['class:{}'.format('pio' if n % 2 else 'web'),
+                             'index:{}'.format(index)]},
+        'Checks': [{'Name': 'serf', 'Status': 'passing'}],
+    } for n in range(count)]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'services.snap')
+
+
+def test_encode_lookup(path):
+    web = instances('web', 100)
+    Snapshot.write(path, [('web', Snapshot.encode(7, web)),
+                          ('empty', Snapshot.encode(3, []))], dc='dc1')
+
+    with Snapshot(path) as snapshot:
+        assert snapshot.info == {'dc': 'dc1'}
+        assert 'web' in snapshot and 'db' not in snapshot
+        assert snapshot.index('web') == 7
+        assert snapshot.index('db') is None
+
+        assert list(snapshot.entries('web')) == web
+        assert list(snapshot.entries('web', 'class:pio')) == \
+            [entry for entry in web if 'class:pio' in entry['Service']['Tags']]
+        assert list(snapshot.entries('web', 'class:db')) == []
+        assert list(snapshot.entries('empty')) == []
+
+        with pytest.raises(Snapshot.NotFound):
+            list(snapshot.entries('db'))
+
+
+def test_copy_blocks(path, tmp_path):
+    '''Blocks are copied between snapshots as they are'''
+    web, db = instances('web', 10), instances('db', 5)
+    Snapshot.write(path, [('web', Snapshot.encode(1, web)),
+                          ('db', Snapshot.encode(2, db))])
+
+    copy = str(tmp_path / 'copy.snap')
+    with Snapshot(path) as snapshot:
+        block = snapshot.block('db')
+        Snapshot.write(copy, [('db', block),
+                              ('web', Snapshot.encode(3, web[:1]))])
+
+    with Snapshot(copy) as snapshot:
+        assert snapshot.index('db') == 2
+        assert list(snapshot.entries('db')) == db
+        assert list(snapshot.entries('db', 'class:web')) == db[::2]
+        assert list(snapshot.entries('web')) == web[:1]
+
+
+@pytest.mark.parametrize('content', [b'', b'CNSLSNP1', b'x' * 64])
+def test_invalid(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+    with pytest.raises(Snapshot.Error):
+        Snapshot(path)
+
+
+def test_missing(path):
+    with pytest.raises(Snapshot.Error):
+        Snapshot(path)
+
+
+@pytest.fixture
+def server(fake_consul):
+    server = fake_consul()
+    for service, index in (('web', 10), ('db', 20), ('cache', 30)):
+        server.update(service, instances(service, 4, index), index)
+    return server
+
+
+def test_refresh(server, path):
+    from counsel.counsel import Counsel
+
+    app = Counsel(server=server.uri)
+    stats = app.snapshot(path=path, workers=1)
+    assert stats['services'] == 3 and stats['updated'] == 3
+
+    with Snapshot(path) as snapshot:
+        before = {service: snapshot.block(service).data
+                  for service in server.services}
+
+    # only the services whose index moved are updated
+    server.update('db', instances('db', 4, 21), 21)
+    stats = app.snapshot(path=path, refresh=True, workers=1)
+    assert stats['services'] == 3 and stats['updated'] == 1
+
+    with Snapshot(path) as snapshot:
+        assert snapshot.index('db') == 21
+        assert list(snapshot.entries('db', 'index:21')) == \
+            instances('db', 4, 21)
+        for service in ('web', 'cache'):
+            assert snapshot.block(service).data == before[service]
+            assert list(snapshot.entries(service)) == \
+                instances(service, 4, server.index(service))
+
+    # refreshing selected services keeps the others
+    server.update('web', instances('web', 4, 11), 11)
+    stats = app.snapshot(services=['web'], path=path, refresh=True,
+                         workers=1)
+    assert stats['services'] == 3 and stats['updated'] == 1
+
+    with Snapshot(path) as snapshot:
+        assert sorted(snapshot.services) == ['cache', 'db', 'web']
+        assert snapshot.index('web') == 11
+        assert snapshot.block('cache').data == before['cache']
@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+from counsel.stream import JSONStream, iter_array
+
+
+ENTRIES = [
+    {'Node': {'Node': 'node1', 'Address': '10.0.0.1'},
+     'Service': {'Port': 8080, 'Tags': ['class:pio', 'v2'], 'Weight': 1.5}},
+    {'Node': {'Node': 'nöde2 "quoted" \\ ,]}'}, 'Service': None},
+    12345678,
+    -0.25e3,
+    'text',
+    [],
+    {},
+    True,
+    None,
+]
+
+
+def split(text, size):
+    return [text[pos:pos + size] for pos in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 1 << 20])
+def test_chunk_boundaries(size):
+    text = json.dumps(ENTRIES, indent=1, ensure_ascii=False)
+    assert list(iter_array(split(text, size))) == ENTRIES
+
+
+def test_every_split():
+    text = json.dumps(ENTRIES)
+    for pos in range(len(text) + 1):
+        assert list(iter_array([text[:pos], '', text[pos:]])) == ENTRIES
+
+
+@pytest.mark.parametrize('chunks', [
+    # numbers ending at a chunk end continue in the next one
+    ['[12', '34', ', 5', '6]'],
+    ['[1234', ',56', ']'],
+    ['[1234,', '56]'],
+    # a prefix of a number might be a number itself
+    ['[1234', '.0, 56]'],
+    ['[1234.', '0, 5', '6e0]'],
+    ['[1.234', 'e3, 56', 'E-0]'],
+    ['[1.234e', '+3,', '56]'],
+])
+def test_truncated_numbers(chunks):
+    assert list(iter_array(chunks)) == [1234, 56]
+
+
+def test_number_at_end_of_stream():
+    with pytest.raises(JSONStream.Error):
+        list(iter_array(['[1, 2']))
+
+
+def test_empty():
+    assert list(iter_array(['[', ' ', ']'])) == []
+    assert list(iter_array([' [\n]\n'])) == []
+
+
+def test_key():
+    text = json.dumps({'Index': 10, 'Skipped': {'a': [1, 2]},
+                       'Nodes': ENTRIES, 'After': 'x'})
+    assert list(iter_array(split(text, 5), key='Nodes')) == ENTRIES
+
+
+def test_key_not_found():
+    with pytest.raises(JSONStream.Error):
+        list(iter_array(['{"Index": 1}'], key='Nodes'))
+    with pytest.raises(JSONStream.Error):
+        list(iter_array(['{}'], key='Nodes'))
+
+
+@pytest.mark.parametrize('chunks', [
+    [''],
+    ['{"a": 1}'],
+    ['[1, 2'],
+    ['[1 2]'],
+    ['[{"a": }]'],
+    ['[{"a": 1}', '}'],
+])
+def test_invalid(chunks):
+    with pytest.raises(ValueError):
+        list(iter_array(chunks))
+
+
+def test_incremental():
+    '''Elements are yielded as soon as they are complete'''
+    def chunks():
+        yield '[1, {"a": 2}, '
+        raise AssertionError('read past the first elements')
+
+    items = iter_array(chunks())
+    assert next(items) == 1
+    assert next(items) == {'a': 2}
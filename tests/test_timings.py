@@ -0,0 +1,97 @@
+import io
+import json
+
+import pytest
+
+from counsel.counsel import Counsel
+from counsel.timings import Timings, Collector
+
+
+@pytest.fixture
+def collector():
+    collector = Collector()
+    Timings.add_hook(collector)
+    yield collector
+    Timings.remove_hook(collector)
+
+
+def test_span(collector):
+    with Timings.span('http', 'GET /v1/status/leader', stream=False) as attrs:
+        attrs['size'] = 10
+
+    [event] = collector.events
+    assert event['kind'] == 'http'
+    assert event['name'] == 'GET /v1/status/leader'
+    assert event['size'] == 10 and event['stream'] is False
+    assert event['duration_ms'] >= 0
+
+
+def test_span_error(collector):
+    '''Blocks which raise are timed as well'''
+    with pytest.raises(ValueError):
+        with Timings.span('render', 'JinjaRender'):
+            raise ValueError('broken template')
+    assert [e['name'] for e in collector.events] == ['JinjaRender']
+
+
+def test_disabled():
+    '''Nothing is recorded once the hook is removed'''
+    events = []
+    hook = events.append
+    Timings.add_hook(hook)
+    assert Timings.enabled()
+    Timings.remove_hook(hook)
+    assert not Timings.enabled()
+
+    with Timings.span('api', 'health.service') as attrs:
+        attrs['size'] = 1
+    Timings.record('cache', 'hit /v1/health/service/web', 0.5)
+    assert events == []
+
+
+def test_record(collector):
+    Timings.record('cache', 'hit /v1/health/service/web', 0.0125, size=7)
+    assert collector.events == [{
+        'kind': 'cache', 'name': 'hit /v1/health/service/web',
+        'duration_ms': 12.5, 'size': 7
+    }]
+
+
+def test_aggregate(collector):
+    Timings.record('http', 'GET /v1/query', 0.010, size=100, wire_size=40)
+    Timings.record('http', 'GET /v1/query', 0.030, size=300, wire_size=60)
+    Timings.record('decode', '/v1/query', 0.002)
+
+    assert collector.aggregate() == [{
+        'kind': 'http', 'name': 'GET /v1/query', 'count': 2,
+        'total_ms': 40.0, 'max_ms': 30.0, 'size': 400, 'wire_size': 100
+    }, {
+        'kind': 'decode', 'name': '/v1/query', 'count': 1,
+        'total_ms': 2.0, 'max_ms': 2.0, 'size': 0, 'wire_size': 0
+    }]
+
+    out = io.StringIO()
+    collector.write(out)
+    header, http, decode = out.getvalue().splitlines()
+    assert header.split()[:3] == ['kind', 'name', 'count']
+    assert http.split() == ['http', 'GET', '/v1/query', '2', '40.0', '30.0',
+                            '400', '100']
+    assert decode.split()[:3] == ['decode', '/v1/query', '1']
+
+    out = io.StringIO()
+    collector.write(out, output_format='json')
+    dump = json.loads(out.getvalue())
+    assert dump['events'] == collector.events
+    assert dump['summary'] == collector.aggregate()
+
+
+def test_api_span_names(collector, fake_consul):
+    '''API spans are named after the operation, not the HTTP client'''
+    app = Counsel(server=fake_consul().uri)
+    app.health_service('web')
+    app.health_service('web', where='Service.Port == 8000')
+    app.query_service('web')
+
+    names = [e['name'] for e in collector.events if e['kind'] == 'api']
+    assert names == ['health.service', 'health.service', 'query.execute',
+                     'query.create', 'query.execute']
@@ -0,0 +1,95 @@
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+import counsel.counsel
+from counsel.counsel import Counsel
+
+
+def entries(*nodes):
+    return [{
+        'Node': {'Node': node, 'Address': '10.0.0.1'},
+        'Service': {'Service': 'web', 'Tags': []},
+        'Checks': []
+    } for node in nodes]
+
+
+@pytest.fixture
+def server(fake_consul):
+    server = fake_consul()
+    server.update('web', entries('a'), index=5)
+    return server
+
+
+def indexes(server):
+    '''Index params of the health requests'''
+    return [parse_qs(urlsplit(path).query).get('index', [None])[0]
+            for _, path in server.requests]
+
+
+def later(function, *args, **kwargs):
+    '''Call function once the watch is blocked by the request'''
+    timer = threading.Timer(0.2, function, args, kwargs)
+    timer.start()
+    return timer
+
+
+def test_index(server):
+    '''Blocking queries pass the last index, which is reset when it goes
+       backwards'''
+    app = Counsel(server=server.uri)
+    watch = Counsel.Health(app.agent).watch('web', wait='10s',
+                                            min_interval=0)
+
+    assert next(watch) == entries('a')
+    later(server.update, 'web', entries('b'))
+    assert next(watch) == entries('b')
+    assert indexes(server) == [None, '5']
+
+    later(server.update, 'web', entries('c'), index=2)
+    assert next(watch) == entries('c')
+    assert next(watch) == entries('c')
+    assert indexes(server) == [None, '5', '6', None]
+
+
+def test_changes_only(server):
+    '''Results are yielded only when the rendered output changes'''
+    app = Counsel(server=server.uri)
+    watch = app.watch_health_service('web', filter='{{ Node.Node }}',
+                                     wait='10s', min_interval=0)
+
+    assert next(watch) == ['a']
+
+    def update():
+        # the index moves, the nodes don't
+        server.update('web', entries('a'))
+        later(server.update, 'web', entries('a', 'b'))
+    later(update)
+    assert next(watch) == ['a', 'b']
+    assert indexes(server) == [None, '5', '6']
+
+
+def test_backoff(server, monkeypatch, caplog):
+    '''Failed requests are retried with backoff growing by the consecutive
+       failures'''
+    attempts = []
+
+    def backoff_delay(attempt, cap):
+        attempts.append(attempt)
+        return 0.01
+    monkeypatch.setattr(counsel.counsel, 'backoff_delay', backoff_delay)
+
+    app = Counsel(server=server.uri)
+    watch = Counsel.Health(app.agent).watch('web', wait='10s',
+                                            min_interval=0)
+
+    server.codes = [400, 400]
+    assert next(watch) == entries('a')
+    assert attempts == [1, 2]
+
+    server.codes = [400]
+    later(server.update, 'web', entries('b'))
+    assert next(watch) == entries('b')
+    assert attempts == [1, 2, 1]
+    assert caplog.text.count('watch failed') == 3
@@ -0,0 +1,121 @@
+import pytest
+
+from counsel.where import Where
+
+
+def entry(*tags):
+    return {'Node': {'Node': 'node1'}, 'Service': {'Tags': list(tags)}}
+
+
+ENTRY = {
+    'Node': {'Node': 'node1', 'Meta': {'rack': 'r1'}},
+    'Service': {'Service': 'web', 'Port': 8080, 'Tags': ['class:pio', 'v2'],
+                'Meta': {}},
+    'Checks': [{'Name': 'serf', 'Status': 'passing'},
+               {'Name': 'http', 'Status': 'critical'}],
+}
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('Node.Node == node1', True),
+    ('Node.Node == "node2"', False),
+    ('Node.Node != node2', True),
+    ('Service.Port == 8080', True),
+    ('Service.Port != 8080', False),
+    ('Service.Service contains "we"', True),
+    ('Service.Service matches "^w.b$"', True),
+    ('Service.Service not matches "^w"', False),
+    ('Node.Meta contains rack', True),
+    ('Node.Meta.rack == r1', True),
+    ('Service.Meta is empty', True),
+    ('Service.Tags is not empty', True),
+    ('Node.Missing is empty', True),
+])
+def test_scalar(expression, expected):
+    assert Where(expression)(ENTRY) is expected
+
+
+@pytest.mark.parametrize('expression, expected', [
+    # list values are tested element by element
+    ('Service.Tags matches "^class"', True),
+    ('Service.Tags matches "^env"', False),
+    ('Service.Tags not matches "^class"', False),
+    ('Service.Tags == v2', True),
+    ('Service.Tags != v2', False),
+    ('Service.Tags != v3', True),
+    ('Service.Tags contains "class:pio"', True),
+    ('Service.Tags contains "class"', False),
+    ('"v2" in Service.Tags', True),
+    ('"v3" not in Service.Tags', True),
+    # selectors crossing lists match if any of the elements does, != is
+    # the negation of ==
+    ('Checks.Status == critical', True),
+    ('Checks.Status != passing', False),
+    ('Checks.Status != warning', True),
+    ('Checks.Name matches "^ht"', True),
+    ('Checks.Status == warning', False),
+])
+def test_list(expression, expected):
+    assert Where(expression)(ENTRY) is expected
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('Node.Node == node1 and Service.Port == 80', False),
+    ('Node.Node == node1 or Service.Port == 80', True),
+    ('not (Node.Node == node1 and Service.Port == 80)', True),
+    ('Node.Node == node2 or (Service.Tags == v2 and not Service.Port == 1)',
+     True),
+])
+def test_logic(expression, expected):
+    assert Where(expression)(ENTRY) is expected
+
+
+@pytest.mark.parametrize('expression', [
+    'Node.Node ==',
+    'Node.Node == node1 and',
+    '(Node.Node == node1',
+    'Node.Node is full',
+    '"node1" == Node.Node',
+    'Node.Node matches "("',
+    'Node.Node === node1',
+])
+def test_invalid(expression):
+    with pytest.raises(Where.Error):
+        Where(expression)
+
+
+def test_filter():
+    entries = [entry('class:pio'), entry('class:web'), entry()]
+    where = Where('Service.Tags contains "class:web"')
+    assert list(where.filter(entries)) == [entries[1]]
+
+
+def test_tag_filter_key_value():
+    where = Where.create(None, ['class=pio'])
+    assert where(entry('class:pio', 'env:prod'))
+    assert not where(entry('class:pion'))
+    assert where.server == 'Service.Tags contains "class:pio"'
+
+
+def test_tag_filter_key_only():
+    where = Where.create(None, ['class'])
+    assert where(entry('env:prod', 'class:pio'))
+    assert where(entry('class'))
+    assert not where(entry('classy:pio'))
+    assert not where(entry())
+    # Consul can't evaluate matches on tag lists
+    assert where.server is None
+
+
+def test_tag_filter_mixed():
+    where = Where.create('Node.Node == "node1"', ['class', 'env=prod'])
+    assert where(entry('class:pio', 'env:prod'))
+    assert not where(entry('env:prod'))
+    assert not where(entry('class:pio', 'env:dev'))
+    assert where.server == \
+        '(Node.Node == "node1") and Service.Tags contains "env:prod"'
+
+
+def test_tag_filter_invalid():
+    with pytest.raises(Where.Error):
+        Where.create(None, ['=pio'])